@@ -8,11 +8,13 @@ Routes:
 - /: Displays the upload page
 - /upload: Handles file uploads
 - /process/<uid>: Processes uploaded files
+- /process_status/<job_id>: Reports the progress of asynchronous upload processing
 - /session: Displays session overview
 - /regret_video: Handles regret recording for videos
 - /attention_check: Manages attention checks
 - /review: Displays regret summary
 - /post_submit: Submits regrets and cleans up temporary files
+- /metrics: Exposes Prometheus metrics
 """
 
 import os
@@ -20,39 +22,68 @@ import uuid
 import json
 import random
 import datetime
+import time
 import logging
 import yaml
+import click
 import pandas as pd
 from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, Request, Response, render_template, request, redirect, url_for, flash, session
 from flask_migrate import Migrate
-from flask_session import Session
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.utils import secure_filename
 from redis import Redis
-from utils.yt_utils import get_youtube_video_info, beautify_video_info
-from utils.file_utils import create_sessions, parse_yt_url
+from prometheus_client import CONTENT_TYPE_LATEST
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import CompileError, DataError, IntegrityError, ProgrammingError
+from utils.yt_utils import HttpPool, build_http, build_youtube, get_youtube_videos_info, beautify_video_info
+from utils.file_utils import HashingFile, compact_uploads, create_sessions, load_sessions, read_watch_history, save_sessions
+from utils.cache_utils import ChannelCache, LRUCache, VideoCache
+from utils.db_utils import bulk_insert
+from utils.metrics_utils import MeteredRedisSessionInterface, instrument_app, record_upload, render_metrics, record_video_cache_event, record_youtube_guard_state
+from utils.queue_utils import enqueue_job, get_job_status, job_status_key, increment_job_status, claim_inflight, release_inflight, wait_inflight
+from utils.queue_utils import append_record, ensure_group, read_records, ack_records, is_acknowledged
+from utils.throttle_utils import ApiGuard, CircuitBreaker, CircuitOpenError, QuotaCounter, TokenBucket
 from werkzeug.utils import secure_filename
 
 
 load_dotenv('.env')
 
+
+class HashingRequest(Request):
+    """Request whose uploaded files are hashed while they are received."""
+
+    def _get_file_stream(self, *args, **kwargs):
+        return HashingFile(super()._get_file_stream(*args, **kwargs))
+
+
 app = Flask(__name__)
+app.request_class = HashingRequest
 app.secret_key = os.getenv('FLASK_SECRET')
 app.config['ALLOWED_EXTENSIONS'] = set(['json'])
-app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{os.getenv("PG_USER")}:{os.getenv("PG_PW")}@db/{os.getenv("PG_DB")}'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', f'postgresql://{os.getenv("PG_USER")}:{os.getenv("PG_PW")}@db/{os.getenv("PG_DB")}')
 app.config['SESSION_TYPE'] = 'redis'
 app.config['SESSION_PERMANENT'] = False
 app.config['SESSION_USE_SIGNER'] = True
-app.config['SESSION_REDIS'] = Redis(host='redis', port=6379, db=0)
-Session(app)
+redis_client = Redis.from_url(os.getenv('REDIS_URL', 'redis://redis:6379/0'))
+app.config['SESSION_REDIS'] = redis_client
+app.session_interface = MeteredRedisSessionInterface(
+    app,
+    client=redis_client,
+    use_signer=app.config['SESSION_USE_SIGNER'],
+    permanent=app.config['SESSION_PERMANENT'],
+)
+instrument_app(app)
 
 # Load non-secret config values from config.yaml
 with open('config.yaml', 'r') as file:
     config = yaml.safe_load(file)
 # Set other configuration values from the loaded YAML config
 app.config['UPLOAD_FOLDER'] = config['UPLOAD_FOLDER']
+app.config['UPLOAD_ARCHIVE_FOLDER'] = config['UPLOAD_ARCHIVE_FOLDER']
+app.config['UPLOAD_COMPACT_AFTER_DAYS'] = config['UPLOAD_COMPACT_AFTER_DAYS']
 app.config['MIN_NUM_SESSIONS'] = config['MIN_NUM_SESSIONS']
 app.config['MIN_TIME_BETWEEN_SESSIONS'] = config['MIN_TIME_BETWEEN_SESSIONS']
 app.config['MIN_VIDEOS_PER_SESSION'] = config['MIN_VIDEOS_PER_SESSION']
@@ -64,6 +95,29 @@ app.config['ATTENTION_LEFT'] = config['ATTENTION_LEFT']
 app.config['ATTENTION_RIGHT'] = config['ATTENTION_RIGHT']
 app.config['ATTENTION_LEFT_RELATIVE_TIME'] = config['ATTENTION_LEFT_RELATIVE_TIME']
 app.config['ATTENTION_RIGHT_RELATIVE_TIME'] = config['ATTENTION_RIGHT_RELATIVE_TIME']
+app.config['ASYNC_INGEST'] = config['ASYNC_INGEST']
+app.config['INGEST_TIMEOUT_SECONDS'] = config['INGEST_TIMEOUT_SECONDS']
+app.config['PREFETCH_ENABLED'] = config['PREFETCH_ENABLED']
+app.config['PREFETCH_WAIT_SECONDS'] = config['PREFETCH_WAIT_SECONDS']
+app.config['CHANNEL_CACHE_SIZE'] = config['CHANNEL_CACHE_SIZE']
+app.config['CHANNEL_MAX_AGE_DAYS'] = config['CHANNEL_MAX_AGE_DAYS']
+app.config['REVIEW_PAGE_SIZE'] = config['REVIEW_PAGE_SIZE']
+app.config['DISPLAY_CACHE_SIZE'] = config['DISPLAY_CACHE_SIZE']
+app.config['VIDEO_CACHE_SIZE'] = config['VIDEO_CACHE_SIZE']
+app.config['VIDEO_CACHE_TTL'] = config['VIDEO_CACHE_TTL']
+app.config['VIDEO_CACHE_NEGATIVE_TTL'] = config['VIDEO_CACHE_NEGATIVE_TTL']
+app.config['UNAVAILABLE_RECHECK_DAYS'] = config['UNAVAILABLE_RECHECK_DAYS']
+app.config['WRITE_BEHIND'] = config['WRITE_BEHIND']
+app.config['WRITE_BEHIND_BATCH_SIZE'] = config['WRITE_BEHIND_BATCH_SIZE']
+app.config['WRITE_BEHIND_WAIT_SECONDS'] = config['WRITE_BEHIND_WAIT_SECONDS']
+app.config['YT_TIMEOUT_SECONDS'] = config['YT_TIMEOUT_SECONDS']
+app.config['YT_MAX_CONCURRENCY'] = config['YT_MAX_CONCURRENCY']
+app.config['YT_RATE_LIMIT'] = config['YT_RATE_LIMIT']
+app.config['YT_RATE_BURST'] = config['YT_RATE_BURST']
+app.config['YT_RATE_WAIT_SECONDS'] = config['YT_RATE_WAIT_SECONDS']
+app.config['YT_BREAKER_FAILURES'] = config['YT_BREAKER_FAILURES']
+app.config['YT_BREAKER_WINDOW_SECONDS'] = config['YT_BREAKER_WINDOW_SECONDS']
+app.config['YT_BREAKER_RESET_SECONDS'] = config['YT_BREAKER_RESET_SECONDS']
 
 # Calculate and set derived values
 app.config['ATTENTION_LEFT_TIME'] = int(app.config['ATTENTION_LEFT_RELATIVE_TIME'] * app.config['MIN_TOTAL_VIDEOS'])
@@ -72,17 +126,50 @@ app.config['ATTENTION_RIGHT_TIME'] = int(app.config['ATTENTION_RIGHT_RELATIVE_TI
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+# Redis key prefix marking videos whose metadata is currently being fetched
+VIDEO_INFLIGHT_PREFIX = 'video_inflight'
+# Redis stream buffering ratings in write-behind mode, and the consumer group writing them to the database
+RATINGS_STREAM = 'ratings'
+RATINGS_GROUP = 'flusher'
+# Redis stream keeping the buffered ratings that cannot be written, with the error
+RATINGS_DEAD_LETTER_STREAM = 'ratings:dead'
+
+# YouTube API client with a timeout on every call, and the rate limit, circuit breaker and quota counter
+# that all web and worker processes share through Redis
+youtube = build_youtube(timeout=app.config['YT_TIMEOUT_SECONDS'])
+# HTTP objects sending the calls of a batch of more than 50 videos or channels concurrently
+youtube_http_pool = HttpPool(lambda: build_http(timeout=app.config['YT_TIMEOUT_SECONDS']),
+                             size=app.config['YT_MAX_CONCURRENCY'])
+youtube_guard = ApiGuard(
+    TokenBucket(redis_client, 'youtube:bucket', rate=app.config['YT_RATE_LIMIT'], capacity=app.config['YT_RATE_BURST']),
+    CircuitBreaker(redis_client, 'youtube:circuit',
+                   failure_threshold=app.config['YT_BREAKER_FAILURES'],
+                   failure_window=app.config['YT_BREAKER_WINDOW_SECONDS'],
+                   reset_seconds=app.config['YT_BREAKER_RESET_SECONDS']),
+    QuotaCounter(redis_client, 'youtube:quota'),
+    max_wait=app.config['YT_RATE_WAIT_SECONDS'],
+)
+
 class Files(db.Model):
     """Table for storing file metadata."""
+    __table_args__ = (
+        # repeated uploads are looked up by user and content
+        db.Index('ix_files_user_id_content_hash', 'user_id', 'content_hash'),
+    )
     filename = db.Column(db.String(80), primary_key=True)
     user_id = db.Column(db.String(20), nullable=False)
     tz_offset = db.Column(db.Float, nullable=True)
     created_at = db.Column(db.DateTime, nullable=False)
     completed = db.Column(db.Boolean, default=False)
     updated_at = db.Column(db.DateTime, nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
     
 class HistoryInfo(db.Model):
     """Table for storing video history information."""
+    __table_args__ = (
+        # sessions are always looked up within a file
+        db.Index('ix_history_info_filename_session_num', 'filename', 'session_num'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(80), nullable=False)
     video_id = db.Column(db.String(20), nullable=False)
@@ -94,23 +181,25 @@ class Selected(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     session_num = db.Column(db.Integer, nullable=False)
     position = db.Column(db.Integer, nullable=False)
-    history_id = db.Column(db.Integer, db.ForeignKey('history_info.id'), nullable=False)
+    history_id = db.Column(db.Integer, db.ForeignKey('history_info.id'), nullable=False, index=True)
 
 class Regrets(db.Model):
     """Table for storing user regrets."""
     id = db.Column(db.Integer, primary_key=True)
-    history_id = db.Column(db.Integer, db.ForeignKey('history_info.id'), nullable=False)
+    history_id = db.Column(db.Integer, db.ForeignKey('history_info.id'), nullable=False, index=True)
     regret = db.Column(db.String(20), nullable=False)
     reason = db.Column(db.String(120), nullable=True)
     created_at = db.Column(db.DateTime, nullable=False)
+    stream_id = db.Column(db.String(32), nullable=True, unique=True)
     
 class Attention(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(80), nullable=False)
+    filename = db.Column(db.String(80), nullable=False, index=True)
     created_at = db.Column(db.DateTime, nullable=True)
     check_passed = db.Column(db.Boolean, nullable=True)
     attention_side = db.Column(db.String(20), nullable=True)
     attention_time = db.Column(db.Integer, nullable=True)
+    stream_id = db.Column(db.String(32), nullable=True, unique=True)
 
 
 class Video(db.Model):
@@ -129,6 +218,55 @@ class Video(db.Model):
     channel_title = db.Column(db.String(120), nullable=True)
     channel_icon = db.Column(db.String(400), nullable=True)
     description = db.Column(db.String(1200), nullable=True)
+    fetched_at = db.Column(db.DateTime, nullable=True)
+
+class Channel(db.Model):
+    """Table for caching channel metadata."""
+    channel_id = db.Column(db.String(120), nullable=False, primary_key=True)
+    title = db.Column(db.String(120), nullable=True)
+    icon = db.Column(db.String(400), nullable=True)
+    fetched_at = db.Column(db.DateTime, nullable=False)
+
+class UnavailableVideo(db.Model):
+    """Table for storing videos that YouTube reported as deleted or private."""
+    video_id = db.Column(db.String(20), nullable=False, primary_key=True)
+    checked_at = db.Column(db.DateTime, nullable=False)
+
+class RegretCounts:
+    """Columns counting the ratings of a group, one per regret value, maintained by refresh_aggregates."""
+    n_ratings = db.Column(db.Integer, nullable=False, default=0)
+    n_yes = db.Column(db.Integer, nullable=False, default=0)
+    n_no = db.Column(db.Integer, nullable=False, default=0)
+    n_dont_remember = db.Column(db.Integer, nullable=False, default=0)
+    n_skip = db.Column(db.Integer, nullable=False, default=0)
+
+class RegretsByUser(RegretCounts, db.Model):
+    """Table for storing the rating counts and times of every upload."""
+    filename = db.Column(db.String(80), primary_key=True)
+    user_id = db.Column(db.String(20), nullable=False, index=True)
+    first_rating_at = db.Column(db.DateTime, nullable=True)
+    last_rating_at = db.Column(db.DateTime, nullable=True)
+    n_checks = db.Column(db.Integer, nullable=False, default=0)
+    n_checks_passed = db.Column(db.Integer, nullable=False, default=0)
+
+class RegretsByChannel(RegretCounts, db.Model):
+    """Table for storing the rating counts of the videos of every channel."""
+    channel_id = db.Column(db.String(120), primary_key=True)
+
+class RegretsByCategory(RegretCounts, db.Model):
+    """Table for storing the rating counts of the videos of every YouTube category."""
+    category_id = db.Column(db.Integer, primary_key=True)
+
+class AttentionBySide(db.Model):
+    """Table for storing the number of attention checks shown and passed on every side."""
+    attention_side = db.Column(db.String(20), primary_key=True)
+    n_checks = db.Column(db.Integer, nullable=False, default=0)
+    n_checks_passed = db.Column(db.Integer, nullable=False, default=0)
+
+class AggregateWatermark(db.Model):
+    """Table for storing the highest ID of a rating table included in the aggregate tables."""
+    table_name = db.Column(db.String(40), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
 
 logging.basicConfig(level=logging.DEBUG) 
 # Configure loggers
@@ -162,6 +300,833 @@ def object_as_dict(obj):
     """Convert an object to a dictionary, excluding private attributes."""
     return {key: value for key, value in obj.__dict__.items() if not key.startswith('_')}
 
+def insert_history(filename, view_sessions, return_ids=False):
+    """
+    Write the whole watch history of a file to HistoryInfo in one round-trip.
+
+    Parameters:
+    filename (str): Name of the processed file.
+    view_sessions (utils.file_utils.Sessions): Sessions as returned by create_sessions.
+    return_ids (bool): Whether to return the generated history IDs.
+
+    Returns:
+    list: The generated history IDs in event order if return_ids is set, otherwise None.
+    """
+    rows = [
+        {'filename': filename, 'video_id': video_id, 'event_ts': ts, 'session_num': index_sess}
+        for ts, video_id, index_sess in zip(view_sessions.timestamps().to_pydatetime(),
+                                            view_sessions.video_ids.tolist(),
+                                            view_sessions.session_numbers().tolist())
+    ]
+    return bulk_insert(db.session.connection(), HistoryInfo.__table__, rows, return_ids=return_ids)
+
+
+def load_channels(channel_ids):
+    """
+    Load cached channels from the database, ignoring entries older than CHANNEL_MAX_AGE_DAYS.
+
+    Parameters:
+    channel_ids (list): IDs of the channels to load.
+
+    Returns:
+    dict: A dictionary mapping each stored channel ID to its title and icon URL.
+    """
+    min_fetched_at = datetime.datetime.now() - datetime.timedelta(days=app.config['CHANNEL_MAX_AGE_DAYS'])
+    channels = Channel.query.filter(Channel.channel_id.in_(channel_ids), Channel.fetched_at >= min_fetched_at).all()
+    return {channel.channel_id: {'title': channel.title, 'icon': channel.icon} for channel in channels}
+
+
+def store_channels(channels_info):
+    """
+    Save fetched channels to the database, replacing stale entries.
+
+    Parameters:
+    channels_info (dict): A dictionary mapping channel IDs to their title and icon URL.
+    """
+    fetched_at = datetime.datetime.now()
+    rows = [dict(channel_id=channel_id, title=info['title'], icon=info['icon'], fetched_at=fetched_at)
+            for channel_id, info in channels_info.items()]
+    statement = pg_insert(Channel).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=['channel_id'],
+        set_={'title': statement.excluded.title, 'icon': statement.excluded.icon, 'fetched_at': statement.excluded.fetched_at}
+    )
+    db.session.execute(statement)
+    db.session.commit()
+
+
+channel_cache = ChannelCache(load_channels, store_channels, maxsize=app.config['CHANNEL_CACHE_SIZE'])
+
+
+def store_videos(videos_info):
+    """
+    Save fetched videos to the database, ignoring videos saved concurrently by another process.
+
+    Parameters:
+    videos_info (dict): A dictionary mapping video IDs to their raw video information.
+    """
+    if not videos_info:
+        return
+    fetched_at = datetime.datetime.now()
+    rows = [dict(video_info, video_id=video_id, fetched_at=fetched_at) for video_id, video_info in videos_info.items()]
+    db.session.execute(pg_insert(Video).values(rows).on_conflict_do_nothing(index_elements=['video_id']))
+    db.session.commit()
+
+
+def unavailable_recheck_time():
+    """Time before which videos recorded as unavailable are checked again on YouTube."""
+    return datetime.datetime.now() - datetime.timedelta(days=app.config['UNAVAILABLE_RECHECK_DAYS'])
+
+
+def load_unavailable(video_ids):
+    """
+    Load the videos recorded as unavailable that are not due for a re-check.
+
+    Parameters:
+    video_ids (list): IDs of the videos to look up.
+
+    Returns:
+    set: The IDs of the videos known to be unavailable.
+    """
+    rows = (
+        db.session.query(UnavailableVideo.video_id)
+        .filter(UnavailableVideo.video_id.in_(video_ids), UnavailableVideo.checked_at >= unavailable_recheck_time())
+        .all()
+    )
+    return {video_id for (video_id,) in rows}
+
+
+def store_unavailable(video_ids):
+    """
+    Record videos that YouTube reported as unavailable, restarting the re-check interval of known ones.
+
+    Parameters:
+    video_ids (list): IDs of the unavailable videos.
+    """
+    if not video_ids:
+        return
+    checked_at = datetime.datetime.now()
+    statement = pg_insert(UnavailableVideo).values([dict(video_id=video_id, checked_at=checked_at) for video_id in video_ids])
+    statement = statement.on_conflict_do_update(index_elements=['video_id'], set_={'checked_at': statement.excluded.checked_at})
+    db.session.execute(statement)
+    db.session.commit()
+
+
+def available_sessions(filename, session_nums):
+    """
+    Keep the sessions that have at least MIN_VIDEOS_PER_SESSION videos not known to be unavailable.
+
+    Parameters:
+    filename (str): Name of the processed file.
+    session_nums (list): Numbers of the sessions to check.
+
+    Returns:
+    list: The numbers of the available sessions, in the given order.
+    """
+    unavailable_ids = select(UnavailableVideo.video_id).where(UnavailableVideo.checked_at >= unavailable_recheck_time())
+    counts = dict(
+        db.session.query(HistoryInfo.session_num, func.count(HistoryInfo.id))
+        .filter(HistoryInfo.filename == filename,
+                HistoryInfo.session_num.in_(session_nums),
+                HistoryInfo.video_id.not_in(unavailable_ids))
+        .group_by(HistoryInfo.session_num)
+        .all()
+    )
+    return [session_num for session_num in session_nums if counts.get(session_num, 0) >= app.config['MIN_VIDEOS_PER_SESSION']]
+
+
+def fetch_videos_info(video_ids, log_context):
+    """
+    Fetch videos from YouTube in one batch and save them to the database.
+
+    Videos recorded as unavailable are not requested again until their re-check interval has passed.
+    The videos are marked as in-flight in Redis while they are fetched, so that
+    other processes can wait for them instead of fetching them a second time.
+
+    Parameters:
+    video_ids (list): IDs of the videos to fetch.
+    log_context (str): Description of the user, file and session, used for logging.
+
+    Returns:
+    tuple: A dictionary mapping each found video ID to its raw video information,
+           and a list of the video IDs that were not found.
+
+    Raises:
+    CircuitOpenError: If the YouTube API calls are suspended after repeated failures.
+    RateLimitedError: If the shared rate limit of the YouTube API calls was reached.
+    """
+    youtube_guard.breaker.check()
+    unavailable_ids = load_unavailable(video_ids)
+    if unavailable_ids:
+        app.logger.info(f'Skipping videos {sorted(unavailable_ids)} recorded as unavailable {log_context}')
+        video_ids = [video_id for video_id in video_ids if video_id not in unavailable_ids]
+    fetched_info, not_found_ids = {}, []
+    if video_ids:
+        app.logger.info(f'Fetching videos {video_ids} from YouTube {log_context}')
+        claimed_ids = claim_inflight(redis_client, VIDEO_INFLIGHT_PREFIX, video_ids)
+        try:
+            fetched_info, not_found_ids = get_youtube_videos_info(video_ids, youtube=youtube, channel_cache=channel_cache,
+                                                                  guard=youtube_guard, http_pool=youtube_http_pool)
+            store_videos(fetched_info)
+            store_unavailable(not_found_ids)
+        finally:
+            release_inflight(redis_client, VIDEO_INFLIGHT_PREFIX, claimed_ids)
+        if not_found_ids:
+            app.logger.error(f'Videos {not_found_ids} not found on YouTube {log_context}')
+        app.logger.info(f'Videos {list(fetched_info)} fetched from YouTube {log_context}')
+    return fetched_info, not_found_ids + sorted(unavailable_ids)
+
+
+def load_videos(video_ids):
+    """
+    Load stored videos from the database.
+
+    Parameters:
+    video_ids (list): IDs of the videos to load.
+
+    Returns:
+    dict: A dictionary mapping each stored video ID to its raw video information.
+    """
+    return {video.video_id: object_as_dict(video) for video in Video.query.filter(Video.video_id.in_(video_ids)).all()}
+
+
+video_cache = VideoCache(
+    redis_client,
+    load_videos,
+    maxsize=app.config['VIDEO_CACHE_SIZE'],
+    ttl=app.config['VIDEO_CACHE_TTL'],
+    negative_ttl=app.config['VIDEO_CACHE_NEGATIVE_TTL'],
+    record_event=record_video_cache_event,
+)
+
+
+def get_videos_info(video_ids, log_context, status_key=None, cached_info=None):
+    """
+    Look up videos in the video cache and fetch all cache misses from YouTube in one batch.
+
+    Videos that are being prefetched by the worker are waited for briefly instead of being fetched twice.
+
+    Parameters:
+    video_ids (list): IDs of the videos to resolve.
+    log_context (str): Description of the user, file and session, used for logging.
+    status_key (str, optional): Redis key of the prefetch job status, used to count prefetch hits and misses.
+    cached_info (dict, optional): Videos already loaded from the database, which are not looked up again.
+
+    Returns:
+    dict: A dictionary mapping each resolved video ID to its raw video information.
+    """
+    video_ids = list(dict.fromkeys(video_ids))
+    cached_info = cached_info or {}
+    videos_info = {video_id: cached_info[video_id] for video_id in video_ids if video_id in cached_info}
+    fetched_ids = []
+
+    def fetch_missing(missing_ids):
+        prefetched_info = {}
+        if app.config['PREFETCH_ENABLED']:
+            inflight_ids = wait_inflight(redis_client, VIDEO_INFLIGHT_PREFIX, missing_ids, app.config['PREFETCH_WAIT_SECONDS'])
+            if inflight_ids:
+                db.session.expire_all()
+                prefetched_info = load_videos(inflight_ids)
+                missing_ids = [video_id for video_id in missing_ids if video_id not in prefetched_info]
+        if not missing_ids:
+            return prefetched_info, []
+        fetched_ids.extend(missing_ids)
+        try:
+            fetched_info, not_found_ids = fetch_videos_info(missing_ids, log_context)
+        except CircuitOpenError:
+            # the overview is built from the videos that are already cached until the API recovers
+            app.logger.warning(f'YouTube API calls suspended, videos {missing_ids} skipped {log_context}')
+            return prefetched_info, []
+        except Exception as e:
+            # not cached as missing, so that the videos are fetched again on the next request
+            app.logger.error(f'Error fetching videos {missing_ids} from YouTube: {str(e)} {log_context}')
+            db.session.rollback()
+            return prefetched_info, []
+        return {**prefetched_info, **fetched_info}, not_found_ids
+
+    remaining_ids = [video_id for video_id in video_ids if video_id not in videos_info]
+    if remaining_ids:
+        videos_info.update(video_cache.get_many(remaining_ids, fetch_missing))
+    if status_key:
+        try:
+            increment_job_status(redis_client, status_key, 'hits', len(video_ids) - len(fetched_ids))
+            increment_job_status(redis_client, status_key, 'misses', len(fetched_ids))
+        except Exception as e:
+            app.logger.error(f'Error recording prefetch hit rate: {str(e)} {log_context}')
+    return videos_info
+
+
+# Display data of the sessions shown to users, shared by all requests of the process so that
+# the Flask session only needs to hold the history IDs of the current session
+display_cache = LRUCache(maxsize=app.config['DISPLAY_CACHE_SIZE'])
+
+
+def session_header(first_ts, last_ts, n_videos):
+    """
+    Format the header of a session as shown above its videos.
+
+    Parameters:
+    first_ts (datetime): Time of the first event of the session.
+    last_ts (datetime): Time of the last event of the session.
+    n_videos (int): Number of videos watched in the session.
+
+    Returns:
+    dict: The day, start time, end time and number of videos of the session.
+    """
+    return {
+        'day': first_ts.strftime('%B %d, %Y'),
+        'start_time': first_ts.strftime('%-I:%M %p'),
+        'end_time': last_ts.strftime('%-I:%M %p'),
+        'sess_num_videos': n_videos,
+    }
+
+
+def history_display(history):
+    """
+    Extract the fields of a history record shown next to its video.
+
+    Parameters:
+    history (HistoryInfo): The history record.
+
+    Returns:
+    dict: The video ID, watch time and history ID of the record.
+    """
+    return {'video_id': history.video_id, 'watched_at': history.event_ts.strftime('%-I:%M %p'), 'history_id': history.id}
+
+
+def load_session_display(filename, session_num, history_ids, log_context):
+    """
+    Resolve the display data of a session from the display and video caches, loading the missing entries from the database.
+
+    Parameters:
+    filename (str): Name of the processed file.
+    session_num (int): Number of the session in the file.
+    history_ids (list): History IDs of the videos selected for the session, in display order.
+    log_context (str): Description of the user, file and session, used for logging.
+
+    Returns:
+    dict: The session header with the beautified information of the selected videos under 'videos'.
+    """
+    header_key = ('session', filename, session_num)
+    video_keys = [('history', history_id) for history_id in history_ids]
+    cached = display_cache.get_many([header_key] + video_keys)
+
+    if header_key not in cached:
+        first_ts, last_ts, n_videos = (
+            db.session.query(func.min(HistoryInfo.event_ts), func.max(HistoryInfo.event_ts), func.count(HistoryInfo.id))
+            .filter(HistoryInfo.filename == filename, HistoryInfo.session_num == session_num)
+            .one()
+        )
+        cached[header_key] = session_header(first_ts, last_ts, n_videos)
+        display_cache.put_many({header_key: cached[header_key]})
+
+    missing_ids = [history_id for history_id, key in zip(history_ids, video_keys) if key not in cached]
+    if missing_ids:
+        loaded = {
+            ('history', history.id): history_display(history)
+            for history in HistoryInfo.query.filter(HistoryInfo.id.in_(missing_ids)).all()
+        }
+        display_cache.put_many(loaded)
+        cached.update(loaded)
+
+    entries = [cached[key] for key in video_keys]
+    videos_info = get_videos_info([entry['video_id'] for entry in entries], log_context)
+    # display fields such as the video age are computed at render time
+    videos = [beautify_video_info(dict(videos_info[entry['video_id']], **entry)) for entry in entries]
+    return dict(cached[header_key], videos=videos)
+
+
+class IngestError(Exception):
+    """Problem with an uploaded file, whose message is shown to the user."""
+
+
+def ingest_history(stream, filename, uid, tz_offset, content_hash=None):
+    """
+    Parse an uploaded watch history, split it into sessions and save it.
+
+    Creates the file record, writes the cleaned history to the upload folder and to HistoryInfo,
+    and queues the prefetch of the eligible sessions' video metadata.
+
+    Parameters:
+    stream (file-like): Binary stream containing the watch-history JSON array.
+    filename (str): Name under which the file is stored.
+    uid (str): ID of the user.
+    tz_offset (float): Offset in hours of the user's time zone, or None.
+    content_hash (str, optional): SHA-256 hash of the upload.
+
+    Returns:
+    dict: The total number of videos that can be shown and the numbers of the eligible sessions.
+
+    Raises:
+    IngestError: If the file cannot be read or does not contain enough sessions or videos.
+    """
+    # Create and save file record
+    ts_now = datetime.datetime.now()
+    try:
+        new_file = Files(filename=filename,
+                        user_id=uid,
+                        tz_offset=tz_offset,
+                        created_at=ts_now,
+                        content_hash=content_hash)
+        db.session.add(new_file) 
+    except Exception as e:
+        app.logger.error(f'Error creating file record: {str(e)} for user {uid}')   
+
+    try:
+        df = read_watch_history(stream, tz_offset=tz_offset)
+        app.logger.info(f'File {filename} read successfully for user {uid}')
+    except Exception as e:
+        app.logger.error(f'Error reading file: {str(e)} for user {uid}')
+        raise IngestError('Error reading file. Make sure you uploaded the correct file.')
+
+    # break up history into sessions
+    view_sessions = create_sessions(df, delta_minutes=app.config['MIN_TIME_BETWEEN_SESSIONS'])
+    if len(view_sessions) < app.config['MIN_NUM_SESSIONS']:
+        app.logger.error(f'Not enough sessions in file for user {uid}')
+        raise IngestError('Not enough sessions in recent history. Make sure you uploaded the correct file.')
+    
+    total_videos = view_sessions.n_videos(app.config['MAX_VIDEOS_PER_SESSION'])
+    if total_videos < app.config['MAX_TOTAL_VIDEOS']:
+        app.logger.error(f'Not enough videos in file for user {uid}, only {total_videos} found, expected > {app.config["MAX_TOTAL_VIDEOS"]}')
+        raise IngestError('Not enough videos in history file. Make sure you uploaded the correct file.')
+     
+    try:
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f'{filename}.parquet')
+        save_sessions(view_sessions, filepath)
+        app.logger.info(f'File {filepath} saved successfully for user {uid}')
+    except Exception as e:
+        app.logger.error(f'Error saving file: {str(e)} for user {uid}')
+    
+    eligible_sessions = []
+    # populate HistoryInfo
+    try:
+        insert_history(filename, view_sessions)
+        eligible_sessions = view_sessions.eligible(app.config['MIN_VIDEOS_PER_SESSION'], app.config['LATEST_EVENT'])
+        db.session.commit()
+        app.logger.info(f'History records created successfully for user {uid}')
+    except Exception as e:
+        db.session.rollback()
+        eligible_sessions = []
+        app.logger.error(f'Error creating history records: {str(e)} for user {uid}')
+
+    # fetch video metadata in the background before the session overview needs it
+    if app.config['PREFETCH_ENABLED'] and eligible_sessions:
+        try:
+            enqueue_job(redis_client, 'prefetch',
+                        {'filename': filename, 'eligible_sessions': eligible_sessions},
+                        status_key=f'prefetch:{filename}')
+            app.logger.info(f'Prefetch job queued for file {filename} for user {uid}')
+        except Exception as e:
+            app.logger.error(f'Error queuing prefetch job: {str(e)} for user {uid}')
+
+    return {'n_total_videos': total_videos, 'eligible_sessions': eligible_sessions}
+
+
+def find_upload(uid, content_hash, tz_offset):
+    """
+    Find an upload of the same file by the same user, in the same time zone, whose history was stored.
+
+    Uploads still queued or being processed, and those whose processing failed, have no history rows
+    and are not returned, so the file is processed again.
+
+    Parameters:
+    uid (str): ID of the user.
+    content_hash (str): SHA-256 hash of the upload.
+    tz_offset (float): Offset in hours of the user's time zone, or None.
+
+    Returns:
+    Files: The most recent such upload, or None.
+    """
+    return db.session.execute(
+        select(Files)
+        .where(Files.user_id == uid, Files.content_hash == content_hash, Files.tz_offset.is_not_distinct_from(tz_offset))
+        .where(select(HistoryInfo.id).where(HistoryInfo.filename == Files.filename).exists())
+        .order_by(Files.created_at.desc())
+        .limit(1)
+    ).scalar_one_or_none()
+
+
+def load_upload_sessions(filename):
+    """
+    Load the sessions saved by ingest_history, from the upload folder or from the compacted uploads.
+
+    Parameters:
+    filename (str): Name of the processed file.
+
+    Returns:
+    Sessions: The sessions, or None if they were not saved.
+    """
+    path = os.path.join(app.config['UPLOAD_FOLDER'], f'{filename}.parquet')
+    if os.path.exists(path):
+        return load_sessions(path)
+    if os.path.isdir(app.config['UPLOAD_ARCHIVE_FOLDER']):
+        view_sessions = load_sessions(app.config['UPLOAD_ARCHIVE_FOLDER'], filename)
+        if len(view_sessions):
+            return view_sessions
+    return None
+
+
+def reuse_upload(filename):
+    """
+    Rebuild the result of ingest_history for an upload that was already processed, with the progress of its ratings.
+
+    The sessions already shown are left out, so the study continues where it stopped instead of showing
+    rated videos again.
+
+    Parameters:
+    filename (str): Name of the processed file.
+
+    Returns:
+    dict: The result of ingest_history with the progress of the study, or None if the sessions were not saved.
+    """
+    view_sessions = load_upload_sessions(filename)
+    if view_sessions is None:
+        return None
+    shown = db.session.execute(
+        select(HistoryInfo.session_num, Selected.session_num)
+        .join(Selected, Selected.history_id == HistoryInfo.id)
+        .where(HistoryInfo.filename == filename)
+    ).all()
+    shown_sessions = {history_session for history_session, _ in shown}
+    eligible_sessions = view_sessions.eligible(app.config['MIN_VIDEOS_PER_SESSION'], app.config['LATEST_EVENT'])
+    return {
+        'n_total_videos': view_sessions.n_videos(app.config['MAX_VIDEOS_PER_SESSION']),
+        'eligible_sessions': [session_num for session_num in eligible_sessions if session_num not in shown_sessions],
+        # Selected.session_num is the index of a session among those shown to the user, not its number in the file
+        'current_session': max((selected_index for _, selected_index in shown), default=-1) + 1,
+        'n_rated_videos': db.session.scalar(
+            select(func.count()).select_from(Regrets)
+            .join(HistoryInfo, Regrets.history_id == HistoryInfo.id)
+            .where(HistoryInfo.filename == filename, Regrets.regret != 'skip')
+        ),
+        'n_attention_checks': db.session.scalar(select(func.count()).where(Attention.filename == filename)),
+    }
+
+
+def start_study(result):
+    """
+    Initialize the study progress in the user session from the result of ingest_history or reuse_upload.
+
+    Parameters:
+    result (dict): The result of ingest_history or reuse_upload.
+    """
+    session['n_total_videos'] = result['n_total_videos']
+    session['current_video'] = 0 #<- current video in the session
+    session['current_session'] = result.get('current_session', 0) #<- current session
+    session['n_rated_videos'] = result.get('n_rated_videos', 0)
+    session['n_attention_checks'] = result.get('n_attention_checks', 0)
+    session['eligible_sessions'] = result['eligible_sessions']
+    session['n_eligible_sessions'] = len(result['eligible_sessions'])
+
+
+# Tables whose rows can be buffered in the ratings stream
+RATING_MODELS = {model.__tablename__: model for model in (Regrets, Attention)}
+
+
+def record_rating(model, **fields):
+    """
+    Save a rating, or append it to the ratings stream in write-behind mode.
+
+    Parameters:
+    model (db.Model): Model of the rating, Regrets or Attention.
+    fields: Column values of the rating.
+
+    Raises:
+    ValueError: If a regret does not rate a video of the current session.
+    """
+    # a rating that cannot be written would otherwise hold up the ratings stream
+    if model is Regrets and fields.get('history_id') not in session.get('current_history_ids', []):
+        raise ValueError(f'History ID {fields.get("history_id")} is not a video of the current session')
+    if app.config['WRITE_BEHIND']:
+        record = {'table': model.__tablename__, 'fields': fields}
+        session['last_rating_id'] = append_record(redis_client, RATINGS_STREAM, record, encoder=CustomEncoder)
+    else:
+        db.session.add(model(**fields))
+        db.session.commit()
+
+
+# Errors of ratings that cannot be written however often they are retried
+RATING_DATA_ERRORS = (CompileError, DataError, IntegrityError, ProgrammingError)
+
+
+def insert_ratings(model, rows):
+    """Insert rating rows, skipping those already written from the same stream entry."""
+    db.session.execute(pg_insert(model).values(rows).on_conflict_do_nothing(index_elements=['stream_id']))
+
+
+def flush_ratings(consumer, block=None):
+    """
+    Write one batch of buffered ratings to the database and acknowledge them.
+
+    Ratings are acknowledged only after they are committed, and each row keeps the ID of its stream entry,
+    so ratings delivered again after a crash are not written twice. If the batch cannot be written because
+    of the data of some ratings, the ratings are written one by one, and those that still fail are moved
+    to the dead-letter stream, so that they do not hold up the ratings after them.
+
+    Parameters:
+    consumer (str): Name of the consumer in the ratings consumer group.
+    block (int, optional): Time in milliseconds to wait for new ratings.
+
+    Returns:
+    int: Number of ratings written.
+    """
+    entries = read_records(redis_client, RATINGS_STREAM, RATINGS_GROUP, consumer,
+                           app.config['WRITE_BEHIND_BATCH_SIZE'], block=block)
+    rows = []
+    failed = []
+    for entry_id, record in entries:
+        try:
+            fields = dict(record['fields'], stream_id=entry_id)
+            if fields.get('created_at'):
+                fields['created_at'] = datetime.datetime.fromisoformat(fields['created_at'])
+            rows.append((entry_id, record, RATING_MODELS[record['table']], fields))
+        except (KeyError, TypeError, ValueError) as e:
+            failed.append((entry_id, record, e))
+
+    try:
+        by_model = {}
+        for _, _, model, fields in rows:
+            by_model.setdefault(model, []).append(fields)
+        for model, model_rows in by_model.items():
+            insert_ratings(model, model_rows)
+        db.session.commit()
+    except RATING_DATA_ERRORS as e:
+        db.session.rollback()
+        app.logger.warning(f'Batch of {len(rows)} ratings could not be written, writing them one by one: {str(e)}')
+        for entry_id, record, model, fields in rows:
+            try:
+                with db.session.begin_nested():
+                    insert_ratings(model, [fields])
+            except RATING_DATA_ERRORS as row_error:
+                failed.append((entry_id, record, row_error))
+        db.session.commit()
+
+    for entry_id, record, error in failed:
+        append_record(redis_client, RATINGS_DEAD_LETTER_STREAM, {'entry_id': entry_id, 'record': record, 'error': str(error)})
+        app.logger.error(f'Rating {entry_id} moved to {RATINGS_DEAD_LETTER_STREAM}: {str(error)}')
+    ack_records(redis_client, RATINGS_STREAM, RATINGS_GROUP, [entry_id for entry_id, _ in entries])
+    return len(entries) - len(failed)
+
+
+def drain_ratings(entry_id, timeout):
+    """
+    Write buffered ratings until a given rating is in the database, or until the timeout expires.
+
+    Parameters:
+    entry_id (str): ID of the stream entry of the rating.
+    timeout (float): Maximum time in seconds to wait.
+
+    Returns:
+    bool: Whether the rating and all ratings before it are written, or moved to the dead-letter stream.
+    """
+    ensure_group(redis_client, RATINGS_STREAM, RATINGS_GROUP)
+    deadline = time.monotonic() + timeout
+    while not is_acknowledged(redis_client, RATINGS_STREAM, RATINGS_GROUP, entry_id):
+        if time.monotonic() >= deadline:
+            return False
+        # help the flusher rather than only waiting for it
+        if flush_ratings(f'web-{os.getpid()}') == 0:
+            time.sleep(0.05)
+    return True
+
+
+# Columns of the aggregate tables counting each value of Regrets.regret
+REGRET_COUNT_COLUMNS = {'yes': 'n_yes', 'no': 'n_no', 'dont remember': 'n_dont_remember', 'skip': 'n_skip'}
+# Values that the keyboard shortcuts of the rating buttons used to submit, stored in older ratings
+KEYBOARD_REGRET_VALUES = {'regret': 'yes', 'noRegret': 'no', 'noRemember': 'dont remember'}
+AGGREGATE_MODELS = (RegretsByUser, RegretsByChannel, RegretsByCategory, AttentionBySide)
+
+
+def normalize_regret(value):
+    """Map a value submitted by a keyboard shortcut to the value of its rating button."""
+    return KEYBOARD_REGRET_VALUES.get(value, value)
+
+
+def regret_counts(regret):
+    """Count the ratings of a group, in total and for every regret value."""
+    return [func.count().label('n_ratings')] + [
+        func.count().filter(regret.in_([value] + [key for key, alias in KEYBOARD_REGRET_VALUES.items() if alias == value]))
+        .label(column)
+        for value, column in REGRET_COUNT_COLUMNS.items()
+    ]
+
+
+def merge_counts(model, keys, query, merge=None):
+    """
+    Add the counts of a grouped query to the rows of an aggregate table, inserting the groups it does not have yet.
+
+    Parameters:
+    model (db.Model): Aggregate table.
+    keys (list): Names of the key columns of the groups.
+    query (Select): Grouped query whose columns are labeled with the names of the table columns.
+    merge (dict, optional): Functions combining the stored and the new value of columns that are not added up.
+    """
+    columns = [column.name for column in query.selected_columns]
+    statement = pg_insert(model).from_select(columns, query)
+    merge = merge or {}
+    values = {
+        column: merge.get(column, lambda stored, new: stored + new)(getattr(model, column), statement.excluded[column])
+        for column in columns if column not in keys
+    }
+    db.session.execute(statement.on_conflict_do_update(index_elements=keys, set_=values))
+
+
+def refresh_aggregates(full=False):
+    """
+    Add the ratings and attention checks stored since the last refresh to the aggregate tables.
+
+    Every rating table has a watermark, the highest ID already aggregated, so each refresh only reads the new rows,
+    and the counts and watermarks are updated in one transaction. A rating committed after a rating with a higher ID
+    had already been aggregated, or whose video had no metadata yet, is only counted by a full refresh.
+
+    Parameters:
+    full (bool): Rebuild the aggregate tables from all ratings.
+
+    Returns:
+    dict: The previous and new watermark of every rating table.
+    """
+    db.session.execute(
+        pg_insert(AggregateWatermark)
+        .values([{'table_name': model.__tablename__, 'last_id': 0} for model in RATING_MODELS.values()])
+        .on_conflict_do_nothing(index_elements=['table_name'])
+    )
+    # lock the watermarks, so that concurrent refreshes do not count the same ratings twice
+    watermarks = dict(db.session.execute(
+        select(AggregateWatermark.table_name, AggregateWatermark.last_id).with_for_update()
+    ).all())
+    if full:
+        for model in AGGREGATE_MODELS:
+            db.session.execute(delete(model))
+        watermarks = dict.fromkeys(watermarks, 0)
+    bounds = {
+        model.__tablename__: (watermarks[model.__tablename__],
+                              db.session.scalar(select(func.max(model.id))) or watermarks[model.__tablename__])
+        for model in RATING_MODELS.values()
+    }
+
+    last_id, high_id = bounds[Regrets.__tablename__]
+    if high_id > last_id:
+        ratings = (
+            select(Regrets.regret, Regrets.created_at, HistoryInfo.filename, HistoryInfo.video_id)
+            .join(HistoryInfo, Regrets.history_id == HistoryInfo.id)
+            .where(Regrets.id > last_id, Regrets.id <= high_id)
+            .subquery()
+        )
+        merge_counts(
+            RegretsByUser, ['filename'],
+            select(ratings.c.filename, Files.user_id, *regret_counts(ratings.c.regret),
+                   func.min(ratings.c.created_at).label('first_rating_at'),
+                   func.max(ratings.c.created_at).label('last_rating_at'))
+            .join(Files, Files.filename == ratings.c.filename)
+            .group_by(ratings.c.filename, Files.user_id),
+            merge={'user_id': lambda stored, new: stored,
+                   'first_rating_at': func.least, 'last_rating_at': func.greatest},
+        )
+        for model, column in ((RegretsByChannel, Video.channel_id), (RegretsByCategory, Video.category_id)):
+            merge_counts(
+                model, [column.name],
+                select(column, *regret_counts(ratings.c.regret))
+                .join(Video, Video.video_id == ratings.c.video_id)
+                .where(column.isnot(None))
+                .group_by(column),
+            )
+
+    last_id, high_id = bounds[Attention.__tablename__]
+    if high_id > last_id:
+        checks = select(Attention).where(Attention.id > last_id, Attention.id <= high_id).subquery()
+        check_counts = [func.count().label('n_checks'),
+                        func.count().filter(checks.c.check_passed.is_(True)).label('n_checks_passed')]
+        merge_counts(
+            RegretsByUser, ['filename'],
+            select(checks.c.filename, Files.user_id, *check_counts)
+            .join(Files, Files.filename == checks.c.filename)
+            .group_by(checks.c.filename, Files.user_id),
+            merge={'user_id': lambda stored, new: stored},
+        )
+        merge_counts(
+            AttentionBySide, ['attention_side'],
+            select(checks.c.attention_side, *check_counts)
+            .where(checks.c.attention_side.isnot(None))
+            .group_by(checks.c.attention_side),
+        )
+
+    for table_name, (_, high_id) in bounds.items():
+        db.session.execute(
+            update(AggregateWatermark).where(AggregateWatermark.table_name == table_name).values(last_id=high_id)
+        )
+    db.session.commit()
+    return bounds
+
+
+def study_summary():
+    """
+    Summarize the progress of the study from the aggregate tables.
+
+    Returns:
+    dict: Completion funnel, regret rate, attention-check pass rates and rating latency.
+    """
+    rated = RegretsByUser.n_ratings - RegretsByUser.n_skip
+    users = db.session.execute(select(
+        func.count().filter(RegretsByUser.n_ratings > 0).label('started'),
+        func.count().filter(rated >= app.config['MIN_TOTAL_VIDEOS']).label('qualified'),
+        func.count().filter(RegretsByUser.n_checks > 0,
+                            RegretsByUser.n_checks_passed == RegretsByUser.n_checks).label('passed_attention'),
+        func.coalesce(func.sum(RegretsByUser.n_yes), 0).label('n_yes'),
+        func.coalesce(func.sum(rated), 0).label('n_rated'),
+        # mean time between two ratings of a user, and from the upload to the first rating
+        func.avg(func.extract('epoch', RegretsByUser.last_rating_at - RegretsByUser.first_rating_at)
+                 / (RegretsByUser.n_ratings - 1)).filter(RegretsByUser.n_ratings > 1).label('seconds_per_rating'),
+        func.avg(func.extract('epoch', RegretsByUser.first_rating_at - Files.created_at)).label('seconds_to_first_rating'),
+    ).select_from(RegretsByUser).outerjoin(Files, Files.filename == RegretsByUser.filename)).one()
+    uploads = db.session.execute(select(func.count().label('uploaded'),
+                                        func.count().filter(Files.completed.is_(True)).label('completed'))).one()
+    attention = db.session.execute(
+        select(AttentionBySide.attention_side, AttentionBySide.n_checks, AttentionBySide.n_checks_passed)
+    ).all()
+    return {
+        'funnel': {
+            'uploaded': uploads.uploaded,
+            'started': users.started,
+            'qualified': users.qualified,
+            'passed_attention': users.passed_attention,
+            'completed': uploads.completed,
+        },
+        'regret_rate': users.n_yes / users.n_rated if users.n_rated else None,
+        'attention_pass_rate': {side: passed / checks for side, checks, passed in attention if checks},
+        'seconds_per_rating': users.seconds_per_rating,
+        'seconds_to_first_rating': users.seconds_to_first_rating,
+    }
+
+
+@app.cli.command('refresh-aggregates')
+@click.option('--full', is_flag=True, help='Rebuild the aggregate tables from all ratings.')
+def refresh_aggregates_command(full):
+    """Aggregate the ratings stored since the last refresh and print the progress of the study."""
+    for table_name, (last_id, high_id) in refresh_aggregates(full=full).items():
+        click.echo(f'{table_name}: aggregated IDs {last_id + 1} to {high_id}' if high_id > last_id
+                   else f'{table_name}: no new rows')
+    summary = study_summary()
+    click.echo(' > '.join(f'{step} {count}' for step, count in summary['funnel'].items()))
+    if summary['regret_rate'] is not None:
+        click.echo(f'regret rate {summary["regret_rate"]:.1%}')
+    for side, rate in sorted(summary['attention_pass_rate'].items()):
+        click.echo(f'attention check {side}: {rate:.1%} passed')
+    if summary['seconds_per_rating'] is not None:
+        click.echo(f'{summary["seconds_per_rating"]:.1f}s per rating, '
+                   f'{summary["seconds_to_first_rating"] or 0:.1f}s from upload to first rating')
+
+
+@app.cli.command('compact-uploads')
+@click.option('--older-than-days', type=float, default=None,
+              help='Minimum age in days of the compacted files, UPLOAD_COMPACT_AFTER_DAYS by default.')
+def compact_uploads_command(older_than_days):
+    """Merge the session files of old uploads into the partitioned dataset of UPLOAD_ARCHIVE_FOLDER."""
+    if older_than_days is None:
+        older_than_days = app.config['UPLOAD_COMPACT_AFTER_DAYS']
+    n_files = compact_uploads(app.config['UPLOAD_FOLDER'], app.config['UPLOAD_ARCHIVE_FOLDER'], older_than_days)
+    click.echo(f'Compacted {n_files} files into {app.config["UPLOAD_ARCHIVE_FOLDER"]}')
+
+
 @app.context_processor
 def inject_config():
     """Inject configuration into templates."""
@@ -239,83 +1204,47 @@ def process(uid):
             elif tz_offset == -5:
                 session['timezone'] = 'EST'
             app.logger.info(f'Processing file {filename} for user {uid}')
-            # Create and save file record
-            ts_now = datetime.datetime.now()
-            try:
-                new_file = Files(filename=filename,
-                                user_id=uid,
-                                tz_offset=tz_offset,
-                                created_at=ts_now)
-                db.session.add(new_file) 
-            except Exception as e:
-                app.logger.error(f'Error creating file record: {str(e)} for user {uid}')   
             session['filename'] = filename
             session['uid'] = uid
 
+            file.stream.seek(0, os.SEEK_END)
+            upload_size = file.stream.tell()
+            file.stream.seek(0)
+            ingest_start = time.perf_counter()
+
+            # the same file uploaded again by the same user continues the study of the first upload
+            content_hash = file.stream.content_hash
+            existing = find_upload(uid, content_hash, tz_offset)
+            result = reuse_upload(existing.filename) if existing else None
+            if result:
+                session['filename'] = existing.filename
+                record_upload(upload_size, 'sync', 'reused', time.perf_counter() - ingest_start)
+                app.logger.info(f'File {filename} for user {uid} is a repeated upload of file {existing.filename}')
+                start_study(result)
+                return redirect(url_for('session_overview'))
+
+            if app.config['ASYNC_INGEST']:
+                # store the upload and let the worker process it
+                upload_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{filename}.json')
+                file.save(upload_path)
+                job_id = enqueue_job(redis_client, 'ingest',
+                                     {'upload_path': upload_path, 'filename': filename, 'uid': uid, 'tz_offset': tz_offset,
+                                      'content_hash': content_hash})
+                record_upload(upload_size, 'async', 'ok', time.perf_counter() - ingest_start)
+                session['ingest_job'] = job_id
+                app.logger.info(f'Ingest job {job_id} queued for file {filename} for user {uid}')
+                return redirect(url_for('process_status', job_id=job_id))
+
             try:
-                df = pd.read_json(file, orient='records')
-                app.logger.info(f'File {file.filename} read successfully for user {uid}')
-            except Exception as e:
-                app.logger.error(f'Error reading file: {str(e)} for user {uid}')
-            df['video_id'] = df['titleUrl'].apply(lambda x: parse_yt_url(x) if pd.notnull(x) else None)
-            df.dropna(subset=['video_id'], inplace=True)
-            # drop items corresponding to ads
-            if 'details' in df.columns:
-                df = df[df['details'].isna()]
-            df = df[['time', 'video_id']]
-            df['time'] = pd.to_datetime(df['time'], format='ISO8601')
-            # offset the time
-            if tz_offset:
-                df['time'] = df['time'] + pd.Timedelta(hours=tz_offset)
-            # save the file locally
-            df.dropna(inplace=True)
-            df = df[df['video_id'].str.len() == 11]
-            
-            # break up history into sessions
-            view_sessions = create_sessions(df, delta_minutes=app.config['MIN_TIME_BETWEEN_SESSIONS'])
-            if len(view_sessions) < app.config['MIN_NUM_SESSIONS']:
-                app.logger.error(f'Not enough sessions in file for user {uid}')
-                return render_template('error.html', message='Not enough sessions in recent history. Make sure you uploaded the correct file.')
-            
-            total_videos = sum([min(len(sess), app.config['MAX_VIDEOS_PER_SESSION']) for sess in view_sessions])
-            if total_videos < app.config['MAX_TOTAL_VIDEOS']:
-                app.logger.error(f'Not enough videos in file for user {uid}, only {total_videos} found, expected > {app.config["MAX_TOTAL_VIDEOS"]}')
-                return render_template('error.html', message='Not enough videos in history file. Make sure you uploaded the correct file.')
-             
-            try:
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], f'{filename}.csv')
-                df.to_csv(filepath, index=False)
-                app.logger.info(f'File {filepath} saved successfully for user {uid}')
-            except Exception as e:
-                app.logger.error(f'Error saving file: {str(e)} for user {uid}')
-            
-            session['n_total_videos'] = total_videos
-            session['current_video'] = 0 #<- current video in the session
-            session['current_session'] = 0 #<- current session
-            session['n_rated_videos'] = 0
-            session['n_eligible_sessions'] = 0
-            session['n_attention_checks'] = 0
-            eligible_sessions = []
-            # populate HistoryInfo
-            try:
-                for index_sess, view_sess in enumerate(view_sessions):
-                    for (ts, video_id) in view_sess:
-                        new_history = HistoryInfo(
-                            filename=filename,
-                            video_id=video_id,
-                            event_ts=ts,
-                            session_num=index_sess,
-                        )
-                        db.session.add(new_history)
-                    last_ts = view_sess[-1][0]
-                    if last_ts >= pd.Timestamp(app.config['LATEST_EVENT']).tz_localize('UTC') and len(view_sess) >= app.config['MIN_VIDEOS_PER_SESSION']:
-                        eligible_sessions.append(index_sess)
-                db.session.commit()
-                app.logger.info(f'History records created successfully for user {uid}')
-                session['eligible_sessions'] = eligible_sessions
-                session['n_eligible_sessions'] = len(eligible_sessions)
-            except Exception as e:
-                app.logger.error(f'Error creating history records: {str(e)} for user {uid}')
+                result = ingest_history(file.stream, filename, uid, tz_offset, content_hash=content_hash)
+            except IngestError as e:
+                record_upload(upload_size, 'sync', 'rejected', time.perf_counter() - ingest_start)
+                return render_template('error.html', message=str(e))
+            except Exception:
+                record_upload(upload_size, 'sync', 'error', time.perf_counter() - ingest_start)
+                raise
+            record_upload(upload_size, 'sync', 'ok', time.perf_counter() - ingest_start)
+            start_study(result)
 
             # point to session_overview function
             return redirect(url_for('session_overview'))
@@ -325,70 +1254,98 @@ def process(uid):
         app.logger.error(f'Error processing file: {str(e)} for user {uid}')
         return render_template('error.html', message='Error processing file')     
     
+@app.route('/process_status/<job_id>')
+def process_status(job_id):
+    """Report the progress of an asynchronous upload processing job, and continue once it is done."""
+    if session.get('ingest_job') != job_id:
+        app.logger.warning(f'Unknown ingest job {job_id} requested for user {session.get("uid")}')
+        return render_template('error.html', message='Upload not found or session expired.')
+    status = get_job_status(redis_client, job_status_key(job_id))
+    state = status.get('state')
+    if state == 'done':
+        start_study(json.loads(status['result']))
+        session.pop('ingest_job')
+        return redirect(url_for('session_overview'))
+    if state == 'failed' or state is None:
+        app.logger.error(f'Ingest job {job_id} failed for user {session.get("uid")}: {status.get("error")}')
+        return render_template('error.html', message=status.get('message', 'Error processing file'))
+    if time.time() - float(status['queued_at']) > app.config['INGEST_TIMEOUT_SECONDS']:
+        # the job may be lost, for example when no worker is running
+        app.logger.error(f'Ingest job {job_id} still {state} after {app.config["INGEST_TIMEOUT_SECONDS"]}s for user {session.get("uid")}')
+        session.pop('ingest_job')
+        return render_template('error.html', message='Error processing file')
+    return render_template('processing.html', job_id=job_id, state=state)
+    
 @app.route('/session_overview')
 def session_overview():
     """Render the session overview page."""
     eligible_sessions = session.get('eligible_sessions', [])
+    if eligible_sessions:
+        # drop the sessions that cannot be shown because too many of their videos are unavailable
+        available = available_sessions(session['filename'], eligible_sessions)
+        if len(available) < len(eligible_sessions):
+            app.logger.info(f'Sessions {sorted(set(eligible_sessions) - set(available))} excluded for unavailable videos for user {session["uid"]} in file {session["filename"]}')
+            eligible_sessions = available
+            session['eligible_sessions'] = eligible_sessions
+            session['n_eligible_sessions'] = len(eligible_sessions)
     session_data = {}
-    while len(eligible_sessions) > 0:
-        current_session = random.choice(eligible_sessions)
+    # sessions not tried yet in this request, so that failed lookups are not retried forever
+    candidate_sessions = list(eligible_sessions)
+    while len(candidate_sessions) > 0:
+        current_session = random.choice(candidate_sessions)
+        candidate_sessions.remove(current_session)
         try:
-            history_info = HistoryInfo.query.filter_by(filename=session['filename'], 
-                                                        session_num=current_session).all()
+            # load the session's history together with the videos already in the database
+            history_rows = (
+                db.session.query(HistoryInfo, Video)
+                .outerjoin(Video, Video.video_id == HistoryInfo.video_id)
+                .filter(HistoryInfo.filename == session['filename'], HistoryInfo.session_num == current_session)
+                .order_by(HistoryInfo.id)
+                .all()
+            )
+            history_info = [history for history, _ in history_rows]
+            cached_info = {video.video_id: object_as_dict(video) for _, video in history_rows if video is not None}
             app.logger.info(f'History records fetched successfully for user {session["uid"]} in file {session["filename"]} for session {current_session}')
         except Exception as e:
             app.logger.error(f'Error fetching history records: {str(e)} for user {session["uid"]} in file {session["filename"]} for session {current_session}')
-        session_data = {}
-        start = history_info[0].event_ts
-        day = start.strftime('%B %d, %Y')
-        session_data['day'] = day
-        start_time = start.strftime('%-I:%M %p')
-        session_data['start_time'] = start_time
-        end_time = history_info[-1].event_ts.strftime('%-I:%M %p')
-        session_data['end_time'] = end_time
-        session_data['sess_num_videos'] = len(history_info)
-        session_data['videos'] = []
+        log_context = f'for user {session["uid"]} in file {session["filename"]} for session {current_session}'
+        status_key = f'prefetch:{session["filename"]}' if app.config['PREFETCH_ENABLED'] else None
+        header = session_header(history_info[0].event_ts, history_info[-1].event_ts, len(history_info))
+        session_data = dict(header, videos=[])
+        display_entries = {}
+        selected_rows = []
         selected_videos = 0
-        for index, history in enumerate(history_info):
-            if selected_videos < app.config['MAX_VIDEOS_PER_SESSION']:
+        next_index = 0
+        while selected_videos < app.config['MAX_VIDEOS_PER_SESSION'] and next_index < len(history_info):
+            # resolve only as many videos as are still needed, in a single batch
+            window_start = next_index
+            next_index += app.config['MAX_VIDEOS_PER_SESSION'] - selected_videos
+            window = history_info[window_start:next_index]
+            videos_info = get_videos_info([history.video_id for history in window], log_context,
+                                          status_key=status_key, cached_info=cached_info)
+            for index, history in enumerate(window, start=window_start):
                 video_id = history.video_id
-                video_info = Video.query.get(video_id)
+                video_info = videos_info.get(video_id)
                 if video_info:
-                    app.logger.info(f'Video {video_id} fetched from database for user {session["uid"]} in file {session["filename"]} for session {current_session}')
-                    video_info = object_as_dict(video_info)
-                else:
-                    app.logger.info(f'Fetching video {video_id} from YouTube for user {session["uid"]} in file {session["filename"]} for session {current_session}')
-                    video_info = get_youtube_video_info(video_id)
-                    if video_info is None:
-                        app.logger.error(f'Error fetching video {video_id} from YouTube for user {session["uid"]} in file {session["filename"]} for session {current_session}')
-                    else:
-                        # save the video to the databaseß
-                        app.logger.info(f'Video {video_id} fetched from YouTube for user {session["uid"]} in file {session["filename"]} for session {current_session}')
-                        video_info['video_id'] = video_id
-                        video = Video(**video_info)
-                        db.session.add(video)
-                        db.session.commit()
-                if video_info:
-                    video_info = beautify_video_info(video_info)
-                    watched_at = HistoryInfo.query.filter_by(filename=session['filename'], id=history.id).first().event_ts
-                    watched_at = watched_at.strftime('%-I:%M %p')
-                    video_info['watched_at'] = watched_at
-                    video_info['history_id'] = history.id
-                    video_info['session_num'] = session['current_session']
-                    session_data['videos'].append(video_info)
-                    new_selected = Selected(
-                                session_num=session['current_session'],
-                                position=index,
-                                history_id=history.id
-                            )
-                    db.session.add(new_selected)
+                    display_info = history_display(history)
+                    display_entries[('history', history.id)] = display_info
+                    session_data['videos'].append(beautify_video_info(dict(video_info, **display_info)))
+                    selected_rows.append({
+                        'session_num': session['current_session'],
+                        'position': index,
+                        'history_id': history.id,
+                    })
                     app.logger.info(f'Video {video_id} added to session data for user {session["uid"]} in file {session["filename"]} for session {current_session}')
                     selected_videos += 1
+        bulk_insert(db.session.connection(), Selected.__table__, selected_rows)
         db.session.commit()
         if len(session_data['videos']) >= app.config['MIN_VIDEOS_PER_SESSION']:
             session['current_session'] +=1
             eligible_sessions.remove(current_session)
-            session['current_data'] = session_data
+            # keep only the IDs in the session; the display data is shared through the display cache
+            display_cache.put_many({('session', session['filename'], current_session): header, **display_entries})
+            session['current_session_num'] = current_session
+            session['current_history_ids'] = [video_info['history_id'] for video_info in session_data['videos']]
             session['eligible_sessions'] = eligible_sessions
             session['n_eligible_sessions'] = len(eligible_sessions)
             break
@@ -398,39 +1355,38 @@ def session_overview():
 def regret_video():
     try:
         if session['n_rated_videos'] >= app.config['MAX_TOTAL_VIDEOS']:
-            return redirect(url_for('regret_summary'))
+            return redirect(url_for('review'))
         
         if session['n_eligible_sessions'] == 0:
             if session['n_rated_videos'] < app.config['MIN_TOTAL_VIDEOS']:
                 return render_template('error.html', message='No more sessions to show. You have not completed rating enough videos to qualify.')
             else:
-                return redirect(url_for('regret_summary'))
+                return redirect(url_for('review'))
 
         
         # Load session data safely
         session_filename = session.get('filename')
         if not session_filename:
             raise ValueError("Session filename is missing")
-        session_data = session.get('current_data')
+        history_ids = session['current_history_ids']
         
         if request.method == 'POST':
             video_id = request.form.get('video_id')
-            regret = request.form.get('regret')
+            regret = normalize_regret(request.form.get('regret'))
             created_at = datetime.datetime.now()
-            history_id = request.form.get('history_id')
-            new_regret = Regrets(history_id=history_id,
-                                 regret=regret,
-                                 created_at=created_at)
+            history_id = request.form.get('history_id', type=int)
+            record_rating(Regrets,
+                          history_id=history_id,
+                          regret=regret,
+                          created_at=created_at)
             app.logger.info(f'Regret recorded for video {video_id} in session {session["filename"]} for user {session["uid"]}')
-            db.session.add(new_regret)
-            db.session.commit()
             
             if regret != 'skip':
                 session['n_rated_videos'] += 1
                 session.modified = True
             
             # Update session data
-            if session['current_video'] < len(session_data['videos']) - 1:
+            if session['current_video'] < len(history_ids) - 1:
                 session['current_video'] += 1
             else:
                 session['current_video'] = 0
@@ -446,6 +1402,8 @@ def regret_video():
             return redirect(url_for('attention_check'))
         
         # Serve the current video
+        log_context = f'for user {session["uid"]} in file {session_filename} for session {session["current_session_num"]}'
+        session_data = load_session_display(session_filename, session['current_session_num'], history_ids, log_context)
         video_info = session_data['videos'][session['current_video']]
         progress = min(100, session['n_rated_videos'] / app.config['MIN_TOTAL_VIDEOS'] * 100)
         return render_template('regret.html', 
@@ -466,21 +1424,20 @@ def attention_check():
         attention_image = app.config[f'ATTENTION_{attention_side}']
 
         if request.method == 'POST':
-            regret = request.form.get('regret')
+            regret = normalize_regret(request.form.get('regret'))
             if (regret == 'yes' and attention_side == 'LEFT') or (regret == 'no' and attention_side == 'RIGHT'):
                 attention_value = True 
             else:
                 attention_value = False
             created_at = datetime.datetime.now()
-            new_attention_check = Attention(
+            record_rating(
+                Attention,
                 filename=session['filename'],
                 created_at=created_at,
                 check_passed=attention_value,
                 attention_side=attention_side,
                 attention_time=session['n_rated_videos']
             )
-            db.session.add(new_attention_check)
-            db.session.commit()
             app.logger.info(f'{attention_side} attention status for user {session["uid"]} in session {session["filename"]} returned {attention_value}')
             session['n_attention_checks'] += 1
             session.modified = True  # Ensure session modifications are saved
@@ -519,28 +1476,36 @@ def attention_check():
 @app.route('/review')
 def review():
     try:
-        regrets_query = (
-            db.session.query(Regrets)
+        last_rating_id = session.get('last_rating_id')
+        if last_rating_id and not drain_ratings(last_rating_id, app.config['WRITE_BEHIND_WAIT_SECONDS']):
+            app.logger.warning(f'Ratings not yet saved for user {session["uid"]} in session {session["filename"]}')
+            return render_template('error.html', message='Your ratings are still being saved. Please reload this page in a moment.')
+        page = max(request.args.get('page', 1, type=int), 1)
+        page_size = app.config['REVIEW_PAGE_SIZE']
+        # one row per rating, fetching one extra row to know whether a next page exists
+        rows = (
+            db.session.query(Regrets.regret, Video.title)
             .join(HistoryInfo, Regrets.history_id == HistoryInfo.id)
-            .join(Files, HistoryInfo.filename == Files.filename)
-            .filter(Files.filename == session['filename'])
-            .order_by(Regrets.created_at.asc())
+            .outerjoin(Video, HistoryInfo.video_id == Video.video_id)
+            .filter(HistoryInfo.filename == session['filename'])
+            .order_by(Regrets.created_at.asc(), Regrets.id.asc())
+            .offset((page - 1) * page_size)
+            .limit(page_size + 1)
             .all()
         )
-        all_regrets = []
-        for regret in regrets_query:
-            this_regret = {}
-            this_regret['regret'] = regret.regret
-            video_id = HistoryInfo.query.get(regret.history_id).video_id
-            this_regret['title'] = Video.query.get(video_id).title
-            all_regrets.append(this_regret)
-        file = Files.query.filter_by(filename=session['filename']).first()
-        file.completed = True
-        file.updated_at = datetime.datetime.now()
-        db.session.commit()
-        app.logger.info(f'Regrets recorded for user {session["uid"]} in session {session["filename"]}')
-        return render_template('regrets_summary.html', regrets=all_regrets)
+        has_next = len(rows) > page_size
+        all_regrets = [{'regret': regret, 'title': title} for regret, title in rows[:page_size]]
+        if page == 1:
+            db.session.execute(
+                update(Files)
+                .where(Files.filename == session['filename'])
+                .values(completed=True, updated_at=datetime.datetime.now())
+            )
+            db.session.commit()
+            app.logger.info(f'Regrets recorded for user {session["uid"]} in session {session["filename"]}')
+        return render_template('regrets_summary.html', regrets=all_regrets, page=page, has_next=has_next)
     except Exception as e:
+        db.session.rollback()
         app.logger.error(f'Error showing regret summary: {str(e)} for user {session["uid"]} in session {session["filename"]}')
         return render_template('error.html', message='No regrets to display or session expired.')
 
@@ -548,6 +1513,15 @@ def review():
 def post_submit():
     return render_template('submission_success.html')
 
+@app.route('/metrics')
+def metrics():
+    """Expose the application metrics in the Prometheus text format."""
+    try:
+        record_youtube_guard_state(youtube_guard.quota.used(), youtube_guard.breaker.is_open())
+    except Exception as e:
+        app.logger.error(f'Error reading the YouTube API quota and circuit state: {str(e)}')
+    return Response(render_metrics(), mimetype=CONTENT_TYPE_LATEST)
+
    
 if __name__ == '__main__':
     with app.app_context():
@@ -0,0 +1,109 @@
+"""
+bench_metadata.py
+
+This benchmark measures the latency, API calls and quota units of fetching the metadata of a session's videos
+under emulated YouTube Data API conditions, for per-video fetches, batched fetches, batched fetches with a
+warm channel cache, and batches whose chunks of 50 videos are fetched concurrently. It runs offline against
+the emulator of utils.yt_emulator, so it needs no network access, API key or quota.
+
+Run it from the app directory:
+    python -m benchmarks.bench_metadata --latency-ms 80 --error-rate 0.01 --missing-rate 0.05
+Sessions of more than 50 videos, such as the prefetch of a whole upload, show the effect of concurrency:
+    python -m benchmarks.bench_metadata --sessions 10 --videos-per-session 400
+"""
+
+import argparse
+import time
+
+import numpy as np
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+from benchmarks.synthetic import generate_video_ids
+from utils.cache_utils import ChannelCache
+from utils.yt_emulator import EmulatorHttp
+from utils.yt_utils import HttpPool, get_youtube_video_info, get_youtube_videos_info
+
+
+def fetch_per_video(youtube, video_ids, channel_cache, http_pool):
+    """Fetch the videos one by one, as the session overview did before batching."""
+    for video_id in video_ids:
+        get_youtube_video_info(video_id, youtube=youtube)
+
+
+def fetch_batched(youtube, video_ids, channel_cache, http_pool):
+    """Fetch the videos with batched videos.list and channels.list calls."""
+    get_youtube_videos_info(video_ids, youtube=youtube)
+
+
+def fetch_batched_cached(youtube, video_ids, channel_cache, http_pool):
+    """Fetch the videos with batched calls, resolving channels from a cache shared by all sessions."""
+    get_youtube_videos_info(video_ids, youtube=youtube, channel_cache=channel_cache)
+
+
+def fetch_concurrent(youtube, video_ids, channel_cache, http_pool):
+    """Fetch the videos with batched calls sent concurrently, resolving channels from the shared cache."""
+    get_youtube_videos_info(video_ids, youtube=youtube, channel_cache=channel_cache, http_pool=http_pool)
+
+
+STRATEGIES = {
+    'per video': fetch_per_video,
+    'batched': fetch_batched,
+    'batched + channel cache': fetch_batched_cached,
+    'concurrent + channel cache': fetch_concurrent,
+}
+
+
+def run(args):
+    """
+    Fetch the metadata of synthetic sessions with each strategy and print the latency percentiles and API usage.
+
+    Parameters:
+    args (argparse.Namespace): Command-line arguments.
+    """
+    print(f'{args.sessions} sessions of {args.videos_per_session} videos, latency {args.latency_ms}ms '
+          f'+ up to {args.jitter_ms}ms, error rate {args.error_rate:.1%}, quota error rate {args.quota_error_rate:.1%}, '
+          f'missing rate {args.missing_rate:.1%}')
+    sessions = [generate_video_ids(args.videos_per_session, seed=args.seed + index) for index in range(args.sessions)]
+
+    print(f"{'strategy':>27} {'p50 (ms)':>9} {'p95 (ms)':>9} {'calls/session':>14} {'quota units':>12} {'failed':>7}")
+    for name, strategy in STRATEGIES.items():
+        http = EmulatorHttp(latency=args.latency_ms / 1000, latency_jitter=args.jitter_ms / 1000,
+                            error_rate=args.error_rate, quota_error_rate=args.quota_error_rate,
+                            missing_rate=args.missing_rate, seed=args.seed)
+        youtube = build('youtube', 'v3', developerKey='emulator', http=http)
+        # the emulator can be used by several threads at once
+        http_pool = HttpPool(lambda: http, size=args.concurrency)
+        channels = {}
+        channel_cache = ChannelCache(lambda ids: {cid: channels[cid] for cid in ids if cid in channels}, channels.update)
+
+        latencies = []
+        failed = 0
+        for video_ids in sessions:
+            start = time.perf_counter()
+            try:
+                strategy(youtube, video_ids, channel_cache, http_pool)
+            except HttpError:
+                failed += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        calls = http.calls['videos'] + http.calls['channels']
+        p50, p95 = np.percentile(latencies, [50, 95]) if latencies else (float('nan'), float('nan'))
+        print(f'{name:>27} {p50:>9.1f} {p95:>9.1f} {calls / len(sessions):>14.1f} {http.calls["quota_units"]:>12} '
+              f'{failed:>7}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=50, help='Number of sessions')
+    parser.add_argument('--videos-per-session', type=int, default=20, help='Number of videos per session')
+    parser.add_argument('--latency-ms', type=float, default=80, help='Latency of every API call in milliseconds')
+    parser.add_argument('--jitter-ms', type=float, default=40, help='Maximum random latency added to every API call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of API calls failing with a 503')
+    parser.add_argument('--quota-error-rate', type=float, default=0.0,
+                        help='Fraction of API calls failing with a 403 quotaExceeded')
+    parser.add_argument('--missing-rate', type=float, default=0.05, help='Fraction of videos reported missing')
+    parser.add_argument('--concurrency', type=int, default=4, help='Maximum number of concurrent calls of a batch')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the sessions and emulated errors')
+    run(parser.parse_args())
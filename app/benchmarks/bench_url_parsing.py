@@ -0,0 +1,59 @@
+"""
+bench_url_parsing.py
+
+This benchmark compares the per-row `apply` of the original URL parser, the per-row `apply` of
+parse_yt_url, and the vectorized parse_yt_urls on the titleUrl column of a synthetic watch history.
+
+Run it from the app directory:
+    python -m benchmarks.bench_url_parsing --rows 500000
+"""
+
+import argparse
+import time
+
+import pandas as pd
+
+from utils.file_utils import parse_yt_url, parse_yt_urls
+from benchmarks.synthetic import generate_watch_history
+
+
+def legacy_parse_yt_url(url):
+    """URL parser used by /process before parse_yt_urls, kept as the baseline."""
+    if url.startswith('https://www.youtube.com/watch?v='):
+        return url.split('=')[-1]
+    return None
+
+
+METHODS = {
+    'legacy_apply': lambda urls: urls.apply(lambda x: legacy_parse_yt_url(x) if pd.notnull(x) else None),
+    'scalar_apply': lambda urls: urls.apply(lambda x: parse_yt_url(x) if pd.notnull(x) else None),
+    'vectorized': parse_yt_urls,
+}
+
+
+def run(n_rows, repeat):
+    """
+    Time every parser on the same column and print the best time and the number of extracted IDs.
+
+    Parameters:
+    n_rows (int): Number of rows of the synthetic history.
+    repeat (int): Number of runs per parser.
+    """
+    urls = pd.DataFrame(generate_watch_history(n_rows))['titleUrl']
+    print(f"{'method':>13} {'best (s)':>10} {'rows/s':>12} {'ids':>8}")
+    for name, method in METHODS.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            video_ids = method(urls)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        print(f'{name:>13} {best:>10.3f} {n_rows / best:>12.0f} {video_ids.notna().sum():>8}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
@@ -0,0 +1,247 @@
+"""
+load_test.py
+
+This load test runs complete participant journeys against a running instance of the application:
+/upload, /process with a synthetic watch history, /session_overview, the /regret_video ratings with their
+attention checks, and /review. Many virtual users run journeys concurrently, and the latency percentiles,
+throughput and error rate of every route are printed and written to a JSON file for comparing runs.
+
+It needs the requests package, which requirements.txt includes (`pip install -r requirements.txt`).
+Start the stack with `docker-compose up -d`, then run it from the app directory:
+    python -m benchmarks.load_test --host http://127.0.0.1:5001 --users 50 --journeys 200
+"""
+
+import argparse
+import datetime
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+import requests
+
+from benchmarks.synthetic import generate_watch_history
+
+HISTORY_ID_PATTERN = re.compile(r'name="history_id" value="(\d+)"')
+ERROR_PAGE_MARKER = '<title>Error</title>'
+# Values submitted by the rating buttons of /regret_video
+REGRET_VALUES = ['yes', 'no', 'dont remember', 'skip']
+
+
+class JourneyError(Exception):
+    """A request of a journey failed, so the journey cannot continue."""
+
+
+class Stats:
+    """Thread-safe collector of request latencies and outcomes per route."""
+
+    def __init__(self):
+        self.samples = {}
+        self.journeys = {'completed': 0, 'failed': 0}
+        self._lock = threading.Lock()
+
+    def add(self, route, latency, ok):
+        with self._lock:
+            self.samples.setdefault(route, []).append((latency, ok))
+
+    def end_journey(self, completed):
+        with self._lock:
+            self.journeys['completed' if completed else 'failed'] += 1
+
+    def summary(self, duration):
+        """
+        Summarize the samples of every route.
+
+        Parameters:
+        duration (float): Wall-clock duration of the run in seconds.
+
+        Returns:
+        dict: Request count, error rate, requests per second and latency percentiles in milliseconds per route.
+        """
+        routes = {}
+        for route, samples in sorted(self.samples.items()):
+            latencies = np.array([latency for latency, _ in samples]) * 1000
+            errors = sum(1 for _, ok in samples if not ok)
+            routes[route] = {
+                'requests': len(samples),
+                'errors': errors,
+                'error_rate': errors / len(samples),
+                'rps': len(samples) / duration,
+                'mean_ms': float(latencies.mean()),
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p95_ms': float(np.percentile(latencies, 95)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'max_ms': float(latencies.max()),
+            }
+        return routes
+
+
+class VirtualUser:
+    """A participant going through the study with its own cookie session."""
+
+    def __init__(self, host, stats, timeout):
+        self.host = host.rstrip('/')
+        self.stats = stats
+        self.timeout = timeout
+        self.http = requests.Session()
+
+    def request(self, method, path, route, **kwargs):
+        """
+        Send a request without following redirects, and record its latency under the given route.
+
+        Returns:
+        requests.Response: The response.
+
+        Raises:
+        JourneyError: If the request failed or the application rendered its error page.
+        """
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, self.host + path, allow_redirects=False, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.stats.add(route, time.perf_counter() - start, False)
+            raise JourneyError(f'{route}: {e}')
+        latency = time.perf_counter() - start
+        ok = response.status_code < 400 and ERROR_PAGE_MARKER not in response.text
+        self.stats.add(route, latency, ok)
+        if not ok:
+            raise JourneyError(f'{route}: status {response.status_code}')
+        return response
+
+    def journey(self, history, max_ratings, poll_interval):
+        """
+        Run one participant journey, from the upload to the review of the ratings.
+
+        Parameters:
+        history (bytes): Watch-history JSON to upload.
+        max_ratings (int, optional): Number of ratings after which the participant goes to the review.
+        poll_interval (float): Time in seconds between two polls of an asynchronous upload.
+        """
+        uid = uuid.uuid4().hex[:20]
+        self.request('GET', '/upload', 'GET /upload', params={'uid': uid})
+        response = self.request('POST', f'/process/{uid}', 'POST /process/<uid>',
+                                data={'timezone': '-5.0'},
+                                files={'file': ('watch-history.json', history, 'application/json')})
+        next_path = urlsplit(response.headers.get('Location', '')).path
+        while next_path.startswith('/process_status/'):
+            time.sleep(poll_interval)
+            response = self.request('GET', next_path, 'GET /process_status/<job_id>')
+            if response.status_code != 302:
+                continue
+            next_path = urlsplit(response.headers['Location']).path
+        if next_path != '/session_overview':
+            raise JourneyError(f'POST /process/<uid>: unexpected redirect to {next_path!r}')
+
+        n_ratings = 0
+        while max_ratings is None or n_ratings < max_ratings:
+            if next_path == '/session_overview':
+                self.request('GET', '/session_overview', 'GET /session_overview')
+                next_path = '/regret_video'
+            elif next_path == '/attention_check':
+                self.request('GET', '/attention_check', 'GET /attention_check')
+                response = self.request('POST', '/attention_check', 'POST /attention_check',
+                                        data={'regret': random.choice(['yes', 'no'])})
+                next_path = urlsplit(response.headers['Location']).path
+            elif next_path == '/regret_video':
+                response = self.request('GET', '/regret_video', 'GET /regret_video')
+                if response.status_code == 302:
+                    next_path = urlsplit(response.headers['Location']).path
+                    continue
+                match = HISTORY_ID_PATTERN.search(response.text)
+                if match is None:
+                    raise JourneyError('GET /regret_video: no video to rate')
+                response = self.request('POST', '/regret_video', 'POST /regret_video',
+                                        data={'regret': random.choice(REGRET_VALUES),
+                                              'history_id': match.group(1), 'video_id': ''})
+                n_ratings += 1
+                next_path = urlsplit(response.headers['Location']).path if response.status_code == 302 else '/regret_video'
+            else:
+                break
+        self.request('GET', '/review', 'GET /review')
+
+
+def run(args):
+    """
+    Run the journeys with the given number of concurrent virtual users.
+
+    Parameters:
+    args (argparse.Namespace): Command-line arguments.
+
+    Returns:
+    dict: The configuration and results of the run.
+    """
+    print(f'Generating {args.histories} watch histories of {args.events} events')
+    histories = [
+        json.dumps(generate_watch_history(args.events, ad_fraction=args.ad_fraction, seed=args.seed + index,
+                                          videos_per_session=args.videos_per_session)).encode()
+        for index in range(args.histories)
+    ]
+    stats = Stats()
+
+    def run_journey(index):
+        # spread the start of the first journeys of the virtual users over the ramp-up time
+        if index < args.users:
+            time.sleep(args.ramp_up * index / args.users)
+        user = VirtualUser(args.host, stats, args.timeout)
+        try:
+            user.journey(histories[index % len(histories)], args.max_ratings, args.poll_interval)
+            stats.end_journey(True)
+        except JourneyError as e:
+            print(f'Journey {index} failed: {e}')
+            stats.end_journey(False)
+
+    print(f'Running {args.journeys} journeys with {args.users} virtual users against {args.host}')
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        list(executor.map(run_journey, range(args.journeys)))
+    duration = time.perf_counter() - start
+
+    return {
+        'started_at': started_at.isoformat(),
+        'duration_s': duration,
+        'config': vars(args),
+        'journeys': stats.journeys,
+        'routes': stats.summary(duration),
+    }
+
+
+def print_results(results):
+    """Print the results of a run as a table."""
+    print(f"\n{results['journeys']['completed']} journeys completed, {results['journeys']['failed']} failed "
+          f"in {results['duration_s']:.1f}s")
+    print(f"{'route':>30} {'requests':>9} {'errors':>7} {'rps':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for route, result in results['routes'].items():
+        print(f"{route:>30} {result['requests']:>9} {result['error_rate']:>6.1%} {result['rps']:>8.1f} "
+              f"{result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} {result['p99_ms']:>9.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='http://127.0.0.1:5001', help='Base URL of the application')
+    parser.add_argument('--users', type=int, default=20, help='Number of concurrent virtual users')
+    parser.add_argument('--journeys', type=int, default=None, help='Total number of journeys, defaults to one per user')
+    parser.add_argument('--ramp-up', type=float, default=10, help='Time in seconds over which the virtual users start')
+    parser.add_argument('--max-ratings', type=int, default=None,
+                        help='Number of ratings after which a participant goes to the review, defaults to the study end')
+    parser.add_argument('--events', type=int, default=3000, help='Number of events per watch history')
+    parser.add_argument('--videos-per-session', type=int, default=6, help='Average number of videos per session')
+    parser.add_argument('--ad-fraction', type=float, default=0.02, help='Fraction of ad events')
+    parser.add_argument('--histories', type=int, default=8, help='Number of distinct watch histories to upload')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the watch histories')
+    parser.add_argument('--poll-interval', type=float, default=1, help='Time in seconds between two upload status polls')
+    parser.add_argument('--timeout', type=float, default=60, help='Request timeout in seconds')
+    parser.add_argument('--output', default='load_test_results.json', help='JSON file the results are written to')
+    args = parser.parse_args()
+    args.journeys = args.journeys or args.users
+
+    results = run(args)
+    print_results(results)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f'Results written to {args.output}')
@@ -0,0 +1,112 @@
+"""
+synthetic.py
+
+This module generates synthetic YouTube watch histories for benchmarks and load tests.
+It can produce either Takeout-style JSON records, as participants upload them, or the cleaned
+time/video_id DataFrame that the application works with after parsing.
+"""
+
+import random
+import string
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+VIDEO_ID_ALPHABET = string.ascii_letters + string.digits + '-_'
+
+
+def generate_video_ids(n_videos, seed=0):
+    """
+    Generate random, distinct-looking 11-character YouTube video IDs.
+
+    Parameters:
+    n_videos (int): Number of IDs to generate.
+    seed (int): Random seed.
+
+    Returns:
+    list: List of video IDs.
+    """
+    rng = random.Random(seed)
+    return [''.join(rng.choices(VIDEO_ID_ALPHABET, k=11)) for _ in range(n_videos)]
+
+
+def generate_events(n_events, n_videos=None, videos_per_session=6, session_gap_minutes=120,
+                    end=None, seed=0):
+    """
+    Generate a cleaned watch history with sessions of videos separated by long gaps.
+
+    Video popularity follows a Zipf distribution, so a few videos appear in many events.
+
+    Parameters:
+    n_events (int): Number of watch events.
+    n_videos (int, optional): Number of distinct videos, defaults to half the number of events.
+    videos_per_session (int): Average number of videos per session.
+    session_gap_minutes (int): Average gap between two sessions in minutes.
+    end (datetime, optional): Time of the latest event, defaults to now.
+    seed (int): Random seed.
+
+    Returns:
+    pd.DataFrame: DataFrame with a UTC 'time' column and a 'video_id' column, most recent event first.
+    """
+    rng = np.random.default_rng(seed)
+    n_videos = n_videos or max(1, n_events // 2)
+    video_ids = np.array(generate_video_ids(n_videos, seed=seed))
+    popularity = rng.zipf(1.5, size=n_events) % n_videos
+
+    # gaps of a few minutes within a session, and of hours between sessions
+    new_session = rng.random(n_events) < 1 / videos_per_session
+    gaps = np.where(new_session,
+                    rng.exponential(session_gap_minutes, n_events) + 60,
+                    rng.uniform(1, 10, n_events))
+    end = end or datetime.now(timezone.utc)
+    offsets = pd.to_timedelta(np.cumsum(gaps), unit='min')
+    return pd.DataFrame({
+        'time': pd.Timestamp(end) - offsets,
+        'video_id': video_ids[popularity],
+    })
+
+
+def generate_watch_history(n_events, ad_fraction=0.02, other_fraction=0.02, seed=0, **kwargs):
+    """
+    Generate a Takeout-style watch history, including ads and entries without a video.
+
+    Parameters:
+    n_events (int): Number of watch events.
+    ad_fraction (float): Fraction of events marked as ads.
+    other_fraction (float): Fraction of events without a titleUrl, such as visited posts.
+    seed (int): Random seed.
+    kwargs: Further arguments passed to generate_events.
+
+    Returns:
+    list: List of Takeout records, most recent event first.
+    """
+    rng = random.Random(seed)
+    events = generate_events(n_events, seed=seed, **kwargs)
+    url_formats = [
+        'https://www.youtube.com/watch?v={}',
+        'https://www.youtube.com/watch?v={}&t=42s',
+        'https://m.youtube.com/watch?v={}',
+        'https://music.youtube.com/watch?v={}',
+        'https://youtu.be/{}',
+    ]
+    url_weights = [0.9, 0.03, 0.02, 0.03, 0.02]
+    records = []
+    for ts, video_id in zip(events['time'], events['video_id']):
+        record = {
+            'header': 'YouTube',
+            'title': f'Watched video {video_id}',
+            'time': ts.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            'products': ['YouTube'],
+            'activityControls': ['YouTube watch history'],
+        }
+        draw = rng.random()
+        if draw < other_fraction:
+            record['title'] = 'Visited YouTube Music'
+        else:
+            record['titleUrl'] = rng.choices(url_formats, url_weights)[0].format(video_id)
+            record['subtitles'] = [{'name': 'Some channel', 'url': 'https://www.youtube.com/channel/UC0000000000000000000000'}]
+            if draw < other_fraction + ad_fraction:
+                record['details'] = [{'name': 'From Google Ads'}]
+        records.append(record)
+    return records
@@ -0,0 +1,12 @@
+"""
+gunicorn.conf.py
+
+Settings read by gunicorn when the application is served with it from this directory.
+"""
+
+from utils.metrics_utils import mark_process_dead
+
+
+def child_exit(server, worker):
+    """Remove the gauges of a web worker that exited from the multiprocess metrics."""
+    mark_process_dead(worker.pid)
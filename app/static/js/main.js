@@ -21,7 +21,8 @@ function activateInputs() {
             "ArrowDown": "skipBtn"
         };
         if (keyMap[event.key]) {
-            triggerOption(document.getElementById(keyMap[event.key]), keyMap[event.key].replace("Btn", ""));
+            // submit the same value as a click on the button
+            document.getElementById(keyMap[event.key]).click();
         }
     });
 }
@@ -0,0 +1,10 @@
+"""
+Settings that let the tests import app.py without the services of docker-compose.yml.
+
+Run the tests from the app directory with `python -m pytest tests`.
+"""
+
+import os
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('FLASK_SECRET', 'test')
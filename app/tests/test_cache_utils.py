@@ -0,0 +1,89 @@
+"""Tests of the expiry of the in-process tier of the video cache."""
+
+import pytest
+
+from utils import cache_utils
+from utils.cache_utils import LRUCache, VideoCache
+
+
+class Clock:
+    """Monotonic clock moved forward by the tests."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ExpiringRedis:
+    """In-memory stand-in for the Redis commands used by VideoCache, with expiry on the test clock."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.values = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key] = (value, None if ex is None else self.clock() + ex)
+
+    def mget(self, keys):
+        values = []
+        for key in keys:
+            value, expires_at = self.values.get(key, (None, None))
+            values.append(None if expires_at is not None and expires_at <= self.clock() else value)
+        return values
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def execute(self):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_utils.time, 'monotonic', clock)
+    return clock
+
+
+def test_lru_entries_expire_after_their_ttl(clock):
+    cache = LRUCache(maxsize=10)
+    cache.put_many({'short': 1}, ttl=10)
+    cache.put_many({'forever': 2})
+    clock.now += 11
+    assert cache.get_many(['short', 'forever']) == {'forever': 2}
+    assert len(cache) == 1
+
+
+def test_missing_video_is_fetched_again_after_negative_ttl(clock):
+    fetched = []
+
+    def fetch_videos(video_ids):
+        fetched.append(list(video_ids))
+        if len(fetched) == 1:
+            return {}, video_ids
+        return {video_id: {'video_id': video_id} for video_id in video_ids}, []
+
+    cache = VideoCache(ExpiringRedis(clock), lambda video_ids: {}, ttl=86400, negative_ttl=3600)
+    assert cache.get_many(['v1'], fetch_videos) == {}
+    clock.now += 3599
+    assert cache.get_many(['v1'], fetch_videos) == {}
+    assert fetched == [['v1']]
+
+    clock.now += 2
+    assert cache.get_many(['v1'], fetch_videos) == {'v1': {'video_id': 'v1'}}
+    assert fetched == [['v1'], ['v1']]
+    assert cache.get_many(['v1'], fetch_videos) == {'v1': {'video_id': 'v1'}}
+    assert len(fetched) == 2
+
+
+def test_found_video_expires_from_process_after_ttl(clock):
+    redis = ExpiringRedis(clock)
+    cache = VideoCache(redis, lambda video_ids: {}, ttl=60, negative_ttl=10)
+    cache.put_many({'v1': {'title': 'old'}})
+    redis.set('video:v1', '{"title": "new"}', ex=60)
+    assert cache.get_many(['v1'], None) == {'v1': {'title': 'old'}}
+    clock.now += 61
+    redis.set('video:v1', '{"title": "new"}', ex=60)
+    assert cache.get_many(['v1'], None) == {'v1': {'title': 'new'}}
@@ -0,0 +1,17 @@
+"""Tests of the ID watermarks of the incremental export."""
+
+import datetime
+
+from utils.db_utils import settled_id
+
+
+def test_settled_id_is_largest_id_seen_before_settle_time():
+    observations = [[10, '2026-01-01T00:00:00'], [15, '2026-01-01T00:01:00'], [20, '2026-01-01T00:02:00']]
+    assert settled_id(observations, datetime.datetime(2026, 1, 1, 0, 1, 30)) == 15
+    assert observations == [[15, '2026-01-01T00:01:00'], [20, '2026-01-01T00:02:00']]
+
+
+def test_no_settled_id_before_first_observation_settles():
+    observations = [[10, '2026-01-01T00:00:00']]
+    assert settled_id(observations, datetime.datetime(2025, 12, 31)) is None
+    assert observations == [[10, '2026-01-01T00:00:00']]
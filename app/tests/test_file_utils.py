@@ -0,0 +1,57 @@
+"""Tests of the streaming reader of watch-history files."""
+
+import io
+import json
+
+import pytest
+
+from utils.file_utils import iter_json_array, read_watch_history
+
+
+class CountingStream(io.BytesIO):
+    """Binary stream counting the bytes read from it."""
+
+    n_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.n_read += len(data)
+        return data
+
+
+def watch_event(video_id, **fields):
+    return {'titleUrl': f'https://www.youtube.com/watch?v={video_id}', 'time': '2024-01-01T12:00:00Z', **fields}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64])
+def test_elements_split_between_chunks_are_decoded(chunk_size):
+    elements = [{'a': 'café \\"q\\" ☃', 'n': -12.5e3, 'b': [True, False, None]}, 1234567, 'x' * 50, []]
+    data = json.dumps(elements).encode()
+    assert list(iter_json_array(io.BytesIO(data), chunk_size=chunk_size)) == elements
+
+
+def test_malformed_element_raises_without_reading_rest_of_file():
+    good = json.dumps(watch_event('aaaaaaaaaaa'))
+    data = ('[' + good + ', {"titleUrl": tru, "time": 1}, ' + ', '.join([good] * 10000) + ']').encode()
+    stream = CountingStream(data)
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_array(stream, chunk_size=1024))
+    assert stream.n_read <= 2048
+
+
+def test_element_longer_than_limit_raises():
+    stream = CountingStream(('["' + 'x' * 100000 + '"]').encode())
+    with pytest.raises(ValueError, match='longer than'):
+        list(iter_json_array(stream, chunk_size=1024, max_element_size=4096))
+    assert stream.n_read <= 8192
+
+
+def test_only_records_with_details_are_dropped_as_ads():
+    records = [
+        watch_event('aaaaaaaaaaa'),
+        watch_event('bbbbbbbbbbb', details=None),
+        watch_event('ccccccccccc', details=[{'name': 'From Google Ads'}]),
+        watch_event('ddddddddddd', details=[]),
+    ]
+    df = read_watch_history(io.BytesIO(json.dumps(records).encode()))
+    assert list(df['video_id']) == ['aaaaaaaaaaa', 'bbbbbbbbbbb']
@@ -0,0 +1,36 @@
+"""Tests of the session interface recording the size and Redis round-trip time of sessions."""
+
+import pytest
+from flask import Flask, session
+from prometheus_client import REGISTRY
+
+from utils.metrics_utils import MeteredRedisSessionInterface
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+def sample_count(histogram, operation, endpoint):
+    return REGISTRY.get_sample_value(f'{histogram}_count', {'operation': operation, 'endpoint': endpoint})
+
+
+def test_session_loads_and_saves_are_recorded():
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.session_interface = MeteredRedisSessionInterface(app, client=fakeredis.FakeRedis(), use_signer=True)
+
+    @app.route('/write')
+    def write():
+        session['uid'] = 'u1'
+        return ''
+
+    @app.route('/read')
+    def read():
+        return session.get('uid', '')
+
+    client = app.test_client()
+    client.get('/write')
+    assert client.get('/read').data == b'u1'
+    assert sample_count('regrets_session_payload_bytes', 'save', 'write') == 1
+    assert sample_count('regrets_session_redis_seconds', 'save', 'write') == 1
+    assert sample_count('regrets_session_payload_bytes', 'load', 'read') == 1
+    assert sample_count('regrets_session_redis_seconds', 'load', 'read') == 1
@@ -0,0 +1,46 @@
+"""Tests of the recovery of the jobs of workers that stopped."""
+
+import pytest
+
+from utils.queue_utils import (JOB_QUEUE, dequeue_job, enqueue_job, finish_job, get_job_status, heartbeat,
+                               processing_key, requeue_stale_jobs)
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeRedis()
+
+
+def test_job_of_stopped_worker_is_queued_again(redis):
+    job_id = enqueue_job(redis, 'ingest', {'filename': 'f'})
+    job = dequeue_job(redis, 'a', timeout=1)
+    assert job['id'] == job_id
+    assert redis.llen(JOB_QUEUE) == 0
+    assert redis.llen(processing_key('a')) == 1
+
+    # worker a stopped without refreshing its liveness marker
+    assert [stale['id'] for stale in requeue_stale_jobs(redis, 'b')] == [job_id]
+    assert get_job_status(redis, job['status_key'])['state'] == 'queued'
+    assert redis.llen(processing_key('a')) == 0
+
+    job = dequeue_job(redis, 'b', timeout=1)
+    assert job['id'] == job_id
+    finish_job(redis, 'b', job)
+    assert redis.llen(processing_key('b')) == 0
+
+
+def test_job_of_running_worker_is_kept(redis):
+    enqueue_job(redis, 'ingest', {'filename': 'f'})
+    heartbeat(redis, 'a')
+    dequeue_job(redis, 'a', timeout=1)
+    assert requeue_stale_jobs(redis, 'b') == []
+    assert redis.llen(processing_key('a')) == 1
+
+
+def test_restarted_worker_requeues_its_own_jobs(redis):
+    job_id = enqueue_job(redis, 'ingest', {'filename': 'f'})
+    heartbeat(redis, 'a')
+    dequeue_job(redis, 'a', timeout=1)
+    assert [stale['id'] for stale in requeue_stale_jobs(redis, 'a')] == [job_id]
@@ -0,0 +1,31 @@
+"""Tests of the regret values submitted by the rating buttons and their keyboard shortcuts."""
+
+import pytest
+import sqlalchemy as sa
+
+from app import normalize_regret, regret_counts
+
+
+@pytest.mark.parametrize('submitted, stored', [
+    ('regret', 'yes'),
+    ('noRegret', 'no'),
+    ('noRemember', 'dont remember'),
+    ('yes', 'yes'),
+    ('no', 'no'),
+    ('dont remember', 'dont remember'),
+    ('skip', 'skip'),
+])
+def test_keyboard_values_are_stored_as_button_values(submitted, stored):
+    assert normalize_regret(submitted) == stored
+
+
+def test_regret_counts_include_keyboard_values():
+    engine = sa.create_engine('sqlite://')
+    metadata = sa.MetaData()
+    ratings = sa.Table('ratings', metadata, sa.Column('regret', sa.String(20)))
+    metadata.create_all(engine)
+    values = ['yes', 'regret', 'no', 'noRegret', 'noRegret', 'dont remember', 'noRemember', 'skip']
+    with engine.begin() as connection:
+        connection.execute(ratings.insert(), [{'regret': value} for value in values])
+        counts = connection.execute(sa.select(*regret_counts(ratings.c.regret))).one()._asdict()
+    assert counts == {'n_ratings': 8, 'n_yes': 2, 'n_no': 3, 'n_dont_remember': 2, 'n_skip': 1}
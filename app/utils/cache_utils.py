@@ -0,0 +1,247 @@
+"""
+cache_utils.py
+
+This module provides caches for metadata fetched from the YouTube Data API.
+It includes a thread-safe LRU cache, a channel cache that checks the LRU cache, then a persistent
+store such as the database, and only then fetches the remaining channels in a single batch, and a
+video cache that adds a Redis tier shared by all processes and remembers videos that YouTube reported missing.
+"""
+
+import datetime
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Value cached for videos that YouTube reported missing
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache that evicts the least recently used entries beyond a maximum size.
+
+    Entries inserted with a time to live expire after it and are then treated as misses.
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        Parameters:
+        maxsize (int): Maximum number of entries kept in the cache.
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self, keys):
+        """
+        Look up several keys, marking the found entries as recently used and removing the expired ones.
+
+        Parameters:
+        keys (list): Keys to look up.
+
+        Returns:
+        dict: A dictionary mapping the found, unexpired keys to their values.
+        """
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    value, expires_at = self._entries[key]
+                    if expires_at is not None and expires_at <= now:
+                        del self._entries[key]
+                        continue
+                    self._entries.move_to_end(key)
+                    found[key] = value
+        return found
+
+    def put_many(self, items, ttl=None):
+        """
+        Insert or replace several entries, evicting the least recently used entries if needed.
+
+        Parameters:
+        items (dict): A dictionary mapping keys to values.
+        ttl (float, optional): Time in seconds after which the entries expire, never if None.
+
+        Returns:
+        int: Number of evicted entries.
+        """
+        evicted = 0
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            for key, value in items.items():
+                self._entries[key] = (value, expires_at)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                evicted += 1
+        return evicted
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+
+class ChannelCache:
+    """Two-level channel metadata cache in front of the channels.list API call."""
+
+    def __init__(self, load_channels, store_channels, maxsize=4096):
+        """
+        Parameters:
+        load_channels (callable): Takes a list of channel IDs and returns a dictionary of the stored channels.
+        store_channels (callable): Takes a dictionary of fetched channels and persists it.
+        maxsize (int): Maximum number of channels kept in process.
+        """
+        self.load_channels = load_channels
+        self.store_channels = store_channels
+        self.lru = LRUCache(maxsize)
+
+    def get_many(self, channel_ids, fetch_channels):
+        """
+        Resolve channels from the in-process cache, then from the persistent store, then with one batched fetch.
+
+        Parameters:
+        channel_ids (list): Channel IDs, duplicates are ignored.
+        fetch_channels (callable): Takes a list of channel IDs and returns a dictionary of the found channels.
+
+        Returns:
+        dict: A dictionary mapping each resolved channel ID to its channel information.
+        """
+        channel_ids = list(dict.fromkeys(cid for cid in channel_ids if cid))
+        channels = self.lru.get_many(channel_ids)
+
+        missing_ids = [cid for cid in channel_ids if cid not in channels]
+        if missing_ids:
+            stored = self.load_channels(missing_ids)
+            self.lru.put_many(stored)
+            channels.update(stored)
+
+        missing_ids = [cid for cid in missing_ids if cid not in channels]
+        if missing_ids:
+            fetched = fetch_channels(missing_ids)
+            if fetched:
+                self.store_channels(fetched)
+                self.lru.put_many(fetched)
+                channels.update(fetched)
+        return channels
+
+
+def _encode_default(obj):
+    """Encode the datetimes of raw video information for the Redis tier."""
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class VideoCache:
+    """
+    Video metadata cache in front of the database and the videos.list API call.
+
+    Videos are looked up in a per-process LRU cache, then in Redis, then in the database, and the remaining
+    videos are fetched in a single batch. Entries hold the raw video information, so that display fields
+    depending on the current time can be computed on render. Videos that YouTube reports missing are cached
+    as such for a shorter time, so that they are not requested again by every process.
+    """
+
+    def __init__(self, redis, load_videos, maxsize=4096, ttl=86400, negative_ttl=3600, key_prefix='video',
+                 record_event=None):
+        """
+        Parameters:
+        redis (redis.Redis): Redis client of the shared tier.
+        load_videos (callable): Takes a list of video IDs and returns a dictionary of the stored videos.
+        maxsize (int): Maximum number of videos kept in process.
+        ttl (int): Time in seconds for which videos are kept in process and in Redis.
+        negative_ttl (int): Time in seconds for which missing videos are remembered in process and in Redis.
+        key_prefix (str): Key prefix of the Redis entries.
+        record_event (callable, optional): Takes a tier, an event such as 'hit', 'miss' or 'eviction' and a count.
+        """
+        self.redis = redis
+        self.load_videos = load_videos
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.key_prefix = key_prefix
+        self.record_event = record_event
+        self.lru = LRUCache(maxsize)
+
+    def _key(self, video_id):
+        return f'{self.key_prefix}:{video_id}'
+
+    def _record(self, tier, event, count):
+        if self.record_event is not None and count:
+            self.record_event(tier, event, count)
+
+    def _put_local(self, entries):
+        found = {video_id: video_info for video_id, video_info in entries.items() if video_info is not MISSING}
+        missing = {video_id: MISSING for video_id, video_info in entries.items() if video_info is MISSING}
+        evicted = self.lru.put_many(found, ttl=self.ttl) if found else 0
+        evicted += self.lru.put_many(missing, ttl=self.negative_ttl) if missing else 0
+        self._record('lru', 'eviction', evicted)
+
+    def put_many(self, videos, missing_ids=()):
+        """
+        Cache videos in both tiers.
+
+        Parameters:
+        videos (dict): A dictionary mapping video IDs to their raw video information.
+        missing_ids (list): IDs of videos that YouTube reported missing.
+        """
+        entries = dict(videos)
+        entries.update((video_id, MISSING) for video_id in missing_ids)
+        if not entries:
+            return
+        self._put_local(entries)
+        pipe = self.redis.pipeline(transaction=False)
+        for video_id, video_info in entries.items():
+            if video_info is MISSING:
+                pipe.set(self._key(video_id), b'', ex=self.negative_ttl)
+            else:
+                pipe.set(self._key(video_id), json.dumps(video_info, default=_encode_default), ex=self.ttl)
+        pipe.execute()
+
+    def get_many(self, video_ids, fetch_videos):
+        """
+        Resolve videos from the in-process cache, then from Redis, then from the database, then with one batched fetch.
+
+        Parameters:
+        video_ids (list): Video IDs, duplicates are ignored.
+        fetch_videos (callable): Takes a list of video IDs and returns a dictionary of the found videos
+                                 and a list of the IDs reported missing.
+
+        Returns:
+        dict: A dictionary mapping each found video ID to its raw video information.
+        """
+        video_ids = list(dict.fromkeys(video_ids))
+        entries = self.lru.get_many(video_ids)
+        self._record('lru', 'hit', len(entries))
+        self._record('lru', 'miss', len(video_ids) - len(entries))
+
+        missing_ids = [video_id for video_id in video_ids if video_id not in entries]
+        if missing_ids:
+            shared = {}
+            for video_id, value in zip(missing_ids, self.redis.mget([self._key(video_id) for video_id in missing_ids])):
+                if value is not None:
+                    shared[video_id] = json.loads(value) if value else MISSING
+            self._record('redis', 'hit', len(shared))
+            self._record('redis', 'miss', len(missing_ids) - len(shared))
+            self._put_local(shared)
+            entries.update(shared)
+            missing_ids = [video_id for video_id in missing_ids if video_id not in shared]
+
+        if missing_ids:
+            stored = self.load_videos(missing_ids)
+            self._record('database', 'hit', len(stored))
+            self._record('database', 'miss', len(missing_ids) - len(stored))
+            self.put_many(stored)
+            entries.update(stored)
+            missing_ids = [video_id for video_id in missing_ids if video_id not in stored]
+
+        if missing_ids:
+            fetched, not_found_ids = fetch_videos(missing_ids)
+            self.put_many(fetched, not_found_ids)
+            entries.update(fetched)
+        return {video_id: video_info for video_id, video_info in entries.items() if video_info is not MISSING}
@@ -2,16 +2,26 @@
 db_utils.py
 
 This module provides utility functions for database operations, including creating SSH tunnels,
-connecting to the database, executing queries, and building specific queries for video events and user data.
+connecting to the database, executing queries, bulk-inserting rows, and building specific queries for video events and user data.
+It also exports the study tables to Parquet incrementally, streaming the rows with server-side cursors.
 """
 
+import argparse
+import csv
+import datetime
+import io
+import json
 import os
 import re
+import socket
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote_plus
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import sqlalchemy as s
 from dotenv import load_dotenv
 from sqlalchemy.exc import OperationalError
@@ -27,25 +37,79 @@ DB_USER = os.getenv("PG_USER")
 EC2_ADDRESS = os.getenv("EC2_ADDRESS")
 SSH_KEY_LOCATION = os.getenv("SSH_KEY_LOCATION")
 
+# Tables of the study export: the alias and FROM clause of their rows, the expression whose growth marks
+# new or updated rows, and whether that expression is a timestamp. History rows are written in the same
+# transaction as their file, so they are synced with it. Selected rows, ratings and attention checks are
+# synced by their serial ID, because ratings written behind are committed long after their created_at time.
+# Rows whose timestamp was NULL before it was recorded are exported by the first sync.
+EXPORT_TABLES = {
+    'files': ('f', 'files f', 'COALESCE(f.updated_at, f.created_at)', True),
+    'history_info': ('h', 'history_info h JOIN files f ON f.filename = h.filename', 'f.created_at', True),
+    'selected': ('sel', 'selected sel', 'sel.id', False),
+    'regrets': ('r', 'regrets r', 'r.id', False),
+    'attention': ('a', 'attention a', 'a.id', False),
+    'video': ('v', 'video v', "COALESCE(v.fetched_at, TIMESTAMP '1970-01-01')", True),
+    'channel': ('c', 'channel c', 'c.fetched_at', True),
+}
+# Rows stamped, or IDs first seen, less than this many seconds before a sync are left for a later one,
+# so that rows of transactions still running when the sync starts are not skipped
+EXPORT_SETTLE_SECONDS = 60
+EXPORT_CHUNK_SIZE = 50000
+WATERMARKS_FILE = '_watermarks.json'
+# Key of the watermarks file holding the largest ID of each table seen by the recent syncs, with the time
+OBSERVED_IDS = '_observed_ids'
 
-def create_ssh_tunnel(ssh_key=SSH_KEY_LOCATION, local_port=1111, remote_port=54321, ec2_address=EC2_ADDRESS):
+
+def wait_for_port(host, port, timeout=10, interval=0.05, process=None):
     """
-    Create an SSH tunnel to securely connect to a remote server.
+    Wait until a TCP port accepts connections.
+
+    Parameters:
+    host (str): Host address.
+    port (int): Port number.
+    timeout (float): Maximum time to wait in seconds.
+    interval (float): Time between two connection attempts in seconds.
+    process (subprocess.Popen, optional): Process expected to open the port; waiting stops if it exits.
+
+    Raises:
+    TimeoutError: If the port did not accept connections in time, or the process exited.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=interval):
+                return
+        except OSError:
+            pass
+        if process is not None and process.poll() is not None:
+            raise TimeoutError(f'Process exited with code {process.returncode} before opening port {port}')
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f'Port {port} of {host} did not open within {timeout}s')
+        time.sleep(interval)
+
+
+def create_ssh_tunnel(ssh_key=SSH_KEY_LOCATION, local_port=1111, remote_port=54321, ec2_address=EC2_ADDRESS, timeout=10):
+    """
+    Create an SSH tunnel to securely connect to a remote server, and wait until it accepts connections.
 
     Parameters:
     ssh_key (str): Path to the SSH key.
     local_port (int): Local port for the SSH tunnel.
     remote_port (int): Remote port for the SSH tunnel.
     ec2_address (str): EC2 instance address.
+    timeout (float): Maximum time in seconds to wait for the tunnel.
 
     Returns:
     subprocess.Popen: A Popen object representing the SSH tunnel process.
     """
+    tunnel_process = None
     try:
         print("Creating SSH tunnel...")
         cmd = [
             'ssh',
             '-i', ssh_key,
+            # exit instead of running without the tunnel if the local port cannot be bound
+            '-o', 'ExitOnForwardFailure=yes',
             '-NL', f"{local_port}:localhost:{remote_port}",
             ec2_address
         ]
@@ -53,12 +117,14 @@ def create_ssh_tunnel(ssh_key=SSH_KEY_LOCATION, local_port=1111, remote_port=543
 
         # Launch a new process for SSH tunneling. The SSH tunnel will remain open as long as the Python process is running.
         tunnel_process = subprocess.Popen(cmd)
-        time.sleep(2)
+        wait_for_port('localhost', local_port, timeout=timeout, process=tunnel_process)
 
         return tunnel_process
 
     except Exception as e:
         print(f"Error creating SSH tunnel: {e}")
+        if tunnel_process is not None:
+            tunnel_process.kill()
         return None
 
 
@@ -117,6 +183,360 @@ def execute_query(query, engine=None):
     return result
 
 
+def stream_query(query, engine, chunksize=EXPORT_CHUNK_SIZE, params=None):
+    """
+    Execute a SQL query with a server-side cursor and yield the result in chunks, so that memory use
+    does not grow with the size of the result.
+
+    Parameters:
+    query (str): SQL query to be executed.
+    engine (sqlalchemy.engine.Engine): SQLAlchemy engine for database connection.
+    chunksize (int): Number of rows per chunk.
+    params (dict, optional): Query parameters.
+
+    Yields:
+    pd.DataFrame: Consecutive chunks of the result.
+    """
+    with engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True, max_row_buffer=chunksize)
+        yield from pd.read_sql(s.text(query), connection, params=params, chunksize=chunksize)
+
+
+def arrow_schema(table):
+    """
+    Build the Parquet schema of a table from its column types, so that every chunk is written with the same
+    schema even if one of its columns is empty.
+
+    Parameters:
+    table (sqlalchemy.Table): Reflected table.
+
+    Returns:
+    pyarrow.Schema: The schema.
+    """
+    types = {int: pa.int64(), float: pa.float64(), bool: pa.bool_(), datetime.datetime: pa.timestamp('us')}
+    fields = []
+    for column in table.columns:
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = str
+        fields.append(pa.field(column.name, types.get(python_type, pa.string())))
+    return pa.schema(fields)
+
+
+def load_watermarks(output_dir):
+    """
+    Load the watermarks of the previous syncs.
+
+    Parameters:
+    output_dir (str): Export directory.
+
+    Returns:
+    dict: Maps each synced table to the largest watermark value exported so far.
+    """
+    path = os.path.join(output_dir, WATERMARKS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as watermarks_file:
+        watermarks = json.load(watermarks_file)
+    return {table: datetime.datetime.fromisoformat(value) if isinstance(value, str) else value
+            for table, value in watermarks.items()}
+
+
+def save_watermarks(output_dir, watermarks):
+    """
+    Save the watermarks atomically, so that an interrupted sync leaves the previous ones.
+
+    Parameters:
+    output_dir (str): Export directory.
+    watermarks (dict): Maps each synced table to the largest watermark value exported so far.
+    """
+    path = os.path.join(output_dir, WATERMARKS_FILE)
+    with open(f'{path}.tmp', 'w') as watermarks_file:
+        json.dump({table: value.isoformat() if isinstance(value, datetime.datetime) else value
+                   for table, value in watermarks.items()}, watermarks_file, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def settled_id(observations, settled_before):
+    """
+    Find the largest ID seen before a time, and drop the observations it makes obsolete.
+
+    IDs are allocated when rows are inserted but become visible when their transaction commits, so an ID
+    may appear after larger ones. Once the largest ID seen at a time has settled, every smaller ID is visible.
+
+    Parameters:
+    observations (list): Pairs of largest ID and ISO time of the recent syncs, oldest first, updated in place.
+    settled_before (datetime.datetime): Time before which the observations have settled.
+
+    Returns:
+    int: The largest settled ID, or None if no observation has settled yet.
+    """
+    settled = [i for i, (_, seen_at) in enumerate(observations)
+               if datetime.datetime.fromisoformat(seen_at) <= settled_before]
+    if not settled:
+        return None
+    del observations[:settled[-1]]
+    return observations[0][0]
+
+
+def export_table(connection, table_name, output_dir, synced_at, low=None, high=None, chunksize=EXPORT_CHUNK_SIZE):
+    """
+    Write the rows of a table whose watermark lies in (low, high] to one Parquet file of the table's directory,
+    fetching them in chunks from a server-side cursor and writing one row group per chunk.
+
+    Parameters:
+    connection (sqlalchemy.engine.Connection): Database connection.
+    table_name (str): Name of a table of EXPORT_TABLES.
+    output_dir (str): Export directory; the file is written to <table>/synced_at=<synced_at>/part-0.parquet.
+    synced_at (str): Label of the sync, used as partition value.
+    low (optional): Watermark of the previous sync, or None to export all rows up to high.
+    high (optional): Largest watermark to export, or None for no limit.
+    chunksize (int): Number of rows fetched per round-trip.
+
+    Returns:
+    tuple: The number of rows written, and the largest exported watermark, or low if no row was written.
+    """
+    alias, from_clause, watermark, timestamped = EXPORT_TABLES[table_name]
+    conditions, params = [], {}
+    if low is not None:
+        conditions.append(f'{watermark} > :low')
+        params['low'] = low
+    if high is not None:
+        conditions.append(f'{watermark} <= :high')
+        params['high'] = high
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    query = f'SELECT {alias}.*, {watermark} AS export_watermark FROM {from_clause} {where} ORDER BY export_watermark'
+
+    table = s.Table(table_name, s.MetaData(), autoload_with=connection)
+    schema = arrow_schema(table)
+    # typed columns, so that the values are converted to Python types whatever the driver returns
+    statement = s.text(query).columns(
+        *table.columns, s.column('export_watermark', s.DateTime if timestamped else s.Integer))
+    partition_dir = os.path.join(output_dir, table_name, f'synced_at={synced_at}')
+    path = os.path.join(partition_dir, 'part-0.parquet')
+    writer = None
+    n_rows, last_watermark = 0, low
+    result = connection.execution_options(stream_results=True, max_row_buffer=chunksize).execute(statement, params)
+    try:
+        for rows in result.partitions(chunksize):
+            if writer is None:
+                os.makedirs(partition_dir, exist_ok=True)
+                writer = pq.ParquetWriter(f'{path}.tmp', schema)
+            columns = list(zip(*rows))
+            # the last column holds the watermark, which is not part of the schema
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+            n_rows += len(rows)
+            last_watermark = columns[-1][-1]
+    finally:
+        result.close()
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(f'{path}.tmp', path)
+    return n_rows, last_watermark
+
+
+def sync_export(engine, output_dir, tables=None, chunksize=EXPORT_CHUNK_SIZE, settle_seconds=EXPORT_SETTLE_SECONDS):
+    """
+    Export the rows added or updated since the previous sync of each table to partitioned Parquet files.
+
+    Each sync writes a new synced_at=<time> partition per table and advances the table's watermark once its file
+    is complete, so an interrupted sync is simply repeated by the next one. Rows updated after their export,
+    such as completed files, are exported again: keep the row of the latest partition for each primary key.
+    Tables synced by ID are exported up to the largest ID seen by a sync at least settle_seconds earlier.
+
+    Parameters:
+    engine (sqlalchemy.engine.Engine): SQLAlchemy engine for database connection.
+    output_dir (str): Export directory.
+    tables (list, optional): Names of the tables to sync, defaults to all tables of EXPORT_TABLES.
+    chunksize (int): Number of rows fetched per round-trip.
+    settle_seconds (int): Rows stamped, or IDs first seen, less than this many seconds ago are left for a later sync.
+
+    Returns:
+    dict: The number of rows exported per table.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    watermarks = load_watermarks(output_dir)
+    synced_at = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    exported = {}
+    with engine.connect() as connection:
+        now = connection.execute(s.text('SELECT LOCALTIMESTAMP')).scalar()
+        settled_before = now - datetime.timedelta(seconds=settle_seconds)
+        for table_name in tables or EXPORT_TABLES:
+            _, from_clause, expression, timestamped = EXPORT_TABLES[table_name]
+            low = watermarks.get(table_name)
+            if timestamped:
+                high = settled_before
+            else:
+                observations = watermarks.setdefault(OBSERVED_IDS, {}).setdefault(table_name, [])
+                high = settled_id(observations, settled_before)
+                max_id = connection.execute(s.text(f'SELECT MAX({expression}) FROM {from_clause}')).scalar()
+                observations.append([max_id or 0, now.isoformat()])
+                # tables synced by time before, whose rows are exported again
+                if not isinstance(low, int):
+                    low = None
+            n_rows = 0
+            if timestamped or high is not None:
+                n_rows, watermark = export_table(connection, table_name, output_dir, synced_at,
+                                                 low=low, high=high, chunksize=chunksize)
+                if n_rows:
+                    watermarks[table_name] = watermark
+            connection.rollback()
+            save_watermarks(output_dir, watermarks)
+            exported[table_name] = n_rows
+            print(f'{table_name}: {n_rows} rows exported')
+    return exported
+
+
+class DatabaseConnection:
+    """
+    Connection to the study database for analysis sessions, used as a context manager.
+
+    The SSH tunnel is opened once and the engine keeps a pool of connections, so that many queries
+    only pay for the tunnel and the connections once, and independent queries can run concurrently.
+
+    Example:
+        with DatabaseConnection() as database:
+            files, regrets = database.query_many(['SELECT * FROM files', 'SELECT * FROM regrets'])
+    """
+
+    def __init__(self, password=DB_PASS, host='localhost', port=1111, user=DB_USER, db_name=DB_NAME,
+                 ssh_key=SSH_KEY_LOCATION, ec2_address=EC2_ADDRESS, remote_port=54321, tunnel=True, pool_size=5):
+        """
+        Parameters:
+        password (str): Database password.
+        host (str): Host address.
+        port (int): Port number, the local port of the SSH tunnel.
+        user (str): Database user.
+        db_name (str): Database name.
+        ssh_key (str): Path to the SSH key.
+        ec2_address (str): EC2 instance address.
+        remote_port (int): Remote port for the SSH tunnel.
+        tunnel (bool): Whether to open an SSH tunnel, or to connect to host and port directly.
+        pool_size (int): Number of pooled connections, which bounds the number of concurrent queries.
+        """
+        self.connection_str = f'postgresql://{user}:{quote_plus(password)}@{host}:{port}/{db_name}'
+        self.port = port
+        self.ssh_key = ssh_key
+        self.ec2_address = ec2_address
+        self.remote_port = remote_port
+        self.tunnel = tunnel
+        self.pool_size = pool_size
+        self.engine = None
+        self.tunnel_process = None
+
+    def __enter__(self):
+        if self.tunnel:
+            self.tunnel_process = create_ssh_tunnel(self.ssh_key, self.port, self.remote_port, self.ec2_address)
+            if self.tunnel_process is None:
+                raise ConnectionError('Could not open the SSH tunnel')
+        # pre-ping replaces the connections that the tunnel dropped while they were idle
+        self.engine = s.create_engine(self.connection_str, pool_size=self.pool_size, max_overflow=0, pool_pre_ping=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.engine.dispose()
+        if self.tunnel_process is not None:
+            self.tunnel_process.kill()
+            self.tunnel_process.wait()
+
+    def query(self, query, params=None):
+        """
+        Execute a SQL query and return the result as a DataFrame.
+
+        Parameters:
+        query (str): SQL query to be executed.
+        params (dict, optional): Query parameters.
+
+        Returns:
+        pd.DataFrame: Query result as a DataFrame.
+        """
+        with self.engine.connect() as connection:
+            return pd.read_sql(s.text(query), connection, params=params)
+
+    def query_many(self, queries):
+        """
+        Execute independent SQL queries concurrently over the pooled connections.
+
+        Parameters:
+        queries (list): SQL queries to be executed.
+
+        Returns:
+        list: Query results as DataFrames, in the order of the queries.
+        """
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            return list(executor.map(self.query, queries))
+
+    def stream(self, query, chunksize=EXPORT_CHUNK_SIZE, params=None):
+        """Yield the result of a SQL query in chunks, as stream_query does."""
+        return stream_query(query, self.engine, chunksize=chunksize, params=params)
+
+    def export(self, output_dir, **kwargs):
+        """Sync the Parquet export of the study tables, as sync_export does."""
+        return sync_export(self.engine, output_dir, **kwargs)
+
+
+def copy_rows(connection, table, rows):
+    """
+    Insert rows into a PostgreSQL table in a single COPY ... FROM STDIN round-trip.
+
+    Parameters:
+    connection (sqlalchemy.engine.Connection): Connection whose transaction the rows are written in.
+    table (sqlalchemy.Table): Table to insert into.
+    rows (list): List of dictionaries with the same keys, mapping column names to values.
+    """
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['\\N' if row[column] is None else row[column] for column in columns])
+    statement = f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    cursor = connection.connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            # psycopg2
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+        else:
+            # psycopg 3
+            with cursor.copy(statement) as copy:
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+
+def bulk_insert(connection, table, rows, return_ids=False):
+    """
+    Insert many rows into a table in one round-trip.
+
+    PostgreSQL connections use COPY unless the generated IDs are requested; other
+    connections, and requests for IDs, use an executemany of insert().values.
+
+    Parameters:
+    connection (sqlalchemy.engine.Connection): Connection whose transaction the rows are written in.
+    table (sqlalchemy.Table): Table to insert into.
+    rows (list): List of dictionaries with the same keys, mapping column names to values.
+    return_ids (bool): Whether to return the generated primary keys.
+
+    Returns:
+    list: The generated primary keys in the order of the rows if return_ids is set, otherwise None.
+    """
+    if not rows:
+        return [] if return_ids else None
+    if connection.dialect.name == 'postgresql' and not return_ids:
+        copy_rows(connection, table, rows)
+        return None
+    statement = s.insert(table)
+    if return_ids:
+        primary_key = list(table.primary_key.columns)[0]
+        result = connection.execute(statement.returning(primary_key, sort_by_parameter_order=True), rows)
+        return [row[0] for row in result]
+    connection.execute(statement, rows)
+    return None
+
+
 def close_ssh_tunnel(tunnel_process):
     """
     Close the SSH tunnel.
@@ -126,6 +546,7 @@ def close_ssh_tunnel(tunnel_process):
     """
     print("Closing SSH tunnel...")
     tunnel_process.kill()
+    tunnel_process.wait()
 
 
 def close_db_connection(engine):
@@ -147,17 +568,21 @@ def close(engine, tunnel_process):
     tunnel_process (subprocess.Popen): SSH tunnel process to be closed.
     """
     close_db_connection(engine)
-    time.sleep(1)
     close_ssh_tunnel(tunnel_process)
-    time.sleep(1)
 
 if __name__ == "__main__":
-    # Example usage
-    engine, tunnel_process = connect_to_db()
-    # Query to list all the tables in the database
-    query = "SELECT table_name FROM information_schema.tables WHERE table_schema='public' AND table_type='BASE TABLE';"
-    result = execute_query(query, engine)
-    print(query)
-    print(result)
-    close(engine, tunnel_process)
+    parser = argparse.ArgumentParser(description='List the tables of the study database, or sync its Parquet export.')
+    parser.add_argument('--export', metavar='DIR', help='Export the new and updated rows of the study tables to DIR')
+    parser.add_argument('--tables', nargs='+', choices=list(EXPORT_TABLES), help='Tables to export')
+    parser.add_argument('--chunksize', type=int, default=EXPORT_CHUNK_SIZE, help='Rows fetched per round-trip')
+    args = parser.parse_args()
+
+    with DatabaseConnection() as database:
+        if args.export:
+            database.export(args.export, tables=args.tables, chunksize=args.chunksize)
+        else:
+            # Query to list all the tables in the database
+            query = "SELECT table_name FROM information_schema.tables WHERE table_schema='public' AND table_type='BASE TABLE';"
+            print(query)
+            print(database.query(query))
     
\ No newline at end of file
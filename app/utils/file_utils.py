@@ -2,12 +2,340 @@
 file_utils.py
 
 This module provides utility functions for processing and extracting sessions from video event data.
-It includes functions for creating sessions based on time intervals, extracting specific sessions based on
-various criteria, and parsing YouTube URLs to extract video IDs.
+It includes an array-backed session container and functions for creating sessions based on time intervals, extracting specific sessions based on
+various criteria, parsing YouTube URLs to extract video IDs, hashing and reading uploaded watch-history files, and storing
+the sessions of processed uploads as Parquet files that are compacted into a partitioned dataset once they are old.
 """
 
+import codecs
+import datetime
+import hashlib
+import json
+import os
 import random
+import re
+from array import array
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+# Length of a YouTube video ID
+VIDEO_ID_LENGTH = 11
+_JSON_DECODER = json.JSONDecoder()
+# Decoding errors this close to the end of the buffer may come from a number, literal or escape cut off by it
+_JSON_TRUNCATION_MARGIN = 16
+# Maximum number of characters of a single element of a JSON array, far above the size of a watch-history record
+MAX_JSON_ELEMENT_SIZE = 1 << 20
+
+VIDEO_ID_PATTERN = r'^[A-Za-z0-9_-]{11}$'
+YT_WATCH_PREFIX = 'https://www.youtube.com/watch?v='
+# Watch URLs on www., m. and music.youtube.com with the v parameter anywhere in the query,
+# youtu.be short links, and shorts/embed/live paths. The pattern avoids look-arounds so that
+# pyarrow can evaluate it natively in parse_yt_urls.
+YT_URL_PATTERN = (
+    r'^https?://(?:(?:www|m|music)\.)?'
+    r'(?:youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/)|youtu\.be/)'
+    r'(?P<video_id>[A-Za-z0-9_-]{11})(?:[^A-Za-z0-9_-]|$)'
+)
+YT_URL_REGEX = re.compile(YT_URL_PATTERN)
+# Schema metadata key storing the time zone of the session times
+SESSIONS_TZ_KEY = b'sessions_tz'
+# Number of rows per row group of the compacted dataset; the filename statistics of the row groups
+# let a read of one upload skip the others
+COMPACT_ROW_GROUP_SIZE = 65536
+
+
+class HashingFile:
+    """
+    File that computes the SHA-256 hash of the bytes written to it, and otherwise behaves as the file it wraps.
+
+    Uploads are spooled to such a file, so that they are hashed while they are received rather than read again.
+    """
+
+    def __init__(self, file):
+        """
+        Parameters:
+        file (file-like): Writable and readable binary file.
+        """
+        self.file = file
+        self.hasher = hashlib.sha256()
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    @property
+    def content_hash(self):
+        """str: Hexadecimal SHA-256 hash of the bytes written so far."""
+        return self.hasher.hexdigest()
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class Sessions:
+    """
+    Watch events split into sessions, stored as flat arrays without per-event Python objects.
+
+    The events are sorted by time in `times` (int64 nanoseconds since the epoch) and `video_ids`
+    (fixed-width strings), and session i spans the events offsets[i]:offsets[i + 1].
+    Indexing or iterating materializes one session at a time as a list of (time, video_id) tuples.
+    """
+
+    def __init__(self, times, video_ids, offsets, tz='UTC'):
+        """
+        Parameters:
+        times (np.ndarray): Sorted event times as int64 nanoseconds since the epoch.
+        video_ids (np.ndarray): Video IDs of the events, in the same order.
+        offsets (np.ndarray): Start offset of every session followed by the number of events.
+        tz (str, optional): Time zone of the materialized timestamps, None for naive timestamps.
+        """
+        self.times = times
+        self.video_ids = video_ids
+        self.offsets = offsets
+        self.tz = tz
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('session index out of range')
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return list(zip(self.timestamps(start, end), self.video_ids[start:end].tolist()))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def lengths(self):
+        """np.ndarray: Number of events of every session."""
+        return np.diff(self.offsets)
+
+    @property
+    def first_times(self):
+        """np.ndarray: Time of the first event of every session, in nanoseconds."""
+        return self.times[self.offsets[:-1]]
+
+    @property
+    def last_times(self):
+        """np.ndarray: Time of the last event of every session, in nanoseconds."""
+        return self.times[self.offsets[1:] - 1]
+
+    def timestamps(self, start=0, end=None):
+        """
+        Convert a range of event times to timestamps.
+
+        Parameters:
+        start (int): Offset of the first event.
+        end (int, optional): Offset after the last event, defaults to the number of events.
+
+        Returns:
+        pd.DatetimeIndex: Timestamps of the events.
+        """
+        return pd.DatetimeIndex(pd.to_datetime(self.times[start:end], utc=self.tz is not None))
+
+    def session_numbers(self):
+        """
+        Number of the session of every event.
+
+        Returns:
+        np.ndarray: Session number of every event.
+        """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def n_videos(self, max_per_session=None):
+        """
+        Count the videos that can be shown, taking at most `max_per_session` from each session.
+
+        Parameters:
+        max_per_session (int, optional): Maximum number of videos counted per session.
+
+        Returns:
+        int: Number of videos.
+        """
+        lengths = self.lengths
+        if max_per_session is not None:
+            lengths = np.minimum(lengths, max_per_session)
+        return int(lengths.sum())
+
+    def eligible(self, min_events=1, latest_event=None):
+        """
+        Find the sessions with at least `min_events` events that end at or after `latest_event`.
+
+        Parameters:
+        min_events (int): Minimum number of events of an eligible session.
+        latest_event (str, optional): ISO format date string, in UTC.
+
+        Returns:
+        list: Numbers of the eligible sessions.
+        """
+        mask = self.lengths >= min_events
+        if latest_event is not None:
+            mask &= self.last_times >= pd.Timestamp(latest_event, tz='UTC').value
+        return np.flatnonzero(mask).tolist()
+
+    def select(self, starts, ends):
+        """
+        Build new sessions from event ranges of these sessions.
+
+        Parameters:
+        starts (np.ndarray): Offset of the first event of every new session.
+        ends (np.ndarray): Offset after the last event of every new session.
+
+        Returns:
+        Sessions: The new sessions.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        lengths = np.asarray(ends, dtype=np.int64) - starts
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        index = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+        return Sessions(self.times[index], self.video_ids[index], offsets, tz=self.tz)
+
+    def take(self, indices):
+        """
+        Keep the given sessions, in the given order.
+
+        Parameters:
+        indices (list): Numbers of the sessions to keep.
+
+        Returns:
+        Sessions: The kept sessions.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return self.select(self.offsets[:-1][indices], self.offsets[1:][indices])
+
+    def head(self, n_events):
+        """
+        Keep the first `n_events` events of every session.
+
+        Parameters:
+        n_events (int): Maximum number of events per session.
+
+        Returns:
+        Sessions: The truncated sessions.
+        """
+        starts = self.offsets[:-1]
+        return self.select(starts, starts + np.minimum(self.lengths, n_events))
+
+    def limit_total(self, n_events):
+        """
+        Keep the first sessions up to a total of `n_events` events, truncating the last kept session.
+
+        Parameters:
+        n_events (int): Maximum total number of events.
+
+        Returns:
+        Sessions: The kept sessions.
+        """
+        n_sessions = int(np.searchsorted(self.offsets, n_events, side='left'))
+        starts = self.offsets[:n_sessions]
+        ends = np.minimum(self.offsets[1:n_sessions + 1], n_events)
+        return self.select(starts, ends)
+
+    def to_frame(self):
+        """
+        Convert the sessions to a DataFrame.
+
+        Returns:
+        pd.DataFrame: DataFrame with 'time', 'video_id' and 'group' columns, sorted by time.
+        """
+        return pd.DataFrame({
+            'time': self.timestamps(),
+            'video_id': self.video_ids,
+            'group': self.session_numbers(),
+        })
+
+    def to_table(self):
+        """
+        Convert the sessions to an Arrow table with the raw event times and dictionary-encoded video IDs.
+
+        Returns:
+        pa.Table: Table with 'time' (int64 nanoseconds since the epoch), 'video_id' and 'session_num' columns,
+                  sorted by time, with the time zone in the schema metadata.
+        """
+        table = pa.table({
+            'time': pa.array(self.times, type=pa.int64()),
+            'video_id': pa.array(self.video_ids, type=pa.string()).dictionary_encode(),
+            'session_num': pa.array(self.session_numbers(), type=pa.int32()),
+        })
+        return table.replace_schema_metadata({SESSIONS_TZ_KEY: (self.tz or '').encode()})
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Rebuild sessions from a table written by to_table, without parsing any text.
+
+        Parameters:
+        table (pa.Table): Table with 'time', 'video_id' and 'session_num' columns, sorted by time.
+
+        Returns:
+        Sessions: The sessions.
+        """
+        tz = (table.schema.metadata or {}).get(SESSIONS_TZ_KEY, b'UTC').decode() or None
+        times = table.column('time').combine_chunks().to_numpy()
+        video_ids = table.column('video_id').unify_dictionaries().combine_chunks()
+        # decode every distinct video ID once and index the decoded IDs
+        video_ids = video_ids.dictionary.to_numpy(zero_copy_only=False).astype(str)[video_ids.indices.to_numpy()]
+        session_nums = table.column('session_num').combine_chunks().to_numpy()
+        n_sessions = int(session_nums[-1]) + 1 if len(session_nums) else 0
+        offsets = np.searchsorted(session_nums, np.arange(n_sessions + 1)).astype(np.int64)
+        return cls(times, video_ids, offsets, tz=tz)
+
+
+def build_sessions(times, video_ids, delta_minutes=30, min_events=1, tz='UTC'):
+    """
+    Split events into sessions wherever consecutive events are more than a time delta apart.
+
+    Parameters:
+    times (np.ndarray): Event times as int64 nanoseconds since the epoch, in any order.
+    video_ids (np.ndarray): Video IDs of the events.
+    delta_minutes (int): Time delta in minutes to define session boundaries.
+    min_events (int): Minimum number of events required to form a session.
+    tz (str, optional): Time zone of the materialized timestamps, None for naive timestamps.
+
+    Returns:
+    Sessions: The sessions, in chronological order.
+    """
+    order = np.argsort(times, kind='stable')
+    times = np.asarray(times, dtype=np.int64)[order]
+    video_ids = np.asarray(video_ids)[order]
+    breaks = np.flatnonzero(np.diff(times) > delta_minutes * 60 * 10**9) + 1
+    offsets = np.concatenate([[0], breaks, [len(times)]]).astype(np.int64) if len(times) else np.zeros(1, dtype=np.int64)
+    sessions = Sessions(times, video_ids, offsets, tz=tz)
+    if min_events > 1:
+        keep = np.flatnonzero(sessions.lengths >= min_events)
+        sessions = sessions.take(keep)
+    return sessions
+
+
+def frame_to_arrays(df: pd.DataFrame):
+    """
+    Extract the event times and video IDs of a DataFrame as arrays.
+
+    Parameters:
+    df (pd.DataFrame): DataFrame containing event data with 'time' and 'video_id' columns.
+
+    Returns:
+    tuple: Event times as int64 nanoseconds since the epoch, video IDs as fixed-width strings,
+           and the time zone of the 'time' column.
+    """
+    times = pd.DatetimeIndex(df['time'])
+    tz = 'UTC' if times.tz is not None else None
+    if tz is not None:
+        times = times.tz_convert('UTC')
+    return times.as_unit('ns').asi8, df['video_id'].to_numpy(dtype=str), tz
 
 
 def create_sessions(df: pd.DataFrame, delta_minutes=30, min_events=1):
@@ -20,12 +348,10 @@ def create_sessions(df: pd.DataFrame, delta_minutes=30, min_events=1):
     min_events (int): Minimum number of events required to form a session.
 
     Returns:
-    list: List of sessions, each session is a list of tuples (time, video_id).
+    Sessions: The sessions; each session materializes as a list of tuples (time, video_id).
     """
-    df.sort_values(by='time', inplace=True)
-    df.loc[:, 'group'] = (df['time'].diff() > pd.Timedelta(minutes=delta_minutes)).astype(int).cumsum()
-    sessions = [list(zip(group['time'], group['video_id'])) for _, group in df.groupby('group') if len(group) >= min_events]
-    return sessions
+    times, video_ids, tz = frame_to_arrays(df)
+    return build_sessions(times, video_ids, delta_minutes=delta_minutes, min_events=min_events, tz=tz)
 
 
 def extract_sessions(df: pd.DataFrame, delta_minutes=30, min_events=1, latest_event=None, n_sessions=None, n_videos_per_session=None, n_total_videos=None):
@@ -42,35 +368,24 @@ def extract_sessions(df: pd.DataFrame, delta_minutes=30, min_events=1, latest_ev
     n_total_videos (int, optional): Maximum total number of videos across all sessions.
 
     Returns:
-    list: List of sessions, each session is a list of tuples (time, video_id).
+    Sessions: The sessions; each session materializes as a list of tuples (time, video_id).
     """
-    df.sort_values(by='time', inplace=True)
+    times, video_ids, tz = frame_to_arrays(df)
 
     if latest_event:
-        latest_event = pd.to_datetime(latest_event, utc=True)
-        df = df[df['time'] >= latest_event].copy()
+        keep = times >= pd.Timestamp(pd.to_datetime(latest_event, utc=True)).value
+        times, video_ids = times[keep], video_ids[keep]
 
-    df.loc[:, 'group'] = (df['time'].diff() > pd.Timedelta(minutes=delta_minutes)).astype(int).cumsum()
-    sessions = [list(zip(group['time'], group['video_id'])) for _, group in df.groupby('group') if len(group) >= min_events]
+    sessions = build_sessions(times, video_ids, delta_minutes=delta_minutes, min_events=min_events, tz=tz)
 
     if n_sessions and len(sessions) > n_sessions:
-        sessions = random.sample(sessions, n_sessions)
+        sessions = sessions.take(random.sample(range(len(sessions)), n_sessions))
 
     if n_videos_per_session:
-        sessions = [session[:min(n_videos_per_session, len(session))] for session in sessions]
+        sessions = sessions.head(n_videos_per_session)
 
     if n_total_videos:
-        current_total = sum(len(session) for session in sessions)
-        if current_total > n_total_videos:
-            selected_sessions = []
-            n = 0
-            for session in sessions:
-                if n + len(session) > n_total_videos:
-                    selected_sessions.append(session[:n_total_videos - n])
-                    break
-                selected_sessions.append(session)
-                n += len(session)
-            sessions = selected_sessions
+        sessions = sessions.limit_total(n_total_videos)
 
     return sessions
 
@@ -85,11 +400,238 @@ def parse_yt_url(url):
     Returns:
     str: Extracted video ID or None if the URL is invalid.
     """
-    if url.startswith('https://www.youtube.com/watch?v='):
-        return url.split('=')[-1]
+    match = YT_URL_REGEX.match(url)
+    if match:
+        return match.group(1)
     return None
 
 
+def parse_yt_urls(urls):
+    """
+    Extract the video IDs of a whole column of YouTube URLs in a single vectorized pass.
+
+    Accepts the same URL forms as parse_yt_url and validates the 11-character ID alphabet.
+    Plain watch URLs, which make up most of a history, are sliced directly; only the
+    remaining URLs go through the full regular expression.
+
+    Parameters:
+    urls (pd.Series): YouTube URLs, missing values are allowed.
+
+    Returns:
+    pd.Series: Categorical series of video IDs, missing where the URL is invalid.
+    """
+    values = pa.array(urls, type=pa.string(), from_pandas=True)
+    id_start = len(YT_WATCH_PREFIX)
+    id_end = id_start + VIDEO_ID_LENGTH
+    plain = pc.and_(pc.starts_with(values, YT_WATCH_PREFIX), pc.equal(pc.utf8_length(values), id_end))
+    plain_ids = pc.utf8_slice_codeunits(values, id_start, id_end)
+    plain_valid = pc.and_(plain, pc.match_substring_regex(plain_ids, VIDEO_ID_PATTERN))
+    other_urls = pc.if_else(plain, pa.scalar(None, pa.string()), values)
+    other_ids = pc.extract_regex(other_urls, YT_URL_PATTERN)
+    other_ids = pc.if_else(pc.is_valid(other_ids), pc.struct_field(other_ids, 'video_id'), pa.scalar(None, pa.string()))
+    video_ids = pc.if_else(plain_valid, plain_ids, other_ids)
+    return pd.Series(video_ids.dictionary_encode().to_pandas(), index=urls.index, name=urls.name)
+
+
+def iter_json_array(stream, chunk_size=1 << 16, max_element_size=MAX_JSON_ELEMENT_SIZE):
+    """
+    Incrementally decode the elements of a top-level JSON array read from a binary stream.
+
+    Only the current element and one chunk of the stream are held in memory at a time. A malformed element
+    raises as soon as it is read, and an element longer than max_element_size raises without being read further.
+
+    Parameters:
+    stream (file-like): Binary stream containing a JSON array.
+    chunk_size (int): Number of bytes read from the stream at a time.
+    max_element_size (int): Maximum number of characters of a single element.
+
+    Yields:
+    object: The decoded elements of the array, in order.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        data = stream.read(chunk_size)
+        eof = not data
+        buffer = buffer[pos:] + decoder.decode(data or b'', final=eof)
+        pos = 0
+
+    def skip(chars):
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            read_more()
+
+    skip(' \t\r\n')
+    if buffer[pos:pos + 1] != '[':
+        raise ValueError('Expected a JSON array')
+    pos += 1
+    while True:
+        skip(' \t\r\n,')
+        if pos >= len(buffer):
+            raise ValueError('Unterminated JSON array')
+        if buffer[pos] == ']':
+            return
+        try:
+            element, end = _JSON_DECODER.raw_decode(buffer, pos)
+        except json.JSONDecodeError as err:
+            # only an element cut off by the end of the buffer is completed by reading more
+            truncated = err.msg.startswith('Unterminated string') or err.pos >= len(buffer) - _JSON_TRUNCATION_MARGIN
+            if eof or not truncated:
+                raise
+            if len(buffer) - pos > max_element_size:
+                raise ValueError(f'JSON array element longer than {max_element_size} characters')
+            read_more()
+            continue
+        if end == len(buffer) and not eof:
+            # a number ending the buffer may continue in the next chunk
+            read_more()
+            continue
+        pos = end
+        yield element
+
+
+def read_watch_history(stream, tz_offset=None, chunk_size=1 << 16, batch_size=10000):
+    """
+    Read a Takeout watch-history file record by record, keeping only the watch time and video ID of each event.
+
+    Events without a parseable YouTube video ID and ads (records with `details`) are dropped batch by batch
+    while reading, so memory use scales with the number of kept events rather than with the size of the file.
+
+    Parameters:
+    stream (file-like): Binary stream containing the watch-history JSON array.
+    tz_offset (float, optional): Offset in hours added to the event times.
+    chunk_size (int): Number of bytes read from the stream at a time.
+    batch_size (int): Number of records whose URLs and times are parsed together.
+
+    Returns:
+    pd.DataFrame: DataFrame with a UTC 'time' column and a 'video_id' column.
+    """
+    times = array('q')
+    video_ids = bytearray()
+    offset_ns = int(tz_offset * 3600 * 10**9) if tz_offset else 0
+    batch_times = []
+    batch_urls = []
+
+    def flush_batch():
+        # parse the URLs and times of a batch of records in one vectorized pass
+        batch_ids = parse_yt_urls(pd.Series(batch_urls))
+        valid = batch_ids.notna().to_numpy()
+        batch_ts = pd.to_datetime(pd.Series(batch_times)[valid], format='ISO8601', utc=True)
+        times.frombytes((batch_ts.to_numpy(dtype='datetime64[ns]').view(np.int64) + offset_ns).tobytes())
+        video_ids.extend(batch_ids[valid].astype(str).to_numpy(dtype=f'S{VIDEO_ID_LENGTH}').tobytes())
+        batch_times.clear()
+        batch_urls.clear()
+
+    for record in iter_json_array(stream, chunk_size=chunk_size):
+        # drop items corresponding to ads
+        if not isinstance(record, dict) or record.get('details') is not None:
+            continue
+        url = record.get('titleUrl')
+        time = record.get('time')
+        if not url or not time:
+            continue
+        batch_urls.append(url)
+        batch_times.append(time)
+        if len(batch_urls) >= batch_size:
+            flush_batch()
+    if batch_urls:
+        flush_batch()
+
+    return pd.DataFrame({
+        'time': pd.to_datetime(np.frombuffer(times, dtype=np.int64), utc=True),
+        'video_id': np.frombuffer(bytes(video_ids), dtype=f'S{VIDEO_ID_LENGTH}').astype(str),
+    })
+
+def save_sessions(sessions, path):
+    """
+    Write sessions to a zstd-compressed Parquet file.
+
+    The sorted times and session numbers are delta-encoded and the video IDs dictionary-encoded.
+    The file is written under a temporary name and renamed, so it is never read half-written.
+
+    Parameters:
+    sessions (Sessions): Sessions to write.
+    path (str): Path of the Parquet file.
+    """
+    tmp_path = f'{path}.tmp'
+    pq.write_table(sessions.to_table(), tmp_path, compression='zstd', use_dictionary=['video_id'],
+                   column_encoding={'time': 'DELTA_BINARY_PACKED', 'session_num': 'DELTA_BINARY_PACKED'})
+    os.replace(tmp_path, path)
+
+
+def load_sessions(path, filename=None):
+    """
+    Load sessions written by save_sessions, or the sessions of one upload from a dataset written by compact_uploads.
+
+    The files are memory-mapped rather than read into memory.
+
+    Parameters:
+    path (str): Path of a Parquet file, or of a compacted dataset.
+    filename (str, optional): Name of the upload to load from a compacted dataset.
+
+    Returns:
+    Sessions: The sessions.
+    """
+    if filename is None:
+        return Sessions.from_table(pq.read_table(path, memory_map=True))
+    dataset = ds.dataset(path, format='parquet', partitioning='hive',
+                         filesystem=pafs.LocalFileSystem(use_mmap=True))
+    table = dataset.to_table(columns=['time', 'video_id', 'session_num'], filter=pc.field('filename') == filename)
+    # the schema metadata of the dataset is the one of its first file
+    table = table.replace_schema_metadata(dataset.schema.metadata).sort_by('time')
+    return Sessions.from_table(table)
+
+
+def compact_uploads(upload_folder, dataset_path, older_than_days):
+    """
+    Merge the session files of old uploads into a dataset partitioned by upload month, and remove them.
+
+    Every run writes one file per month, named after the uploads it holds, so a run interrupted after writing
+    a file and before removing its uploads does not write them twice when it is repeated.
+
+    Parameters:
+    upload_folder (str): Folder of the session files written by save_sessions.
+    dataset_path (str): Folder of the dataset.
+    older_than_days (float): Minimum age in days of the compacted files.
+
+    Returns:
+    int: Number of compacted files.
+    """
+    cutoff = datetime.datetime.now().timestamp() - older_than_days * 24 * 3600
+    months = {}
+    for entry in sorted(os.scandir(upload_folder), key=lambda entry: entry.name):
+        if entry.is_file() and entry.name.endswith('.parquet') and entry.stat().st_mtime < cutoff:
+            month = datetime.datetime.fromtimestamp(entry.stat().st_mtime).strftime('%Y-%m')
+            months.setdefault(month, []).append(entry.path)
+
+    for month, paths in months.items():
+        filenames = [os.path.basename(path)[:-len('.parquet')] for path in paths]
+        partition = os.path.join(dataset_path, f'uploaded={month}')
+        part_path = os.path.join(partition, f'part-{hashlib.sha1(",".join(filenames).encode()).hexdigest()[:16]}.parquet')
+        if not os.path.exists(part_path):
+            tables = []
+            for path, filename in zip(paths, filenames):
+                table = pq.read_table(path, memory_map=True)
+                tables.append(table.append_column('filename', pa.array([filename] * len(table), type=pa.string())))
+            os.makedirs(partition, exist_ok=True)
+            tmp_path = f'{part_path}.tmp'
+            pq.write_table(pa.concat_tables(tables), tmp_path, compression='zstd', row_group_size=COMPACT_ROW_GROUP_SIZE,
+                           use_dictionary=['video_id', 'filename'],
+                           column_encoding={'time': 'DELTA_BINARY_PACKED', 'session_num': 'DELTA_BINARY_PACKED'})
+            os.replace(tmp_path, part_path)
+        for path in paths:
+            os.remove(path)
+    return sum(len(paths) for paths in months.values())
+
+
 if __name__ == "__main__":
     # Example usage
     # Create a DataFrame with example data
@@ -101,11 +643,11 @@ if __name__ == "__main__":
 
     # Create sessions
     sessions = create_sessions(df, delta_minutes=15)
-    print("Sessions:", sessions)
+    print("Sessions:", list(sessions))
 
     # Extract sessions
     extracted_sessions = extract_sessions(df, delta_minutes=15, n_sessions=1)
-    print("Extracted Sessions:", extracted_sessions)
+    print("Extracted Sessions:", list(extracted_sessions))
 
     # Parse YouTube URL
     url = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
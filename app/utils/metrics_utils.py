@@ -0,0 +1,285 @@
+"""
+metrics_utils.py
+
+This module defines the Prometheus metrics exposed by the application on /metrics, and a Flask-Session
+interface that records the size of the session payload and the round-trip time of its reads and writes to Redis.
+It also records the latency of every route with the number and total time of the SQL queries it issued,
+the YouTube Data API calls, and the size and processing time of uploads.
+Metrics are kept per process, unless PROMETHEUS_MULTIPROC_DIR names a directory shared by all web, worker and
+flusher processes: each process then writes its metrics to files in it, and /metrics reports the sum over all of them.
+Processes that exit are marked dead with mark_process_dead, so that their gauges are no longer reported.
+"""
+
+import os
+import socket
+import time
+
+from flask import current_app, g, has_request_context, request
+from flask_session.redis import RedisSessionInterface
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess, values
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import HTTPException
+
+
+def process_identifier(pid=None):
+    """
+    Name the metric files of a process in the multiprocess directory.
+
+    The directory is shared by the containers of the web, worker and flusher services, whose process IDs
+    all start at 1, so the files are named after the host name of the container and the process ID.
+
+    Parameters:
+    pid (int, optional): ID of the process, defaults to the current process.
+
+    Returns:
+    str: The identifier of the process.
+    """
+    return f'{socket.gethostname()}-{os.getpid() if pid is None else pid}'
+
+
+if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    values.ValueClass = values.MultiProcessValue(process_identifier)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+SESSION_PAYLOAD_BYTES = Histogram(
+    'regrets_session_payload_bytes',
+    'Size of the serialized session data read from or written to Redis',
+    ['operation', 'endpoint'],
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536),
+)
+SESSION_REDIS_SECONDS = Histogram(
+    'regrets_session_redis_seconds',
+    'Round-trip time of session reads and writes to Redis',
+    ['operation', 'endpoint'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+REQUEST_SECONDS = Histogram(
+    'regrets_request_seconds',
+    'Latency of the requests served by each route',
+    ['endpoint', 'method', 'status'],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_DB_QUERIES = Histogram(
+    'regrets_request_db_queries',
+    'Number of SQL queries issued while serving a request',
+    ['endpoint'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000),
+)
+REQUEST_DB_SECONDS = Histogram(
+    'regrets_request_db_seconds',
+    'Total time of the SQL queries issued while serving a request',
+    ['endpoint'],
+    buckets=LATENCY_BUCKETS,
+)
+YOUTUBE_CALLS = Counter(
+    'regrets_youtube_calls_total',
+    'YouTube Data API calls per resource and outcome',
+    ['resource', 'outcome'],
+)
+YOUTUBE_CALL_SECONDS = Histogram(
+    'regrets_youtube_call_seconds',
+    'Latency of the YouTube Data API calls',
+    ['resource'],
+    buckets=LATENCY_BUCKETS,
+)
+YOUTUBE_QUOTA_UNITS = Counter(
+    'regrets_youtube_quota_units_total',
+    'YouTube Data API quota units spent',
+    ['resource'],
+)
+YOUTUBE_DAILY_QUOTA_UNITS = Gauge(
+    'regrets_youtube_daily_quota_units',
+    'YouTube Data API quota units spent today by all processes, reset at midnight Pacific time',
+    # read from Redis by the process answering the scrape
+    multiprocess_mode='livemostrecent',
+)
+YOUTUBE_CIRCUIT_OPEN = Gauge(
+    'regrets_youtube_circuit_open',
+    'Whether the circuit breaker of the YouTube Data API calls is open',
+    multiprocess_mode='livemostrecent',
+)
+UPLOAD_BYTES = Histogram(
+    'regrets_upload_bytes',
+    'Size of the uploaded watch-history files',
+    buckets=(2 ** 16, 2 ** 18, 2 ** 20, 2 ** 22, 2 ** 23, 2 ** 24, 2 ** 25, 2 ** 26, 2 ** 27, 2 ** 28),
+)
+INGEST_SECONDS = Histogram(
+    'regrets_ingest_seconds',
+    'Time taken by /process to ingest an upload, or to store and queue it in asynchronous mode',
+    ['mode', 'outcome'],
+    buckets=LATENCY_BUCKETS,
+)
+VIDEO_CACHE_EVENTS = Counter(
+    'regrets_video_cache_events_total',
+    'Hits, misses and evictions of the video metadata cache per tier',
+    ['tier', 'event'],
+)
+
+
+def render_metrics():
+    """
+    Render the metrics in the Prometheus text format, summed over all processes in multiprocess mode.
+
+    Returns:
+    bytes: The metrics.
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+
+def mark_process_dead(pid):
+    """
+    Remove the gauges of a process that exited from the multiprocess directory.
+
+    Parameters:
+    pid (int): ID of the process.
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(process_identifier(pid))
+
+
+def record_video_cache_event(tier, event, count):
+    """
+    Count events of the video metadata cache.
+
+    Parameters:
+    tier (str): Cache tier, one of 'lru', 'redis' or 'database'.
+    event (str): Event, one of 'hit', 'miss' or 'eviction'.
+    count (int): Number of events.
+    """
+    VIDEO_CACHE_EVENTS.labels(tier, event).inc(count)
+
+
+def record_youtube_call(resource, seconds, outcome, quota_units):
+    """
+    Record a YouTube Data API call.
+
+    Parameters:
+    resource (str): API resource, such as 'videos' or 'channels'.
+    seconds (float): Latency of the call.
+    outcome (str): 'ok', or the reason of the error.
+    quota_units (int): Quota units charged for the call.
+    """
+    YOUTUBE_CALLS.labels(resource, outcome).inc()
+    YOUTUBE_CALL_SECONDS.labels(resource).observe(seconds)
+    YOUTUBE_QUOTA_UNITS.labels(resource).inc(quota_units)
+
+
+def record_youtube_guard_state(quota_units, circuit_open):
+    """
+    Record the state shared by all processes of the guard of the YouTube Data API calls.
+
+    Parameters:
+    quota_units (int): Quota units spent today.
+    circuit_open (bool): Whether the circuit breaker is open.
+    """
+    YOUTUBE_DAILY_QUOTA_UNITS.set(quota_units)
+    YOUTUBE_CIRCUIT_OPEN.set(int(circuit_open))
+
+
+def record_upload(size, mode, outcome, seconds):
+    """
+    Record the size of an upload and the time /process took with it.
+
+    Parameters:
+    size (int): Size of the uploaded file in bytes.
+    mode (str): 'sync' if the upload was ingested by the request, 'async' if it was queued for the worker.
+    outcome (str): 'ok', 'rejected' if the file was refused, 'reused' if it was a repeated upload, or 'error'.
+    seconds (float): Time taken.
+    """
+    UPLOAD_BYTES.observe(size)
+    INGEST_SECONDS.labels(mode, outcome).observe(seconds)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_times'].pop()
+    if has_request_context() and 'db_queries' in g:
+        g.db_queries += 1
+        g.db_seconds += elapsed
+
+
+def _handle_error(context):
+    # a failed query does not reach after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_start_times'):
+        context.connection.info['query_start_times'].pop()
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+
+
+def _end_request(response):
+    endpoint = _endpoint()
+    REQUEST_SECONDS.labels(endpoint, request.method, response.status_code).observe(time.perf_counter() - g.request_start)
+    REQUEST_DB_QUERIES.labels(endpoint).observe(g.db_queries)
+    REQUEST_DB_SECONDS.labels(endpoint).observe(g.db_seconds)
+    return response
+
+
+def instrument_app(app):
+    """
+    Record the latency and SQL queries of every request served by a Flask application.
+
+    The SQL queries are counted with SQLAlchemy engine events, so queries issued outside of a request,
+    by the worker for instance, are not counted.
+
+    Parameters:
+    app (flask.Flask): The application.
+    """
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+
+
+def _endpoint():
+    """Name of the endpoint serving the current request, used as a metric label."""
+    if request.endpoint:
+        return request.endpoint
+    # the session is opened before Flask matches the request to an endpoint
+    try:
+        return current_app.url_map.bind_to_environ(request.environ).match()[0]
+    except HTTPException:
+        return 'unknown'
+
+
+class MeteredRedisSessionInterface(RedisSessionInterface):
+    """
+    Redis session interface recording the payload size and Redis round-trip time of every session load and save.
+
+    It overrides the private methods of Flask-Session that read and write the Redis entry, so requirements.txt
+    pins the Flask-Session version providing them.
+    """
+
+    def _retrieve_session_data(self, store_id):
+        start = time.perf_counter()
+        serialized_session_data = self.client.get(store_id)
+        SESSION_REDIS_SECONDS.labels('load', _endpoint()).observe(time.perf_counter() - start)
+        if serialized_session_data:
+            SESSION_PAYLOAD_BYTES.labels('load', _endpoint()).observe(len(serialized_session_data))
+            return self.serializer.decode(serialized_session_data)
+        return None
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        serialized_session_data = self.serializer.encode(session)
+        SESSION_PAYLOAD_BYTES.labels('save', _endpoint()).observe(len(serialized_session_data))
+        start = time.perf_counter()
+        self.client.set(
+            name=store_id,
+            value=serialized_session_data,
+            ex=int(session_lifetime.total_seconds()),
+        )
+        SESSION_REDIS_SECONDS.labels('save', _endpoint()).observe(time.perf_counter() - start)
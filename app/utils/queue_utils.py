@@ -0,0 +1,362 @@
+"""
+queue_utils.py
+
+This module provides utility functions for queuing background jobs in Redis and tracking their status.
+Jobs are JSON documents pushed onto a Redis list and consumed by the worker process, while job status
+is kept in a Redis hash so that both the web application and the worker can read and update it.
+A worker moves each job it takes onto its own processing list until the job is finished, so that the jobs
+of a worker that stopped can be queued again.
+It also provides the Redis stream helpers used to buffer records before they are written to the database.
+"""
+
+import json
+import time
+import uuid
+
+from redis.exceptions import ResponseError
+
+# Redis list holding the pending jobs
+JOB_QUEUE = 'jobs'
+# Time in seconds after which the liveness marker of a worker expires if the worker stopped
+WORKER_TTL = 30
+# Number of times a job is started before it is reported as failed
+MAX_JOB_ATTEMPTS = 3
+# Time in seconds for which job status hashes are kept
+STATUS_TTL = 7 * 24 * 3600
+# Time in seconds after which an in-flight marker expires if its owner died
+INFLIGHT_TTL = 60
+# Time in milliseconds after which a record read but not acknowledged by a consumer can be claimed by another
+CLAIM_IDLE_MS = 30000
+
+
+def job_status_key(job_id):
+    """
+    Default Redis key of the hash tracking the status of a job.
+
+    Parameters:
+    job_id (str): The ID of the job.
+
+    Returns:
+    str: The Redis key.
+    """
+    return f'job:{job_id}'
+
+
+def enqueue_job(redis, job_type, payload, status_key=None):
+    """
+    Push a job onto the job queue and mark it as queued.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    job_type (str): Type of the job, used by the worker to dispatch it.
+    payload (dict): JSON-serializable job arguments.
+    status_key (str, optional): Redis key of the hash tracking the job status, defaults to job_status_key(job_id).
+
+    Returns:
+    str: The ID of the queued job.
+    """
+    job_id = str(uuid.uuid4())
+    status_key = status_key or job_status_key(job_id)
+    job = {'id': job_id, 'type': job_type, 'payload': payload, 'status_key': status_key}
+    set_job_status(redis, status_key, job_id=job_id, state='queued', queued_at=time.time())
+    redis.lpush(JOB_QUEUE, json.dumps(job))
+    return job_id
+
+
+def processing_key(consumer):
+    """
+    Redis key of the list holding the jobs taken by a worker.
+
+    Parameters:
+    consumer (str): Name of the worker.
+
+    Returns:
+    str: The Redis key.
+    """
+    return f'{JOB_QUEUE}:processing:{consumer}'
+
+
+def worker_key(consumer):
+    """
+    Redis key of the liveness marker of a worker.
+
+    Parameters:
+    consumer (str): Name of the worker.
+
+    Returns:
+    str: The Redis key.
+    """
+    return f'worker:{consumer}'
+
+
+def dequeue_job(redis, consumer, timeout=5):
+    """
+    Move the oldest job from the job queue onto the processing list of a worker, waiting for one to arrive.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    consumer (str): Name of the worker.
+    timeout (int): Maximum time in seconds to wait for a job.
+
+    Returns:
+    dict: The job, or None if no job arrived before the timeout.
+    """
+    item = redis.blmove(JOB_QUEUE, processing_key(consumer), timeout, src='RIGHT', dest='LEFT')
+    if item is None:
+        return None
+    return json.loads(item)
+
+
+def finish_job(redis, consumer, job):
+    """
+    Remove a finished job from the processing list of a worker.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    consumer (str): Name of the worker.
+    job (dict): The job returned by dequeue_job.
+    """
+    redis.lrem(processing_key(consumer), 1, json.dumps(job))
+
+
+def heartbeat(redis, consumer, ttl=WORKER_TTL):
+    """
+    Mark a worker as alive for the next ttl seconds.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    consumer (str): Name of the worker.
+    ttl (int): Time in seconds after which the marker expires.
+    """
+    redis.set(worker_key(consumer), 1, ex=ttl)
+
+
+def requeue_stale_jobs(redis, consumer):
+    """
+    Queue again the jobs left on the processing lists of workers that stopped.
+
+    The processing list of the calling worker is always requeued, as it is only called while the worker
+    holds no job, for example after a restart under the same name.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    consumer (str): Name of the calling worker.
+
+    Returns:
+    list: The requeued jobs.
+    """
+    prefix = processing_key('')
+    requeued = []
+    for key in redis.scan_iter(match=f'{prefix}*'):
+        owner = key.decode()[len(prefix):]
+        if owner != consumer and redis.exists(worker_key(owner)):
+            continue
+        # the oldest job goes first, back to the end of the queue from which jobs are taken
+        while (item := redis.lindex(key, -1)) is not None:
+            job = json.loads(item)
+            set_job_status(redis, job['status_key'], state='queued', requeued_at=time.time())
+            redis.lmove(key, JOB_QUEUE, src='RIGHT', dest='RIGHT')
+            requeued.append(job)
+    return requeued
+
+
+def set_job_status(redis, status_key, **fields):
+    """
+    Update fields of a job status hash.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    status_key (str): Redis key of the job status hash.
+    fields: Fields to set.
+    """
+    redis.hset(status_key, mapping=fields)
+    redis.expire(status_key, STATUS_TTL)
+
+
+def increment_job_status(redis, status_key, field, amount=1):
+    """
+    Increment a counter field of a job status hash.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    status_key (str): Redis key of the job status hash.
+    field (str): Counter field to increment.
+    amount (int): Amount to add.
+    """
+    if amount:
+        redis.hincrby(status_key, field, amount)
+
+
+def get_job_status(redis, status_key):
+    """
+    Read a job status hash.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    status_key (str): Redis key of the job status hash.
+
+    Returns:
+    dict: The job status fields as strings, empty if the job is unknown.
+    """
+    return {key.decode(): value.decode() for key, value in redis.hgetall(status_key).items()}
+
+
+def claim_inflight(redis, prefix, ids, ttl=INFLIGHT_TTL):
+    """
+    Mark items as in-flight, skipping those already claimed by another process.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    prefix (str): Key prefix of the in-flight markers.
+    ids (list): Items to claim.
+    ttl (int): Time in seconds after which a marker expires.
+
+    Returns:
+    list: The items claimed by this call.
+    """
+    pipe = redis.pipeline()
+    for item_id in ids:
+        pipe.set(f'{prefix}:{item_id}', 1, nx=True, ex=ttl)
+    return [item_id for item_id, claimed in zip(ids, pipe.execute()) if claimed]
+
+
+def release_inflight(redis, prefix, ids):
+    """
+    Remove the in-flight markers of items.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    prefix (str): Key prefix of the in-flight markers.
+    ids (list): Items to release.
+    """
+    if ids:
+        redis.delete(*[f'{prefix}:{item_id}' for item_id in ids])
+
+
+def wait_inflight(redis, prefix, ids, timeout, poll_interval=0.1):
+    """
+    Wait until none of the items is in-flight anymore, or until the timeout expires.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    prefix (str): Key prefix of the in-flight markers.
+    ids (list): Items to wait for.
+    timeout (float): Maximum time in seconds to wait.
+    poll_interval (float): Time in seconds between two checks.
+
+    Returns:
+    list: The items that were in-flight when the wait started.
+    """
+    keys = [f'{prefix}:{item_id}' for item_id in ids]
+    if not keys:
+        return []
+    pipe = redis.pipeline()
+    for key in keys:
+        pipe.exists(key)
+    inflight = [item_id for item_id, exists in zip(ids, pipe.execute()) if exists]
+    deadline = time.monotonic() + timeout
+    while inflight and time.monotonic() < deadline:
+        time.sleep(poll_interval)
+        if redis.exists(*[f'{prefix}:{item_id}' for item_id in inflight]) == 0:
+            break
+    return inflight
+
+
+def _stream_id(entry_id):
+    """Split a Redis stream entry ID into comparable integers."""
+    milliseconds, sequence = entry_id.split('-')
+    return int(milliseconds), int(sequence)
+
+
+def append_record(redis, stream, record, encoder=None):
+    """
+    Append a record to a Redis stream.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    stream (str): Key of the stream.
+    record (dict): JSON-serializable record.
+    encoder (json.JSONEncoder, optional): Encoder class for values that JSON does not support.
+
+    Returns:
+    str: The ID of the stream entry.
+    """
+    return redis.xadd(stream, {'record': json.dumps(record, cls=encoder)}).decode()
+
+
+def ensure_group(redis, stream, group):
+    """
+    Create a consumer group reading a stream from its start, if it does not exist yet.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    stream (str): Key of the stream.
+    group (str): Name of the consumer group.
+    """
+    try:
+        redis.xgroup_create(stream, group, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def read_records(redis, stream, group, consumer, count, block=None, min_idle_ms=CLAIM_IDLE_MS):
+    """
+    Read records for a consumer, first claiming those left unacknowledged by consumers that stopped.
+
+    Records stay pending in the consumer group until they are acknowledged, so a record is never lost
+    when its consumer dies before writing it; it is delivered again to another consumer instead.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    stream (str): Key of the stream.
+    group (str): Name of the consumer group.
+    consumer (str): Name of the consumer.
+    count (int): Maximum number of records to read.
+    block (int, optional): Time in milliseconds to wait for new records, if none are pending.
+    min_idle_ms (int): Time in milliseconds after which a pending record can be claimed.
+
+    Returns:
+    list: Tuples of stream entry ID and record.
+    """
+    entries = redis.xautoclaim(stream, group, consumer, min_idle_time=min_idle_ms, start_id='0-0', count=count)[1]
+    if not entries:
+        response = redis.xreadgroup(group, consumer, {stream: '>'}, count=count, block=block)
+        entries = response[0][1] if response else []
+    return [(entry_id.decode(), json.loads(fields[b'record'])) for entry_id, fields in entries if fields]
+
+
+def ack_records(redis, stream, group, entry_ids):
+    """
+    Acknowledge written records and remove them from the stream.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    stream (str): Key of the stream.
+    group (str): Name of the consumer group.
+    entry_ids (list): IDs of the stream entries.
+    """
+    if entry_ids:
+        pipe = redis.pipeline()
+        pipe.xack(stream, group, *entry_ids)
+        pipe.xdel(stream, *entry_ids)
+        pipe.execute()
+
+
+def is_acknowledged(redis, stream, group, entry_id):
+    """
+    Check whether a record and all records before it have been acknowledged by a consumer group.
+
+    Parameters:
+    redis (redis.Redis): Redis client.
+    stream (str): Key of the stream.
+    group (str): Name of the consumer group.
+    entry_id (str): ID of the stream entry.
+
+    Returns:
+    bool: Whether the records up to the entry have been acknowledged.
+    """
+    groups = {info['name'].decode(): info for info in redis.xinfo_groups(stream)}
+    if _stream_id(groups[group]['last-delivered-id'].decode()) < _stream_id(entry_id):
+        return False
+    return not redis.xpending_range(stream, group, min='-', max=entry_id, count=1)
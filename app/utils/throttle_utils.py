@@ -0,0 +1,221 @@
+"""
+throttle_utils.py
+
+This module provides Redis-backed guards for calls to an external API that are shared by all processes
+of the application: a token bucket limiting the call rate, a circuit breaker that stops the calls after
+repeated failures, and a daily counter of the quota units spent.
+"""
+
+import datetime
+import time
+from zoneinfo import ZoneInfo
+
+# Refills the bucket for the time elapsed since its last update and takes the requested tokens if enough are left.
+# Returns the time in seconds to wait for the missing tokens, or 0 if the tokens were taken.
+# The Redis server clock is used, so that the processes agree on the elapsed time.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+# The YouTube Data API quota is reset at midnight Pacific time
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+
+
+class RateLimitedError(Exception):
+    """No token could be taken from the bucket in the allowed time."""
+
+
+class CircuitOpenError(Exception):
+    """The circuit breaker is open, so the call is not made."""
+
+
+class TokenBucket:
+    """Token bucket shared by all processes through a Redis hash."""
+
+    def __init__(self, redis, key, rate, capacity):
+        """
+        Parameters:
+        redis (redis.Redis): Redis client.
+        key (str): Redis key of the bucket.
+        rate (float): Tokens added per second.
+        capacity (int): Maximum number of tokens, i.e. the largest burst of calls.
+        """
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self.script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def acquire(self, tokens=1, max_wait=0):
+        """
+        Take tokens from the bucket, waiting for them to be refilled if needed.
+
+        Parameters:
+        tokens (int): Number of tokens to take.
+        max_wait (float): Maximum time in seconds to wait for the tokens.
+
+        Raises:
+        RateLimitedError: If the tokens could not be taken within max_wait seconds.
+        """
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = float(self.script(keys=[self.key], args=[self.rate, self.capacity, tokens]))
+            if wait == 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimitedError(f'Rate limit of {self.key} reached')
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker shared by all processes through Redis keys.
+
+    The circuit opens once `failure_threshold` failures happen within `failure_window` seconds, and calls are
+    refused for `reset_seconds`. The first failure after that opens it again right away, until a call succeeds.
+    """
+
+    def __init__(self, redis, key, failure_threshold, failure_window, reset_seconds):
+        """
+        Parameters:
+        redis (redis.Redis): Redis client.
+        key (str): Prefix of the Redis keys of the breaker.
+        failure_threshold (int): Number of failures that opens the circuit.
+        failure_window (int): Time in seconds over which failures are counted.
+        reset_seconds (int): Time in seconds for which the circuit stays open.
+        """
+        self.redis = redis
+        self.failures_key = f'{key}:failures'
+        self.open_key = f'{key}:open'
+        self.half_open_key = f'{key}:half_open'
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.reset_seconds = reset_seconds
+
+    def is_open(self):
+        """Whether calls are currently refused."""
+        return bool(self.redis.exists(self.open_key))
+
+    def check(self):
+        """
+        Raises:
+        CircuitOpenError: If the circuit is open.
+        """
+        if self.is_open():
+            raise CircuitOpenError(f'Circuit {self.open_key} is open')
+
+    def trip(self):
+        """Open the circuit for reset_seconds."""
+        pipe = self.redis.pipeline()
+        pipe.set(self.open_key, 1, ex=self.reset_seconds)
+        pipe.set(self.half_open_key, 1)
+        pipe.delete(self.failures_key)
+        pipe.execute()
+
+    def record_success(self):
+        """Close the circuit after a successful call."""
+        self.redis.delete(self.failures_key, self.half_open_key)
+
+    def record_failure(self):
+        """Count a failed call, and open the circuit if there were too many of them."""
+        if self.redis.exists(self.half_open_key):
+            self.trip()
+            return
+        pipe = self.redis.pipeline()
+        pipe.incr(self.failures_key)
+        pipe.expire(self.failures_key, self.failure_window, nx=True)
+        failures, _ = pipe.execute()
+        if failures >= self.failure_threshold:
+            self.trip()
+
+
+class QuotaCounter:
+    """Daily counter of API quota units shared by all processes."""
+
+    def __init__(self, redis, key):
+        """
+        Parameters:
+        redis (redis.Redis): Redis client.
+        key (str): Prefix of the Redis keys of the daily counters.
+        """
+        self.redis = redis
+        self.key = key
+
+    def _day_key(self):
+        return f'{self.key}:{datetime.datetime.now(QUOTA_TIMEZONE).date().isoformat()}'
+
+    def add(self, units):
+        """Count quota units spent today."""
+        pipe = self.redis.pipeline()
+        pipe.incrby(self._day_key(), units)
+        pipe.expire(self._day_key(), 2 * 24 * 3600)
+        pipe.execute()
+
+    def used(self):
+        """
+        Returns:
+        int: Quota units spent today.
+        """
+        return int(self.redis.get(self._day_key()) or 0)
+
+
+class ApiGuard:
+    """Rate limiter, circuit breaker and quota counter guarding the calls to an API."""
+
+    def __init__(self, bucket, breaker, quota, max_wait):
+        """
+        Parameters:
+        bucket (TokenBucket): Limits the call rate.
+        breaker (CircuitBreaker): Stops the calls after repeated failures.
+        quota (QuotaCounter): Counts the quota units spent.
+        max_wait (float): Maximum time in seconds a call waits for the rate limit.
+        """
+        self.bucket = bucket
+        self.breaker = breaker
+        self.quota = quota
+        self.max_wait = max_wait
+
+    def acquire(self, quota_units):
+        """
+        Allow a call, once the circuit is closed and the rate limit allows it.
+
+        Parameters:
+        quota_units (int): Quota units charged for the call.
+
+        Raises:
+        CircuitOpenError: If the circuit is open.
+        RateLimitedError: If the rate limit did not allow the call within max_wait seconds.
+        """
+        self.breaker.check()
+        self.bucket.acquire(max_wait=self.max_wait)
+        self.quota.add(quota_units)
+
+    def record_success(self):
+        self.breaker.record_success()
+
+    def record_failure(self, trip=False):
+        """
+        Record a failed call.
+
+        Parameters:
+        trip (bool): Open the circuit right away, for errors that retrying cannot fix.
+        """
+        if trip:
+            self.breaker.trip()
+        else:
+            self.breaker.record_failure()
@@ -0,0 +1,202 @@
+"""
+yt_emulator.py
+
+This module provides an offline stand-in for the YouTube Data API, used to benchmark and test the metadata path
+without network access or API quota. It is a transport that googleapiclient uses in place of httplib2.Http, so
+requests are still built and responses parsed by the real client. It answers videos.list and channels.list
+from recorded fixtures or from data generated deterministically from the requested IDs, with configurable
+latency, server errors, quota errors and missing videos.
+
+Set YT_EMULATOR=1 to make yt_utils use it, and tune it with the environment variables read by EmulatorHttp.from_env.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlsplit
+
+import httplib2
+
+from utils.yt_utils import LIST_QUOTA_COST
+
+
+def _unit_hash(value, salt=''):
+    """Map a string to a deterministic number in [0, 1)."""
+    return zlib.crc32(f'{salt}:{value}'.encode()) / 2 ** 32
+
+
+def generate_video_item(video_id, n_channels=1000):
+    """
+    Generate a videos.list item for a video ID, always the same for the same ID.
+
+    Parameters:
+    video_id (str): ID of the video.
+    n_channels (int): Number of distinct channels the videos are spread over.
+
+    Returns:
+    dict: A videos.list item with snippet, contentDetails and statistics.
+    """
+    channel_id = f'UC{int(_unit_hash(video_id, "channel") * n_channels):022d}'
+    published_at = datetime(2024, 1, 1, tzinfo=timezone.utc) - timedelta(days=int(_unit_hash(video_id, 'age') * 3650))
+    duration = int(30 + _unit_hash(video_id, 'duration') * 3600)
+    views = int(10 ** (1 + _unit_hash(video_id, 'views') * 7))
+    return {
+        'kind': 'youtube#video',
+        'id': video_id,
+        'snippet': {
+            'publishedAt': published_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'channelId': channel_id,
+            'title': f'Emulated video {video_id}',
+            'description': f'Description of the emulated video {video_id}.\nSecond line.',
+            'thumbnails': {'high': {'url': f'https://i.ytimg.com/vi/{video_id}/hqdefault.jpg'}},
+            'channelTitle': f'Emulated channel {channel_id}',
+            'categoryId': str(1 + int(_unit_hash(video_id, 'category') * 29)),
+        },
+        'contentDetails': {'duration': f'PT{duration // 60}M{duration % 60}S'},
+        'statistics': {
+            'viewCount': str(views),
+            'likeCount': str(views // 40),
+            'favoriteCount': '0',
+            'commentCount': str(views // 400),
+        },
+    }
+
+
+def generate_channel_item(channel_id):
+    """
+    Generate a channels.list item for a channel ID.
+
+    Parameters:
+    channel_id (str): ID of the channel.
+
+    Returns:
+    dict: A channels.list item with a snippet.
+    """
+    return {
+        'kind': 'youtube#channel',
+        'id': channel_id,
+        'snippet': {
+            'title': f'Emulated channel {channel_id}',
+            'thumbnails': {'default': {'url': f'https://yt3.ggpht.com/{channel_id}=s88'}},
+        },
+    }
+
+
+class EmulatorHttp:
+    """Transport answering YouTube Data API list calls locally, in place of httplib2.Http."""
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0, quota_error_rate=0.0, missing_rate=0.0,
+                 fixtures=None, seed=None, timeout=None):
+        """
+        Parameters:
+        latency (float): Time in seconds every call takes.
+        latency_jitter (float): Maximum random time in seconds added to the latency.
+        error_rate (float): Fraction of calls failing with a 503 backend error.
+        quota_error_rate (float): Fraction of calls failing with a 403 quotaExceeded error.
+        missing_rate (float): Fraction of video IDs that are reported missing, always the same IDs.
+        fixtures (dict, optional): Recorded items under 'videos' and 'channels', each mapping IDs to items;
+                                   they are returned instead of generated items.
+        seed (int, optional): Random seed of the latency jitter and errors.
+        timeout (float, optional): Socket timeout in seconds; slower calls raise TimeoutError as a real socket would.
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.quota_error_rate = quota_error_rate
+        self.missing_rate = missing_rate
+        self.timeout = timeout
+        self.fixtures = fixtures or {'videos': {}, 'channels': {}}
+        self.calls = {'videos': 0, 'channels': 0, 'errors': 0, 'quota_errors': 0, 'quota_units': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, timeout=None):
+        """
+        Create an emulator configured from environment variables:
+        YT_EMULATOR_LATENCY_MS, YT_EMULATOR_JITTER_MS, YT_EMULATOR_ERROR_RATE, YT_EMULATOR_QUOTA_ERROR_RATE,
+        YT_EMULATOR_MISSING_RATE, YT_EMULATOR_FIXTURES (path of a JSON fixtures file) and YT_EMULATOR_SEED.
+
+        Parameters:
+        timeout (float, optional): Socket timeout in seconds.
+
+        Returns:
+        EmulatorHttp: The configured emulator.
+        """
+        fixtures = None
+        if os.getenv('YT_EMULATOR_FIXTURES'):
+            with open(os.getenv('YT_EMULATOR_FIXTURES')) as fixtures_file:
+                fixtures = json.load(fixtures_file)
+        seed = os.getenv('YT_EMULATOR_SEED')
+        return cls(
+            latency=float(os.getenv('YT_EMULATOR_LATENCY_MS', 0)) / 1000,
+            latency_jitter=float(os.getenv('YT_EMULATOR_JITTER_MS', 0)) / 1000,
+            error_rate=float(os.getenv('YT_EMULATOR_ERROR_RATE', 0)),
+            quota_error_rate=float(os.getenv('YT_EMULATOR_QUOTA_ERROR_RATE', 0)),
+            missing_rate=float(os.getenv('YT_EMULATOR_MISSING_RATE', 0)),
+            fixtures=fixtures,
+            seed=int(seed) if seed is not None else None,
+            timeout=timeout,
+        )
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.calls[key] += amount
+
+    def _draw(self):
+        with self._lock:
+            return self._random.random(), self._random.random()
+
+    def _error(self, status, reason, message):
+        content = {'error': {'code': status, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}
+        return httplib2.Response({'status': status, 'content-type': 'application/json'}), json.dumps(content).encode()
+
+    def _video_items(self, video_ids):
+        items = []
+        for video_id in video_ids:
+            if video_id in self.fixtures.get('videos', {}):
+                items.append(self.fixtures['videos'][video_id])
+            elif _unit_hash(video_id, 'missing') >= self.missing_rate:
+                items.append(generate_video_item(video_id))
+        return items
+
+    def _channel_items(self, channel_ids):
+        return [self.fixtures.get('channels', {}).get(channel_id) or generate_channel_item(channel_id)
+                for channel_id in channel_ids]
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        """
+        Answer a request of googleapiclient as httplib2.Http.request does.
+
+        Returns:
+        tuple: The httplib2.Response and the JSON response body.
+        """
+        jitter_draw, error_draw = self._draw()
+        latency = self.latency + jitter_draw * self.latency_jitter
+        if self.timeout is not None and latency > self.timeout:
+            time.sleep(self.timeout)
+            raise TimeoutError('timed out')
+        time.sleep(latency)
+
+        url = urlsplit(uri)
+        resource = url.path.rstrip('/').rsplit('/', 1)[-1]
+        if resource not in ('videos', 'channels'):
+            return self._error(404, 'notFound', f'The emulator does not implement {url.path}')
+        self._count(resource)
+        self._count('quota_units', LIST_QUOTA_COST)
+        if error_draw < self.quota_error_rate:
+            self._count('quota_errors')
+            return self._error(403, 'quotaExceeded', 'The request cannot be completed because you have exceeded your quota.')
+        if error_draw < self.quota_error_rate + self.error_rate:
+            self._count('errors')
+            return self._error(503, 'backendError', 'Backend Error')
+
+        ids = [item_id for item_id in parse_qs(url.query).get('id', [''])[0].split(',') if item_id]
+        items = self._video_items(ids) if resource == 'videos' else self._channel_items(ids)
+        content = {'kind': f'youtube#{resource[:-1]}ListResponse', 'items': items,
+                   'pageInfo': {'totalResults': len(items), 'resultsPerPage': len(items)}}
+        return httplib2.Response({'status': 200, 'content-type': 'application/json'}), json.dumps(content).encode()
@@ -7,10 +7,17 @@ formatting this information for display.
 """
 
 import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 import googleapiclient.discovery
+import httplib2
+from googleapiclient.errors import HttpError
 from isodate import parse_duration
 from dotenv import load_dotenv
+from utils.metrics_utils import record_youtube_call
 
 # Load environment variables from the .env file
 dotenv_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
@@ -19,83 +26,314 @@ load_dotenv(dotenv_path)
 # Retrieve the YouTube developer key from environment variables
 YT_DEVELOPER_KEY = os.getenv("YT_DEVELOPER_KEY")
 
-# Create a YouTube service object using the API key
 api_service_name = "youtube"
 api_version = "v3"
-youtube = googleapiclient.discovery.build(api_service_name, api_version, developerKey=YT_DEVELOPER_KEY)
+# The YouTube Data API accepts at most 50 comma-separated IDs per list call
+MAX_IDS_PER_REQUEST = 50
+# Quota units charged for a list call, whatever the number of IDs
+LIST_QUOTA_COST = 1
+# Error reasons that mean the API refuses calls for a while, so that retrying right away is pointless
+QUOTA_ERROR_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+THROTTLE_ERROR_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
 
 
-def get_youtube_video_info(video_id, session_date=None, youtube=youtube):
+def build_http(timeout=None):
     """
-    Retrieve YouTube video details using the YouTube Data API.
+    Create the HTTP object sending API calls, which is the offline emulator if YT_EMULATOR is set.
 
     Parameters:
-    video_id (str): The ID of the YouTube video.
-    session_date (datetime, optional): The date of the session.
+    timeout (float, optional): Socket timeout in seconds of every API call.
+
+    Returns:
+    httplib2.Http: The HTTP object.
+    """
+    if os.getenv("YT_EMULATOR"):
+        from utils.yt_emulator import EmulatorHttp
+        return EmulatorHttp.from_env(timeout=timeout)
+    return httplib2.Http(timeout=timeout)
+
+
+def build_youtube(timeout=None):
+    """
+    Create a YouTube service object using the API key.
+
+    Parameters:
+    timeout (float, optional): Socket timeout in seconds of every API call.
+
+    Returns:
+    googleapiclient.discovery.Resource: YouTube API service object.
+    """
+    return googleapiclient.discovery.build(api_service_name, api_version, developerKey=YT_DEVELOPER_KEY,
+                                           http=build_http(timeout))
+
+
+youtube = build_youtube()
+
+
+class HttpPool:
+    """
+    HTTP objects for concurrent API calls, since an httplib2.Http object cannot be used by two threads at once.
+    Idle objects are kept, with their open connections, for the next calls.
+    """
+
+    def __init__(self, create_http, size):
+        """
+        Parameters:
+        create_http (callable): Takes no argument and returns a new HTTP object.
+        size (int): Maximum number of concurrent calls of a batch.
+        """
+        self.create_http = create_http
+        self.size = size
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        """Lend an HTTP object to the calling thread."""
+        try:
+            http = self.idle.get_nowait()
+        except queue.Empty:
+            http = self.create_http()
+        try:
+            yield http
+        finally:
+            self.idle.put(http)
+
+
+def chunked(items, size=MAX_IDS_PER_REQUEST):
+    """
+    Split a list into consecutive chunks of at most `size` elements.
+
+    Parameters:
+    items (list): Items to split.
+    size (int): Maximum chunk size.
+
+    Returns:
+    list: List of chunks.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def map_chunks(fetch_chunk, items, http_pool=None):
+    """
+    Call `fetch_chunk` on consecutive chunks of at most 50 items, concurrently if an HTTP pool is given.
+
+    Parameters:
+    fetch_chunk (callable): Takes a chunk and the HTTP object to send its call with, or None for the default one.
+    items (list): Items to split.
+    http_pool (HttpPool, optional): HTTP objects of the concurrent calls, whose size bounds the concurrency.
+
+    Returns:
+    list: The results of the chunks, in the order of the chunks.
+    """
+    chunks = chunked(items)
+    if http_pool is None or http_pool.size <= 1 or len(chunks) <= 1:
+        return [fetch_chunk(chunk, None) for chunk in chunks]
+
+    def fetch_pooled(chunk):
+        with http_pool.connection() as http:
+            return fetch_chunk(chunk, http)
+
+    with ThreadPoolExecutor(max_workers=min(http_pool.size, len(chunks))) as executor:
+        return list(executor.map(fetch_pooled, chunks))
+
+
+def execute_request(api_request, resource, guard=None, http=None):
+    """
+    Execute a YouTube Data API request and record its latency, outcome and quota cost.
+
+    Parameters:
+    api_request (googleapiclient.http.HttpRequest): The request.
+    resource (str): Name of the API resource, used as a metric label.
+    guard (utils.throttle_utils.ApiGuard, optional): Rate limiter and circuit breaker the call must pass,
+                                                     told about the outcome of the call.
+    http (httplib2.Http, optional): HTTP object to send the call with, instead of that of the service object.
+
+    Returns:
+    dict: The response.
+
+    Raises:
+    utils.throttle_utils.CircuitOpenError: If the guard's circuit is open.
+    utils.throttle_utils.RateLimitedError: If the guard's rate limit did not allow the call in time.
+    """
+    if guard is not None:
+        guard.acquire(LIST_QUOTA_COST)
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        response = api_request.execute(http=http)
+    except HttpError as e:
+        details = e.error_details if isinstance(e.error_details, list) else []
+        outcome = details[0].get('reason', str(e.resp.status)) if details else str(e.resp.status)
+        # client errors such as an invalid request say nothing about the health of the API
+        if guard is not None and (e.resp.status >= 500 or outcome in QUOTA_ERROR_REASONS | THROTTLE_ERROR_REASONS):
+            guard.record_failure(trip=outcome in QUOTA_ERROR_REASONS)
+        raise
+    except Exception:
+        # timeouts and connection errors
+        outcome = 'error'
+        if guard is not None:
+            guard.record_failure()
+        raise
+    finally:
+        record_youtube_call(resource, time.perf_counter() - start, outcome, LIST_QUOTA_COST)
+    if guard is not None:
+        guard.record_success()
+    return response
+
+
+def get_youtube_channels_info(channel_ids, youtube=youtube, guard=None, http_pool=None):
+    """
+    Retrieve titles and default icons for a batch of channels using the YouTube Data API.
+
+    Parameters:
+    channel_ids (list): Channel IDs, duplicates are ignored.
     youtube (googleapiclient.discovery.Resource, optional): YouTube API service object.
+    guard (utils.throttle_utils.ApiGuard, optional): Guard of the API calls.
+    http_pool (HttpPool, optional): HTTP objects to send the calls of several chunks concurrently.
 
     Returns:
-    dict: A dictionary containing video information, or None if the video is not found.
+    dict: A dictionary mapping each found channel ID to a dictionary with its title and icon URL.
     """
-    # Call the videos.list method to retrieve video details
-    video_request = youtube.videos().list(
-        part="snippet,contentDetails,statistics",
-        id=video_id
-    )
-    video_response = video_request.execute()
-
-    if video_response['items']:
-        video_item = video_response['items'][0]
-        video_info = video_item['snippet']
-
-        title = video_info.get('title', None)
-        description = video_info.get('description', None)
-        if description and len(description) > 1200:
-            description = description[:1195] + '...'
-        view_count = video_item['statistics'].get('viewCount', None)
-        like_count = video_item['statistics'].get('likeCount', None)
-        comment_count = video_item['statistics'].get('commentCount', None)
-        favorite_count = video_item['statistics'].get('favoriteCount', None)
-        category_id = video_item['statistics'].get('categoryId', None)
-        publish_time = video_info.get('publishedAt', None)
-        if publish_time:
-            if isinstance(publish_time, str):
-                publish_time = publish_time.replace('Z', '+00:00')
-        duration = parse_duration(video_item['contentDetails']['duration']).total_seconds()
-
-        thumbnail_url = f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"
-
-        channel_id = video_info.get('channelId', None)
-        channel_title = video_info['channelTitle']
+    channel_ids = list(dict.fromkeys(cid for cid in channel_ids if cid))
+
+    def fetch_chunk(chunk, http):
         # Call the channels.list method to retrieve channel details
         channel_request = youtube.channels().list(
             part="snippet",
-            id=channel_id
+            id=",".join(chunk)
         )
-        channel_response = channel_request.execute()
-
-        if channel_response['items']:
-            channel_icon = channel_response['items'][0]['snippet']['thumbnails']['default']['url']
-        else:
-            channel_icon = None
-
-        video_info = {
-            'title': title,
-            'description': description,
-            'view_count': view_count,
-            'like_count': like_count,
-            'comment_count': comment_count,
-            'favorite_count': favorite_count,
-            'publish_time': publish_time,
-            'duration': duration,
-            'category_id': category_id,
-            'thumbnail': thumbnail_url,
-            'channel_id': channel_id,
-            'channel_title': channel_title,
-            'channel_icon': channel_icon
-        }
-        return video_info
-    return None
+        return execute_request(channel_request, 'channels', guard=guard, http=http)
+
+    channels_info = {}
+    for channel_response in map_chunks(fetch_chunk, channel_ids, http_pool):
+        for channel_item in channel_response.get('items', []):
+            channels_info[channel_item['id']] = {
+                'title': channel_item['snippet'].get('title', None),
+                'icon': channel_item['snippet']['thumbnails']['default']['url']
+            }
+    return channels_info
+
+
+def parse_video_item(video_item, channel_icon=None):
+    """
+    Convert a videos.list item into the video information dictionary stored in the database.
+
+    Parameters:
+    video_item (dict): A single item of a videos.list response.
+    channel_icon (str, optional): Icon URL of the video's channel.
+
+    Returns:
+    dict: A dictionary containing video information.
+    """
+    video_id = video_item['id']
+    video_info = video_item['snippet']
+
+    title = video_info.get('title', None)
+    description = video_info.get('description', None)
+    if description and len(description) > 1200:
+        description = description[:1195] + '...'
+    view_count = video_item['statistics'].get('viewCount', None)
+    like_count = video_item['statistics'].get('likeCount', None)
+    comment_count = video_item['statistics'].get('commentCount', None)
+    favorite_count = video_item['statistics'].get('favoriteCount', None)
+    category_id = video_info.get('categoryId', None)
+    if category_id is not None:
+        category_id = int(category_id)
+    publish_time = video_info.get('publishedAt', None)
+    if publish_time:
+        if isinstance(publish_time, str):
+            publish_time = publish_time.replace('Z', '+00:00')
+    duration = parse_duration(video_item['contentDetails']['duration']).total_seconds()
+
+    thumbnail_url = f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"
+
+    channel_id = video_info.get('channelId', None)
+    channel_title = video_info['channelTitle']
+
+    return {
+        'title': title,
+        'description': description,
+        'view_count': view_count,
+        'like_count': like_count,
+        'comment_count': comment_count,
+        'favorite_count': favorite_count,
+        'publish_time': publish_time,
+        'duration': duration,
+        'category_id': category_id,
+        'thumbnail': thumbnail_url,
+        'channel_id': channel_id,
+        'channel_title': channel_title,
+        'channel_icon': channel_icon
+    }
+
+
+def get_youtube_videos_info(video_ids, youtube=youtube, channel_cache=None, guard=None, http_pool=None):
+    """
+    Retrieve details for a batch of YouTube videos using the YouTube Data API.
+
+    Video IDs are packed into videos.list calls of up to 50 IDs each, and the
+    channels of all found videos are resolved with de-duplicated channels.list calls.
+    If a channel cache is given, only the channels it cannot resolve are fetched.
+    If an HTTP pool is given, the calls of the chunks are sent concurrently, so that a large batch
+    takes about as long as a single call.
+
+    Parameters:
+    video_ids (list): The IDs of the YouTube videos, duplicates are ignored.
+    youtube (googleapiclient.discovery.Resource, optional): YouTube API service object.
+    channel_cache (utils.cache_utils.ChannelCache, optional): Cache consulted before any channel lookup.
+    guard (utils.throttle_utils.ApiGuard, optional): Guard of the API calls.
+    http_pool (HttpPool, optional): HTTP objects to send the calls of several chunks concurrently.
+
+    Returns:
+    tuple: A dictionary mapping each found video ID to its video information,
+           and a list of the video IDs that were not found.
+    """
+    video_ids = list(dict.fromkeys(video_ids))
+
+    def fetch_chunk(chunk, http):
+        # Call the videos.list method to retrieve video details
+        video_request = youtube.videos().list(
+            part="snippet,contentDetails,statistics",
+            id=",".join(chunk)
+        )
+        return execute_request(video_request, 'videos', guard=guard, http=http)
+
+    video_items = {}
+    for video_response in map_chunks(fetch_chunk, video_ids, http_pool):
+        for video_item in video_response.get('items', []):
+            video_items[video_item['id']] = video_item
+
+    channel_ids = [item['snippet'].get('channelId') for item in video_items.values()]
+    if channel_cache is None:
+        channels_info = get_youtube_channels_info(channel_ids, youtube=youtube, guard=guard, http_pool=http_pool)
+    else:
+        channels_info = channel_cache.get_many(
+            channel_ids,
+            lambda missing_ids: get_youtube_channels_info(missing_ids, youtube=youtube, guard=guard, http_pool=http_pool))
+
+    videos_info = {}
+    for video_id, video_item in video_items.items():
+        channel_icon = channels_info.get(video_item['snippet'].get('channelId'), {}).get('icon')
+        videos_info[video_id] = parse_video_item(video_item, channel_icon)
+    missing_ids = [video_id for video_id in video_ids if video_id not in videos_info]
+    return videos_info, missing_ids
+
+
+def get_youtube_video_info(video_id, session_date=None, youtube=youtube, guard=None):
+    """
+    Retrieve YouTube video details using the YouTube Data API.
+
+    Parameters:
+    video_id (str): The ID of the YouTube video.
+    session_date (datetime, optional): The date of the session.
+    youtube (googleapiclient.discovery.Resource, optional): YouTube API service object.
+    guard (utils.throttle_utils.ApiGuard, optional): Guard of the API calls.
+
+    Returns:
+    dict: A dictionary containing video information, or None if the video is not found.
+    """
+    videos_info, _ = get_youtube_videos_info([video_id], youtube=youtube, guard=guard)
+    return videos_info.get(video_id)
 
 
 def beautify_video_info(video_info):
@@ -0,0 +1,193 @@
+"""
+worker.py
+
+This worker process consumes the background jobs that the Flask application queues in Redis.
+Run it next to the web server with `python worker.py`, or `python worker.py --processes N` for a pool of N processes.
+With `--flush`, it instead writes the ratings buffered in write-behind mode to the database.
+A job taken by a worker that stops is queued again by the other workers, or by the worker itself once restarted.
+
+Jobs:
+- ingest: Processes an uploaded file stored by /process in asynchronous mode
+- prefetch: Fetches the video metadata of the eligible sessions of an uploaded file
+"""
+
+import argparse
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import threading
+import time
+
+from app import app, db, redis_client, video_cache, HistoryInfo, IngestError, fetch_videos_info, ingest_history
+from app import RATINGS_STREAM, RATINGS_GROUP, flush_ratings
+from utils.metrics_utils import mark_process_dead
+from utils.queue_utils import (MAX_JOB_ATTEMPTS, WORKER_TTL, dequeue_job, ensure_group, finish_job, heartbeat,
+                               requeue_stale_jobs, set_job_status)
+
+
+def prefetch_videos(filename, eligible_sessions, status_key):
+    """
+    Fill the Video table and the video cache for the first videos of every eligible session of a file.
+
+    Parameters:
+    filename (str): Name of the processed file.
+    eligible_sessions (list): Numbers of the sessions that may be shown to the user.
+    status_key (str): Redis key of the job status hash.
+    """
+    history_info = (
+        HistoryInfo.query
+        .filter(HistoryInfo.filename == filename, HistoryInfo.session_num.in_(eligible_sessions))
+        .order_by(HistoryInfo.id)
+        .all()
+    )
+    # keep the first videos of each session, as session_overview shows them
+    per_session = {}
+    for history in history_info:
+        session_videos = per_session.setdefault(history.session_num, [])
+        if len(session_videos) < app.config['MAX_VIDEOS_PER_SESSION']:
+            session_videos.append(history.video_id)
+    video_ids = list(dict.fromkeys(video_id for videos in per_session.values() for video_id in videos))
+
+    set_job_status(redis_client, status_key, n_videos=len(video_ids), n_cached=len(video_ids),
+                   n_fetched=0, n_not_found=0)
+
+    def fetch_missing(missing_ids):
+        fetched_info, not_found_ids = fetch_videos_info(missing_ids, f'for prefetch of file {filename}')
+        set_job_status(redis_client, status_key, n_cached=len(video_ids) - len(missing_ids),
+                       n_fetched=len(fetched_info), n_not_found=len(not_found_ids))
+        return fetched_info, not_found_ids
+
+    # warms the shared cache tier and remembers the videos missing on YouTube
+    video_cache.get_many(video_ids, fetch_missing)
+
+def ingest_upload(upload_path, filename, uid, tz_offset, status_key, content_hash=None):
+    """
+    Process an uploaded file and record the result needed to start the study.
+
+    Parameters:
+    upload_path (str): Path of the stored upload, removed once processed or rejected.
+    filename (str): Name under which the file is stored.
+    uid (str): ID of the user.
+    tz_offset (float): Offset in hours of the user's time zone, or None.
+    status_key (str): Redis key of the job status hash.
+    content_hash (str, optional): SHA-256 hash of the upload.
+
+    Returns:
+    dict: Status fields holding the JSON-encoded result of ingest_history.
+    """
+    try:
+        with open(upload_path, 'rb') as upload:
+            result = ingest_history(upload, filename, uid, tz_offset, content_hash=content_hash)
+    except IngestError:
+        os.remove(upload_path)
+        raise
+    # kept after other errors, so that the job can run again if the worker stopped
+    os.remove(upload_path)
+    return {'result': json.dumps(result)}
+
+
+JOBS = {
+    'ingest': ingest_upload,
+    'prefetch': prefetch_videos,
+}
+
+
+def run_job(job):
+    """
+    Run a single job and record its outcome in the job status hash.
+
+    Parameters:
+    job (dict): The job popped from the queue.
+    """
+    status_key = job['status_key']
+    attempts = redis_client.hincrby(status_key, 'attempts', 1)
+    if attempts > MAX_JOB_ATTEMPTS:
+        set_job_status(redis_client, status_key, state='failed', error=f'Stopped during {MAX_JOB_ATTEMPTS} attempts')
+        app.logger.error(f'Job {job["id"]} of type {job["type"]} given up after {MAX_JOB_ATTEMPTS} attempts')
+        return
+    started_at = time.time()
+    set_job_status(redis_client, status_key, state='running', started_at=started_at)
+    try:
+        with app.app_context():
+            result = JOBS[job['type']](**job['payload'], status_key=status_key)
+        set_job_status(redis_client, status_key, state='done', duration=time.time() - started_at, **(result or {}))
+        app.logger.info(f'Job {job["id"]} of type {job["type"]} done in {time.time() - started_at:.2f}s')
+    except IngestError as e:
+        with app.app_context():
+            db.session.rollback()
+        set_job_status(redis_client, status_key, state='failed', message=str(e))
+        app.logger.error(f'Job {job["id"]} of type {job["type"]} rejected the upload: {str(e)}')
+    except Exception as e:
+        with app.app_context():
+            db.session.rollback()
+        set_job_status(redis_client, status_key, state='failed', error=str(e))
+        app.logger.error(f'Job {job["id"]} of type {job["type"]} failed: {str(e)}')
+
+
+def keep_alive(consumer):
+    """Refresh the liveness marker of a worker until its process stops."""
+    while True:
+        heartbeat(redis_client, consumer)
+        time.sleep(WORKER_TTL / 3)
+
+
+def requeue_stale(consumer):
+    """Queue again the jobs of the workers that stopped while processing them."""
+    for job in requeue_stale_jobs(redis_client, consumer):
+        app.logger.warning(f'Job {job["id"]} of type {job["type"]} queued again after its worker stopped')
+
+
+def main():
+    """Consume jobs from the queue until the process is stopped."""
+    consumer = f'{socket.gethostname()}-{os.getpid()}'
+    heartbeat(redis_client, consumer)
+    threading.Thread(target=keep_alive, args=(consumer,), daemon=True).start()
+    app.logger.info(f'Worker {consumer} started')
+    requeue_stale(consumer)
+    while True:
+        job = dequeue_job(redis_client, consumer)
+        if job is None:
+            requeue_stale(consumer)
+            continue
+        run_job(job)
+        finish_job(redis_client, consumer, job)
+
+
+def flush():
+    """Write buffered ratings to the database until the process is stopped."""
+    consumer = f'{socket.gethostname()}-{os.getpid()}'
+    ensure_group(redis_client, RATINGS_STREAM, RATINGS_GROUP)
+    app.logger.info(f'Flusher {consumer} started')
+    while True:
+        try:
+            with app.app_context():
+                n_ratings = flush_ratings(consumer, block=1000)
+            if n_ratings:
+                app.logger.info(f'Flusher {consumer} wrote {n_ratings} ratings')
+        except Exception as e:
+            # unacknowledged ratings stay pending and are delivered again
+            with app.app_context():
+                db.session.rollback()
+            app.logger.error(f'Flusher {consumer} failed to write ratings: {str(e)}')
+            time.sleep(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Consume background jobs queued by the Flask application.')
+    parser.add_argument('--processes', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--flush', action='store_true', help='Write the buffered ratings instead of running jobs')
+    args = parser.parse_args()
+    target = flush if args.flush else main
+    if args.processes == 1:
+        target()
+    else:
+        workers = [multiprocessing.Process(target=target) for _ in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        while workers:
+            multiprocessing.connection.wait([worker.sentinel for worker in workers])
+            for worker in [worker for worker in workers if not worker.is_alive()]:
+                mark_process_dead(worker.pid)
+                workers.remove(worker)